@@ -3,10 +3,15 @@ import asyncio
 import subprocess
 import aiohttp
 import time
+import sys
+from pathlib import Path
 from livekit import api
 from dotenv import load_dotenv
 load_dotenv()
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils_.media_cache import media_cache, stream_copy_cmd
+
 API_URL = "https://content-core-dev.longvan.vn/api/layouts?filters[sites][name][$eq]=TRUEDOC&filters[name][$eq]=WAITINGROOM&populate[banners]=true"
 
 
@@ -54,6 +59,8 @@ async def create_ingress_and_push(room_name: str):
     if not video_path:
         print("❌ Không lấy được video_path hợp lệ, dừng lại.")
         return
+    # tải + encode 1 lần, các vòng stream sau chỉ copy
+    cached_path = await media_cache.get(video_path)
 
     print("🔗 Kết nối LiveKit API...")
     lkapi = api.LiveKitAPI(
@@ -93,7 +100,7 @@ async def create_ingress_and_push(room_name: str):
                 print("⏰ Hết 1 tiếng, dừng stream và xóa ingress.")
                 break
 
-            cmd = [
+            cmd = stream_copy_cmd(cached_path, full_rtmp) if cached_path else [
                 "ffmpeg", "-re",
                 "-stream_loop", "-1",
                 "-i", video_path,
@@ -0,0 +1,122 @@
+import time
+
+
+class AdaptiveInterval:
+    """
+    Khoảng nghỉ giữa 2 tick của poll loop:
+      - tick có thay đổi (join/leave, room mới/mất, egress đang start/stop, việc trễ sắp tới) → về min_interval
+      - tick không có gì đổi → nhân factor, tối đa max_interval
+    Dispatcher đặt max_interval = nhịp list_rooms gốc: tick chỉ được rút ngắn, không giãn
+    (giãn nhịp theo từng room do RoomLanes lo, chỉ áp cho list_participants).
+    """
+
+    def __init__(self, min_interval: float = 0.5, max_interval: float = 4.0, factor: float = 1.5,
+                 start: float = 1.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.current = max(min_interval, min(start, max_interval))
+
+    def next(self, changed: bool) -> float:
+        if changed:
+            self.current = self.min_interval
+        else:
+            self.current = min(self.max_interval, self.current * self.factor)
+        return self.current
+
+
+def room_fingerprint(room_info):
+    """
+    Các field của list_rooms đổi theo membership: num_participants, num_publishers và version (server tăng mỗi
+    lần cập nhật room). 1 người rời + 1 người vào trong cùng 1 tick giữ nguyên số người nhưng đổi version.
+    """
+    version = getattr(room_info, "version", None)
+    return (
+        getattr(room_info, "sid", ""),
+        getattr(room_info, "num_participants", 0),
+        getattr(room_info, "num_publishers", 0),
+        (version.unix_micro, version.ticks) if version is not None else None,
+    )
+
+
+class _RoomLane:
+    __slots__ = ("num", "fingerprint", "identities", "participants", "fetched_at", "hot_until")
+
+    def __init__(self):
+        self.num = None
+        self.fingerprint = None
+        self.identities = None
+        self.participants = None
+        self.fetched_at = 0.0
+        self.hot_until = 0
+
+
+class RoomLanes:
+    """
+    Làn hot / cold cho list_participants theo từng room:
+      - hot:  room vừa đổi (số người / identities) trong hot_ticks tick gần nhất, hoặc is_hot(room) đúng
+              (egress đang start/stop, video chờ đang chạy, ...) → list mỗi tick
+      - cold: room ổn định → dùng lại danh sách participant lần trước, chỉ list lại sau cold_interval giây
+    room_fingerprint (num_participants, num_publishers, version từ list_rooms) khác lần trước → list ngay
+    (join/leave không bị trễ, kể cả rời + vào trong cùng 1 tick).
+    """
+
+    def __init__(self, cold_interval: float = 10.0, hot_ticks: int = 5, is_hot=None):
+        self.cold_interval = cold_interval
+        self.hot_ticks = hot_ticks
+        self.is_hot = is_hot
+        self._rooms = {}  # room_name -> _RoomLane
+        self._tick = 0
+        self._reused = set()
+        self._fingerprints = {}  # room_name -> room_fingerprint của tick hiện tại
+        self.changed = False  # tick hiện tại có room nào đổi không
+
+    def begin_tick(self):
+        self._tick += 1
+        self._reused = set()
+        self._fingerprints = {}
+        self.changed = False
+
+    def reuse(self, room_info):
+        """Danh sách participant cũ nếu room đang ở làn cold và list_rooms không đổi; None → cần list lại."""
+        room_name = getattr(room_info, "name", "")
+        fingerprint = self._fingerprints[room_name] = room_fingerprint(room_info)
+        lane = self._rooms.get(room_name)
+        if lane is None or lane.participants is None or lane.fingerprint != fingerprint:
+            return None
+        if lane.hot_until >= self._tick or (self.is_hot is not None and self.is_hot(room_name)):
+            return None
+        if time.monotonic() - lane.fetched_at >= self.cold_interval:
+            return None
+        self._reused.add(room_name)
+        return lane.participants
+
+    def observe(self, room_name: str, num_participants: int, participants):
+        """Ghi nhận kết quả 1 room sau khi build snapshot; room đổi → chuyển sang làn hot."""
+        if participants is None:
+            return
+        lane = self._rooms.get(room_name)
+        if lane is None:
+            lane = self._rooms[room_name] = _RoomLane()
+        if room_name in self._reused:
+            return
+        identities = frozenset((p.identity or "").strip() for p in participants)
+        if lane.num != num_participants or lane.identities != identities:
+            lane.hot_until = self._tick + self.hot_ticks
+            self.changed = True
+        lane.num = num_participants
+        lane.fingerprint = self._fingerprints.get(room_name)
+        lane.identities = identities
+        lane.participants = participants
+        lane.fetched_at = time.monotonic()
+
+    def retain(self, room_names):
+        """Bỏ state của room không còn trên server; room mất cũng tính là thay đổi."""
+        gone = [r for r in self._rooms if r not in room_names]
+        for r in gone:
+            del self._rooms[r]
+        if gone:
+            self.changed = True
+
+    def hot_count(self) -> int:
+        return sum(1 for lane in self._rooms.values() if lane.hot_until >= self._tick)
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+from pathlib import Path
+
+"""
+Benchmark dispatcher (run_tick của monitor_and_dispatch) với fake_livekit.py ở nhiều quy mô room.
+Mỗi quy mô chạy 2 process riêng: fake LiveKit server + dispatcher (state sạch, CPU / RAM đo riêng cho dispatcher).
+Đo mỗi tick: latency, số call LiveKit API (đếm phía server), CPU dispatcher; cuối run: RSS của dispatcher.
+Checkpoint Redis (state_store.flush) và room registry không chạy trong benchmark → chỉ đo phần LiveKit.
+
+Cách chạy:
+  python bench_dispatch.py                                  # 10, 100, 1000, 5000 room
+  python bench_dispatch.py --sizes 100,1000 --ticks 30 --latency-ms 5 --churn 0.05
+  python bench_dispatch.py --max-p95-ms 500                 # exit 1 nếu p95 tick vượt ngưỡng (regression gate)
+"""
+
+HERE = Path(__file__).resolve().parent
+BENCH_ROUTING = {
+    "rules": [
+        {"name": "bench", "match": "prefix", "prefixes": ["bench_"], "agent": "assistant_agent",
+         "monitor": True, "egress": True, "ingress_mode": "url"},
+    ]
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fetch_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(f"{base_url}/_stats", timeout=5) as resp:
+        return json.load(resp)
+
+
+def wait_ready(base_url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return fetch_stats(base_url)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+# ---------- process dispatcher (1 quy mô) ----------
+async def run_one(args):
+    base_url = args.livekit_url
+    sys.path.insert(0, str(HERE))
+    import dispatch
+    from livekit import api
+
+    lkapi = api.LiveKitAPI(url=base_url, api_key="bench", api_secret="bench_secret_bench_secret_bench_secret")
+    try:
+        for _ in range(args.warmup):
+            await dispatch.run_tick(lkapi)
+            await asyncio.sleep(args.interval)
+
+        ticks, calls, cpu = [], [], []
+        mem_before = rss_mb()
+        for _ in range(args.ticks):
+            before = await asyncio.to_thread(fetch_stats, base_url)
+            cpu0 = time.process_time()
+            started = time.perf_counter()
+            await dispatch.run_tick(lkapi)
+            ticks.append((time.perf_counter() - started) * 1000)
+            cpu.append((time.process_time() - cpu0) * 1000)
+            after = await asyncio.to_thread(fetch_stats, base_url)
+            calls.append(sum(after["calls"].values()) - sum(before["calls"].values()))
+            await asyncio.sleep(args.interval)
+        stats = await asyncio.to_thread(fetch_stats, base_url)
+        result = {
+            "rooms": stats["rooms"],
+            "tick_p50_ms": statistics.median(ticks),
+            "tick_p95_ms": percentile(ticks, 95),
+            "tick_max_ms": max(ticks),
+            "api_calls_per_tick": statistics.mean(calls),
+            "cpu_ms_per_tick": statistics.mean(cpu),
+            "rss_mb": rss_mb(),
+            "rss_growth_mb": rss_mb() - mem_before,
+            "egress": stats["egress"],
+            "ingress": stats["ingress"],
+            "errors": stats["errors"],
+        }
+    finally:
+        await dispatch.delay_scheduler.stop()
+        await dispatch.ingress_supervisor.stop_all()
+        await dispatch.waiting_video.stop()
+        await dispatch.egress_manager.drain()
+        await lkapi.aclose()
+
+    with open(args.result, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+# ---------- driver ----------
+def bench_size(rooms: int, args, routing_path: str) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server_cmd = [
+        sys.executable, str(HERE / "fake_livekit.py"), "--port", str(port), "--rooms", str(rooms),
+        "--users", str(args.users), "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+        "--error-rate", str(args.error_rate), "--churn", str(args.churn), "--seed", "1",
+    ]
+    server = subprocess.Popen(server_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(base_url)
+        fd, result_path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        env = dict(
+            os.environ,
+            LIVEKIT_URL=base_url,
+            ROUTING_CONFIG=routing_path,
+            WAITING_VIDEO_API_URL=f"{base_url}/api/layouts",
+            INGRESS_MAX_STREAMS=str(rooms),
+            EGRESS_MAX_CONCURRENT="0",
+            SHARD_COUNT="0",
+            METRICS_PORT="0",
+            RECORDINGS_LOCAL_DIR="",
+        )
+        child_cmd = [
+            sys.executable, str(Path(__file__).resolve()), "--run-one", "--livekit-url", base_url,
+            "--result", result_path, "--ticks", str(args.ticks), "--warmup", str(args.warmup),
+            "--interval", str(args.interval),
+        ]
+        # log của dispatcher bỏ đi (vẫn tính vào CPU vì print là chi phí thật của dispatcher)
+        subprocess.run(child_cmd, env=env, stdout=subprocess.DEVNULL, check=True, cwd=str(HERE))
+        with open(result_path, encoding="utf-8") as f:
+            result = json.load(f)
+        os.remove(result_path)
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dispatcher với fake LiveKit")
+    parser.add_argument("--sizes", default="10,100,1000,5000", help="danh sách số room, cách nhau dấu phẩy")
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3, help="số tick bỏ qua (dispatch agent / start egress ban đầu)")
+    parser.add_argument("--interval", type=float, default=0.2, help="nghỉ giữa 2 tick (giây)")
+    parser.add_argument("--users", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    parser.add_argument("--jitter-ms", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--churn", type=float, default=0.02)
+    parser.add_argument("--max-p95-ms", type=float, default=None, help="ngưỡng p95 tick; vượt thì exit 1")
+    parser.add_argument("--json", action="store_true", help="in kết quả dạng JSON")
+    # nội bộ: process dispatcher của 1 quy mô
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--livekit-url", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        asyncio.run(run_one(args))
+        return
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(BENCH_ROUTING, f)
+        routing_path = f.name
+    results = []
+    try:
+        for rooms in (int(s) for s in args.sizes.split(",") if s.strip()):
+            print(f"⏱️ Benchmark {rooms} room ...", file=sys.stderr, flush=True)
+            results.append(bench_size(rooms, args, routing_path))
+    finally:
+        os.remove(routing_path)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'rooms':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'calls/tick':>11} "
+              f"{'cpu ms/tick':>12} {'rss MB':>8} {'egress':>7} {'ingress':>8}")
+        for r in results:
+            print(f"{r['rooms']:>6} {r['tick_p50_ms']:>9.1f} {r['tick_p95_ms']:>9.1f} {r['tick_max_ms']:>9.1f} "
+                  f"{r['api_calls_per_tick']:>11.1f} {r['cpu_ms_per_tick']:>12.1f} {r['rss_mb']:>8.1f} "
+                  f"{r['egress']:>7} {r['ingress']:>8}")
+
+    if args.max_p95_ms is not None:
+        slow = [r for r in results if r["tick_p95_ms"] > args.max_p95_ms]
+        if slow:
+            print(f"❌ p95 tick vượt {args.max_p95_ms} ms ở: {', '.join(str(r['rooms']) for r in slow)} room",
+                  file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from metrics import set_pending_delayed
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+class DelayScheduler:
+    """
+    Hàng đợi việc trễ dùng chung (min-heap theo deadline), 1 task chạy nền duy nhất thay cho mỗi việc 1 task sleep.
+      - key = (room_name, identity, action): đã có việc cùng key đang chờ thì schedule() bỏ qua (giữ deadline cũ)
+      - cancel(key) / cancel_room(room) khi điều kiện không còn đúng
+      - pending() / pending_by_action() để đo số việc đang chờ
+    Entry bị hủy chỉ đánh dấu, bỏ qua khi tới lượt (lazy delete).
+    """
+
+    def __init__(self):
+        self._heap = []                 # (due, seq, key)
+        self._entries = {}              # key -> (seq, fn)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._running = set()           # task callback đang chạy
+
+    # ---------- API ----------
+    def schedule(self, key, delay: float, fn) -> bool:
+        """fn: coroutine function không tham số, chạy sau delay giây. Trả về False nếu key đã đang chờ."""
+        if key in self._entries:
+            return False
+        self._ensure_started()
+        seq = next(self._seq)
+        due = time.monotonic() + delay
+        self._entries[key] = (seq, fn)
+        heapq.heappush(self._heap, (due, seq, key))
+        self._publish()
+        if self._heap[0][1] == seq:
+            # việc mới là việc sớm nhất → đánh thức runner để tính lại thời gian ngủ
+            self._wakeup.set()
+        return True
+
+    def cancel(self, key) -> bool:
+        if self._entries.pop(key, None) is None:
+            return False
+        self._publish()
+        return True
+
+    def cancel_room(self, room_name: str) -> int:
+        keys = [k for k in self._entries if k[0] == room_name]
+        for k in keys:
+            self._entries.pop(k, None)
+        if keys:
+            self._publish()
+        return len(keys)
+
+    def is_pending(self, key) -> bool:
+        return key in self._entries
+
+    def pending(self) -> int:
+        return len(self._entries)
+
+    def pending_by_action(self) -> dict:
+        counts = {}
+        for _, _, action in self._entries:
+            counts[action] = counts.get(action, 0) + 1
+        return counts
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        self._heap.clear()
+        self._entries.clear()
+        self._publish()
+
+    # ---------- nội bộ ----------
+    def _publish(self):
+        set_pending_delayed(self.pending_by_action())
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            # bỏ các entry đã bị hủy / đã được schedule lại ở đỉnh heap
+            while self._heap and self._entries.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+                heapq.heappop(self._heap)
+
+            timeout = max(0.0, self._heap[0][0] - time.monotonic()) if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                continue  # có việc mới sớm hơn → tính lại
+            except asyncio.TimeoutError:
+                pass
+
+            t = time.monotonic()
+            while self._heap and self._heap[0][0] <= t:
+                _, seq, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry[0] != seq:
+                    continue
+                del self._entries[key]
+                self._fire(key, entry[1])
+            self._publish()
+
+    def _fire(self, key, fn):
+        async def _call():
+            try:
+                await fn()
+            except Exception as e:
+                print(f"{now()} ❌ Delayed {key[2]} {key[1]} in {key[0]} failed: {repr(e)}")
+
+        task = asyncio.create_task(_call())
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
@@ -1,17 +1,33 @@
 import os
+import sys
 import asyncio
 import time
 import json
 import datetime
+from pathlib import Path
 from dotenv import load_dotenv
 from livekit import api
-import requests
 
-# optional redis (synchronous client). We'll call it in a thread to avoid blocking the event loop.
-try:
-    import redis
-except Exception:
-    redis = None
+from webhook_ingest import WebhookIngest, event_room_name
+from room_snapshot import RoomSnapshot, RoomView
+from metrics import observe_tick, track_api, observe_room, observe_redis, set_room_gauges, start_metrics_server
+from egress_manager import EgressManager
+from egress_profiles import EgressProfiles
+from segment_watcher import SegmentWatcher
+from routing import Router
+from participant_classifier import ParticipantKind, classifier
+from delay_scheduler import DelayScheduler
+from state_store import DispatcherState, StateStore, TrackedDict, TrackedSet
+from sharding import ShardManager, ShardEventBus, shard_of
+from ingress_broadcaster import IngressBroadcaster
+from ingress_supervisor import IngressSupervisor
+from adaptive_poll import AdaptiveInterval, RoomLanes
+
+# cho phép import utils_ khi chạy trực tiếp `python dispatch_server/dispatch.py`
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils_.connect_redis import RoomRegistry
+from utils_.media_cache import media_cache
+from utils_.waiting_video import waiting_video
 
 # --- Load env ---
 load_dotenv()
@@ -26,88 +42,65 @@ REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", "111111aA")
 REDIS_HASH_KEY = os.getenv("REDIS_HASH_KEY", "room:online")
 # -----------------------------------------------------------------------
 
-# Danh sách phòng cho từng loại agent (static)
-MEDICAL_ROOMS = {f"PhongDangKy{i:02}" for i in range(1, 3)}
-ASSISTANT_ROOMS = {f"PhongKham{i:02}" for i in range(1, 3)}
-# NOTE: đây là các room dùng cho dispatch record_agent trong code gốc
-RECORD_ROOMS = {f"PhongHop{i:02}" for i in range(1, 2)}
-TEST_ROOMS = {f"Test{i:02}" for i in range(1, 3)}
-OFFLINE_ROOMS ={f"Offline{i:02}" for i in range(1,2)}
-# --- Egress-specific rooms (static sample from original egress code) ---
-# Bạn có thể thay đổi thành {f"Phong{i:02}" for i in range(1,11)} nếu muốn
-EGRESS_ROOMS = {f"Phong{i:02}" for i in range(1, 11)}
+# Bảng định tuyến room -> agent / monitor / egress (mỗi môi trường 1 file config, không cần fork code)
+# File được hot-reload khi sửa, không cần restart dispatcher.
+ROUTING_CONFIG = os.getenv("ROUTING_CONFIG", str(Path(__file__).with_name("routing.json")))
+router = Router(ROUTING_CONFIG)
 
-# ROOMS_TO_MONITOR ban đầu (static); sau này khi chạy sẽ kết hợp với redis_rooms động
-STATIC_ROOMS_TO_MONITOR = TEST_ROOMS | ASSISTANT_ROOMS
+# room có state đổi từ lần checkpoint trước (các dict / set state bên dưới tự ghi vào)
+dirty_rooms = set()
 
 # Ghi nhớ các phòng đã được dispatch
-dispatched_rooms = set()
-doctor_first_rooms = set() 
+dispatched_rooms = TrackedSet(dirty_rooms)
+doctor_first_rooms = TrackedSet(dirty_rooms)
 
 # --- Egress state ---
-egress_map = {}        # room_name -> egress_id
-room_recording = {}    # room_name -> bool
-room_filepath = {}     # room_name -> current file path
+egress_map = TrackedDict(dirty_rooms)        # room_name -> egress_id
+room_recording = TrackedDict(dirty_rooms)    # room_name -> bool
+room_filepath = TrackedDict(dirty_rooms)     # room_name -> current file path
 
 # track last known participant identities & counts to reduce logging
-last_room_state = {}   # room_name -> {"count_all": int, "count_egress": int, "identities": set(), "recording": bool}
+last_room_state = TrackedDict(dirty_rooms)   # room_name -> {"count_all": int, "count_egress": int, "identities": set(), "recording": bool}
 
 # Config
 MIN_PARTICIPANTS_EGRESS = 2   # egress start condition (real users, excluding EG_* and *_agent)
-CHECK_INTERVAL = 1            # main loop sleep seconds
+CHECK_INTERVAL = 1            # main loop sleep seconds: nhịp list_rooms, không giãn quá mức này (join không bị trễ)
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "0.5"))   # ngay sau khi có thay đổi
+COLD_ROOM_INTERVAL = float(os.getenv("COLD_ROOM_INTERVAL", "10"))  # room ổn định: list_participants lại sau N giây
+HOT_ROOM_TICKS = int(os.getenv("HOT_ROOM_TICKS", "5"))             # room vừa đổi: list mỗi tick trong N tick
+
+# Webhook mode: DISPATCH_MODE=webhook → nhận event từ LiveKit, poll chỉ còn là reconciliation sweep
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "poll")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8089"))
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "30"))  # giây giữa 2 lần quét đầy đủ
+SNAPSHOT_CONCURRENCY = int(os.getenv("SNAPSHOT_CONCURRENCY", "16"))  # số list_participants chạy song song mỗi tick
+FANOUT_TIMEOUT = float(os.getenv("FANOUT_TIMEOUT", "3"))      # timeout mỗi list_participants (giây)
+FANOUT_JITTER = float(os.getenv("FANOUT_JITTER", "0"))        # jitter trước mỗi call (giây), 0 = tắt
+SLOW_TICK_SECONDS = float(os.getenv("SLOW_TICK_SECONDS", "2"))  # log cảnh báo khi 1 tick chậm hơn ngưỡng
+# Prometheus text (/metrics) cho tick / API call / egress / ingress / Redis; 0 = tắt
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
 
 def now():
     return time.strftime("[%H:%M:%S]")
 
-# --- Token helper (egress) ---
-def create_egress_token(room_name: str) -> str:
-    grants = api.VideoGrants(room_record=True, room_join=True, room=room_name)
-    token = api.AccessToken(LIVEKIT_API_KEY, LIVEKIT_API_SECRET)
-    token.identity = f"egress_agent_{room_name}"
-    token.with_grants(grants)
-    token.ttl = datetime.timedelta(hours=1)
-    return token.to_jwt()
-
-# --- Redis helper (synchronous) ---
-def fetch_redis_room_names_sync():
-    rooms = set()
-    if redis is None:
-        # no redis module installed
-        return rooms
-
-    try:
-        r = redis.Redis(
-            host=REDIS_HOST,
-            port=REDIS_PORT,
-            password=REDIS_PASSWORD if REDIS_PASSWORD else None,
-            decode_responses=True,
-            socket_connect_timeout=3,
-            socket_timeout=3,
-        )
-        all_fields = r.hgetall(REDIS_HASH_KEY)  # trả về dict {field: value_json}
-        for field, value_json in all_fields.items():
-            try:
-                data = json.loads(value_json)
-                room_name = data.get("roomName")
-                if room_name:
-                    rooms.add(room_name)
-            except json.JSONDecodeError:
-                # skip bad field
-                continue
-    except Exception:
-        # don't spam logs; return empty set on error
-        return set()
-    return rooms
-
-async def fetch_redis_room_names():
-    return await asyncio.to_thread(fetch_redis_room_names_sync)
+# --- Redis room registry (async, pool dùng lâu dài, map in-memory cập nhật incremental) ---
+room_registry = RoomRegistry(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    password=REDIS_PASSWORD,
+    hash_key=REDIS_HASH_KEY,
+    on_latency=observe_redis,
+)
 
 # --- DFlispatch agent ---
 async def dispatch_agent(lkapi, room_name: str, agent_name: str):
     try:
-        await lkapi.agent_dispatch.create_dispatch(
-            api.CreateAgentDispatchRequest(agent_name=agent_name, room=room_name)
-        )
+        with track_api("create_dispatch"):
+            await lkapi.agent_dispatch.create_dispatch(
+                api.CreateAgentDispatchRequest(agent_name=agent_name, room=room_name)
+            )
         print(f"{now()} ✅ Dispatched {agent_name} -> {room_name}")
         dispatched_rooms.add(room_name)
     except Exception as e:
@@ -116,7 +109,8 @@ async def dispatch_agent(lkapi, room_name: str, agent_name: str):
 # --- Safe wrappers ---
 async def safe_list_rooms(lkapi):
     try:
-        resp = await lkapi.room.list_rooms(api.ListRoomsRequest())
+        with track_api("list_rooms"):
+            resp = await lkapi.room.list_rooms(api.ListRoomsRequest())
         return resp
     except Exception as e:
         # minimal logging
@@ -125,7 +119,8 @@ async def safe_list_rooms(lkapi):
 
 async def safe_list_participants(lkapi, room_name):
     try:
-        resp = await lkapi.room.list_participants(api.ListParticipantsRequest(room=room_name))
+        with track_api("list_participants"):
+            resp = await lkapi.room.list_participants(api.ListParticipantsRequest(room=room_name))
         return resp
     except Exception as e:
         print(f"{now()} ⚠️ list_participants failed for room={room_name}: {repr(e)}")
@@ -133,9 +128,10 @@ async def safe_list_participants(lkapi, room_name):
 
 async def safe_remove_participant(lkapi, room_name, identity, label):
     try:
-        await lkapi.room.remove_participant(
-            api.RoomParticipantIdentity(room=room_name, identity=identity)
-        )
+        with track_api("remove_participant"):
+            await lkapi.room.remove_participant(
+                api.RoomParticipantIdentity(room=room_name, identity=identity)
+            )
         print(f"{now()} ❌ Removed {label} (identity={identity}) from {room_name}")
         return True
     except Exception as e:
@@ -158,146 +154,59 @@ def count_all_participants(participants):
 
 def count_real_for_egress(participants):
     """
-    Count participants excluding:
-      - identities starting with "EG_"
-      - identities that end with "_agent"
-      - explicit "ingress_agent" (also matches *_agent but keep explicit)
+    Count participants excluding EG_*, *_agent and ingress_agent (classifier đã cache).
     This is the count used to decide start/stop egress (i.e. real human users).
     """
-    cnt = 0
-    for p in participants:
-        pid = (p.identity or "").strip()
-        if not pid:
-            continue
-        if pid.startswith("EG_"):
-            continue
-        if pid.endswith("_agent"):
-            continue
-        if pid == "ingress_agent":
-            continue
-        cnt += 1
-    return cnt
+    return sum(1 for p in participants if classifier.is_real(p))
 
 
 
 # --- Ingress integration ---
-import aiohttp
-import subprocess
-
-API_URL = "https://content-core-dev.longvan.vn/api/layouts?filters[sites][name][$eq]=TRUEDOC&filters[name][$eq]=WAITINGROOM&populate[banners]=true"
-
 async def fetch_latest_video_url():
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(API_URL, timeout=10) as resp:
-                if resp.status != 200:
-                    print(f"{now()} ❌ API lỗi: {resp.status}")
-                    return None
-                data = await resp.json()
-
-        banners = (
-            data.get("data", [{}])[0]
-            .get("attributes", {})
-            .get("banners", {})
-            .get("data", [])
-        )
-
-        if not banners:
-            print(f"{now()} ⚠️ Không có banner nào trong dữ liệu API.")
-            return None
-
-        media_items = banners[0]["attributes"].get("media", [])
-        videos = [m for m in media_items if m.get("type") == "VIDEO" and m.get("url")]
-        if not videos:
-            print(f"{now()} ⚠️ Không tìm thấy media VIDEO nào.")
-            return None
-
-        latest_video = videos[-1]
-        video_url = latest_video["url"]
-        print(f"{now()} 🎬 Video mới nhất: {video_url}")
-        return video_url
-    except Exception as e:
-        print(f"{now()} ❌ Lỗi khi fetch video URL: {e}")
-        return None
+    # cache TTL + ETag + stale-while-revalidate, refresher nền chạy từ lúc start → trigger ingress không phải đợi CMS
+    return await waiting_video.get()
 
 ## Ingress video 
-import subprocess
-import asyncio
-import os
-from livekit import api
-
-async def create_ingress_and_push(room_name: str):
-    video_path = await fetch_latest_video_url()
-    if not video_path:
-        return
-
-    lkapi = api.LiveKitAPI(
-        url=LIVEKIT_URL,
-        api_key=LIVEKIT_API_KEY,
-        api_secret=LIVEKIT_API_SECRET,
-    )
-
-    req = api.CreateIngressRequest(
-        input_type=api.IngressInput.RTMP_INPUT,
-        name="ingress_agent",
-        room_name=room_name,
-        participant_identity="ingress_agent",
-        participant_name="Video giới thiệu",
-    )
-    ingress = await lkapi.ingress.create_ingress(req)
-    full_rtmp = f"{ingress.url}/{ingress.stream_key}"
-
-    # ✅ Dòng 1: thông báo bắt đầu
-    print(f"{now()} ▶️ Đang stream video vào {room_name}...")
-
-    cmd = [
-        "ffmpeg", "-re",
-        "-stream_loop", "-1",
-        "-i", video_path,
-        "-vf", "scale=1280:720",
-        "-c:v", "libx264",
-        "-preset", "veryfast",
-        "-b:v", "1300k",
-        "-maxrate", "1500k",
-        "-bufsize", "2200k",
-        "-c:a", "aac",
-        "-b:a", "96k",
-        "-ac", "2",
-        "-ar", "22050",
-        "-f", "flv", full_rtmp,
-    ]
-
-    # ẩn toàn bộ log của ffmpeg
-    with open(os.devnull, "wb") as devnull:
-        proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
-
-    await asyncio.sleep(3600)  # chạy 1 giờ
-
-    if proc.poll() is None:
-        proc.terminate()
-
-    await lkapi.ingress.delete_ingress(api.DeleteIngressRequest(ingress_id=ingress.ingress_id))
-
-    # ✅ Dòng 2: thông báo kết thúc
-    print(f"{now()} ✅ Stream đã kết thúc và ingress bị xóa.")
-
+INGRESS_MAX_STREAMS = int(os.getenv("INGRESS_MAX_STREAMS", "20"))          # số room phát video chờ cùng lúc
+INGRESS_MAX_LIVE_ENCODERS = int(os.getenv("INGRESS_MAX_LIVE_ENCODERS", "2"))  # pipeline x264 trực tiếp (khi cache lỗi)
+INGRESS_MAX_SECONDS = 3600
+# "rtmp" (ffmpeg trên máy này) hoặc "url" (ingress URL_INPUT, LiveKit tự kéo video); rule routing có thể
+# ghi đè bằng key "ingress_mode"
+INGRESS_MODE = os.getenv("INGRESS_MODE", "rtmp")
+
+# 1 pipeline đọc/encode cho mỗi video, các room chỉ gắn thêm 1 writer remux; supervisor lo vòng đời từng room
+ingress_broadcaster = IngressBroadcaster(max_live_encoders=INGRESS_MAX_LIVE_ENCODERS)
+ingress_supervisor = IngressSupervisor(
+    # rtmp mode: bản FLV đã encode sẵn (tải + encode 1 lần cho mọi room); None → pipeline tự encode 1 lần
+    ingress_broadcaster, fetch_latest_video_url, prepare_media=media_cache.get,
+    max_streams=INGRESS_MAX_STREAMS, max_seconds=INGRESS_MAX_SECONDS,
+)
+
+def ingress_mode_for(room_name: str) -> str:
+    route = route_for(room_name)
+    if route is None:
+        return INGRESS_MODE
+    return route.options.get("ingress_mode", INGRESS_MODE)
+
+def rtmp_ingress_used() -> bool:
+    """Có rule nào phát video chờ qua RTMP (cần bản encode sẵn trong media cache) không."""
+    return any(r.egress and r.options.get("ingress_mode", INGRESS_MODE) == "rtmp" for r in router.table.rules)
+
+def start_media_prewarm():
+    # encode sẵn video chờ ngay lúc khởi động + refresh nền → ingress đầu tiên không phải đợi tải / encode
+    if rtmp_ingress_used():
+        media_cache.start(fetch_latest_video_url)
+
+def create_ingress_and_push(lkapi, room_name: str) -> bool:
+    """Bắt đầu phát video chờ vào room (chạy nền). False nếu room đang phát hoặc đã đạt giới hạn."""
+    return ingress_supervisor.start(lkapi, room_name, mode=ingress_mode_for(room_name))
+
+def stop_room_ingress(room_name: str, reason: str = ""):
+    ingress_supervisor.stop(room_name, reason)
 
 
 # trạng thái ingress theo room
-ingress_state = {}  # room_name -> bool (đã trigger hay chưa)
-
-def normalize(text: str) -> str:
-    """Chuẩn hóa chuỗi về dạng thường, bỏ khoảng trắng và dấu tiếng Việt."""
-    import unicodedata
-    if not text:
-        return ""
-    text = text.lower().strip()
-    text = "".join(
-        c for c in unicodedata.normalize("NFD", text)
-        if unicodedata.category(c) != "Mn"
-    )
-    return text
-
+ingress_state = TrackedDict(dirty_rooms)  # room_name -> bool (đã trigger hay chưa)
 
 async def trigger_ingress_if_needed(lkapi, room_name: str, participants):
     """
@@ -311,16 +220,13 @@ async def trigger_ingress_if_needed(lkapi, room_name: str, participants):
     real_count = count_real_for_egress(participants)
 
     # lọc ra các user thật KHÔNG phải bác sĩ
-    real_users = [
-        p for p in participants
-        if not any(
-            k in normalize(p.identity or "") or k in normalize(p.name or "")
-            for k in ["bs", "bacsi", "bac si", "bac-si", "bac_sĩ"]
-        )
-        and not (p.identity or "").startswith("EG_")
-        and not (p.identity or "").endswith("_agent")
-        and (p.identity or "").strip() != "ingress_agent"
-    ]
+    real_users = [p for p in participants if classifier.classify(p) == ParticipantKind.PATIENT]
+
+    # bác sĩ đã vào → tắt video chờ ngay
+    if ingress_supervisor.is_running(room_name) and any(
+        classifier.classify(p) == ParticipantKind.DOCTOR for p in participants
+    ):
+        stop_room_ingress(room_name, "bác sĩ đã vào phòng")
 
     # trigger ingress nếu chỉ còn 1 user thật KHÔNG phải bác sĩ
     if not ingress_state[room_name] and len(real_users) == 1:
@@ -330,180 +236,537 @@ async def trigger_ingress_if_needed(lkapi, room_name: str, participants):
         print(f"{now()} 🎯 Room {room_name} có đúng 1 user thật (không phải bác sĩ): "
               f"pname={pname}, pidentity={pidentity}, real_count={real_count} → trigger ingress...")
         ingress_state[room_name] = True
-        asyncio.create_task(create_ingress_and_push(room_name))
+        if not create_ingress_and_push(lkapi, room_name) and not ingress_supervisor.is_running(room_name):
+            # bị từ chối (đủ max_streams) → bỏ đánh dấu + quên state để tick sau xét lại room này
+            ingress_state[room_name] = False
+            last_room_state.pop(room_name, None)
 
 
 
 # reset trạng thái khi room trống / dispatch reset
 def reset_room_ingress_state(room_name: str):
     ingress_state[room_name] = False
+    # tách room khỏi broadcaster + xóa ingress ngay
+    stop_room_ingress(room_name, "room trống")
     print(f"{now()} 🧹 Reset ingress state cho room {room_name}")
 
 
 # --- Egress functions (start/stop) ---
-def start_egress(room_name: str):
-    # protect double-start
-    if room_recording.get(room_name, False):
-        return
+# Profile egress theo tên (audio-only, 360p, track composite, full HD, ...) khai báo trong file JSON, hot-reload.
+# Chọn profile: field "egressProfile" của room trong Redis → "egress_profile" của rule routing → default của file.
+EGRESS_PROFILES_CONFIG = os.getenv("EGRESS_PROFILES_CONFIG", str(Path(__file__).with_name("egress_profiles.json")))
+egress_profiles = EgressProfiles(EGRESS_PROFILES_CONFIG)
+
+def egress_profile_for(room_name: str):
+    data = room_registry.get(room_name) or {}
+    name = data.get("egressProfile")
+    if not name:
+        route = route_for(room_name)
+        name = route.options.get("egress_profile") if route is not None else None
+    return egress_profiles.get(name)
+
+async def build_egress_request(lkapi, room_name: str):
+    egress_profiles.maybe_reload()
+    profile = egress_profile_for(room_name)
+    now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    try:
-        jwt = create_egress_token(room_name)
-    except Exception as e:
-        print(f"{now()} ❌ Failed create egress token for {room_name}: {repr(e)}")
-        return
+    if profile.needs_tracks:
+        resp = await safe_list_participants(lkapi, room_name)
+        audio_track_id, video_track_id = profile.pick_tracks(resp.participants if resp is not None else [])
+        if audio_track_id and video_track_id:
+            filepath = profile.filepath(room_name, now_str)
+            print(f"{now()} 🎛️ Egress {room_name}: profile {profile.name} (audio={audio_track_id}, video={video_track_id})")
+            return profile.build(room_name, filepath, audio_track_id, video_track_id), filepath
+        # chưa có đủ track (camera tắt, chưa publish) → ghi cả room
+        print(f"{now()} ⚠️ Egress {room_name}: profile {profile.name} thiếu track → dùng {egress_profiles.default}")
+        profile = egress_profiles.default_profile()
+
+    filepath = profile.filepath(room_name, now_str)
+    print(f"{now()} 🎛️ Egress {room_name}: profile {profile.name}")
+    return profile.build(room_name, filepath), filepath
+
+# Governor: tối đa EGRESS_MAX_CONCURRENT egress cùng lúc (hoặc EGRESS_NODES × EGRESS_PER_NODE), 0 = không giới hạn.
+# Room vượt giới hạn xếp hàng theo priority: field "priority" của room trong Redis, không có thì
+# "egress_priority" của rule routing (vd. tư vấn trả phí đặt cao hơn), mặc định 0.
+EGRESS_NODES = int(os.getenv("EGRESS_NODES", "0"))
+EGRESS_PER_NODE = int(os.getenv("EGRESS_PER_NODE", "0"))
+EGRESS_MAX_CONCURRENT = int(os.getenv("EGRESS_MAX_CONCURRENT", str(EGRESS_NODES * EGRESS_PER_NODE)))
+# giây giữa 2 lần đối chiếu list_egress(active) toàn server: đếm slot toàn cục + trả slot egress đã kết thúc
+EGRESS_RECONCILE_INTERVAL = float(os.getenv("EGRESS_RECONCILE_INTERVAL", "30"))
+
+def egress_priority(room_name: str) -> int:
+    data = room_registry.get(room_name) or {}
+    if data.get("priority") is not None:
+        try:
+            return int(data["priority"])
+        except (TypeError, ValueError):
+            pass
+    route = route_for(room_name)
+    return int(route.options.get("egress_priority", 0)) if route is not None else 0
+
+# start/stop chạy nền qua async egress client → monitor loop không bị block bởi egress chậm
+egress_manager = EgressManager(
+    egress_map, room_recording, room_filepath, build_egress_request,
+    max_concurrent=EGRESS_MAX_CONCURRENT or None, priority=egress_priority,
+    reconcile_interval=EGRESS_RECONCILE_INTERVAL,
+)
+
+def start_egress(lkapi, room_name: str):
+    # protect double-start (đang record hoặc đang start dở)
+    egress_manager.request_start(lkapi, room_name)
+
+def stop_egress(lkapi, room_name: str):
+    egress_manager.request_stop(lkapi, room_name)
+
+# --- Bản ghi HLS (profile output=segments): segment ghi xong được đưa sang post-processing ngay trong cuộc gọi ---
+# RECORDINGS_LOCAL_DIR: thư mục local mount storage của egress (trống = tắt watcher)
+RECORDINGS_LOCAL_DIR = os.getenv("RECORDINGS_LOCAL_DIR", "")
+SEGMENT_HOOK_URL = os.getenv("SEGMENT_HOOK_URL", "")  # POST metadata từng segment (vd. worker transcript offline)
+segment_watcher = (
+    SegmentWatcher(room_filepath, RECORDINGS_LOCAL_DIR, hook_url=SEGMENT_HOOK_URL or None)
+    if RECORDINGS_LOCAL_DIR else None
+)
+
+# --- Checkpoint state vào Redis để restart/redeploy không dispatch lại, không mất egress_id ---
+DISPATCHER_STATE_KEY = os.getenv("DISPATCHER_STATE_KEY", "dispatcher:state")
+dispatcher_state = DispatcherState(
+    dispatched_rooms, doctor_first_rooms, egress_map, room_recording,
+    room_filepath, ingress_state, last_room_state, dirty=dirty_rooms,
+)
+state_store = StateStore(
+    dispatcher_state, REDIS_HOST, REDIS_PORT, REDIS_PASSWORD, key=DISPATCHER_STATE_KEY,
+)
+
+# --- Sharded mode: nhiều instance, mỗi instance giữ lease Redis cho 1 phần room ---
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))  # 0 = tắt (1 instance xử lý mọi room)
+SHARD_LEASE_TTL = float(os.getenv("SHARD_LEASE_TTL", "10"))
+
+def owns_room(room_name: str) -> bool:
+    return shard_manager is None or shard_manager.owns(room_name)
+
+# Các callback dưới đây chạy trong main loop (ShardManager.apply_transitions giữa các tick / event)
+async def apply_shard_transitions():
+    if shard_manager is not None and shard_manager.has_transitions():
+        await shard_manager.apply_transitions()
+
+def clear_ingress_flags(rooms):
+    """
+    Video chờ của các room này không còn phát ở instance này (nhả shard, shutdown, chủ cũ mất lease):
+    bỏ cờ đã trigger và last state → tick đầu của instance phụ trách thấy room "đổi" và phát lại nếu còn cần.
+    """
+    for room_name in rooms:
+        ingress_state[room_name] = False
+        last_room_state.pop(room_name, None)
 
-    headers = {"Authorization": f"Bearer {jwt}", "Content-Type": "application/json"}
-    now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filepath = f"default/recordings/{room_name}_{now_str}.mp4"
-
-    payload = {
-        "room_name": room_name,
-        "file_outputs": [{"filepath": filepath, "file_type": "MP4"}],
-        "advanced": {
-            "width": 1280,
-            "height": 720,
-            "framerate": 30,
-            "video_codec": "H264_MAIN",
-            "video_bitrate": 1000,       # kbps
-            "key_frame_interval": 4,
-            "audio_codec": "AAC",
-            "audio_bitrate": 96,
-            "audio_frequency": 22050
-        }
-    }
+def rooms_in_shards(shards):
+    return [
+        r for r in dispatcher_state.tracked_rooms() | ingress_supervisor.rooms() | egress_manager.rooms()
+        if shard_of(r, SHARD_COUNT) in shards
+    ]
+
+async def on_shards_acquired(shards):
+    shards = set(shards)
+    loaded = await state_store.load(include=lambda r: shard_of(r, SHARD_COUNT) in shards)
+    # chủ cũ mất lease thì không checkpoint được: cờ video chờ trong Redis có thể vẫn bật dù không còn ai phát
+    clear_ingress_flags([
+        r for r in rooms_in_shards(shards) if ingress_state.get(r) and not ingress_supervisor.is_running(r)
+    ])
+    print(f"{now()} ♻️ Nạp state {loaded} room của {len(shards)} shard mới nhận")
+    egress_manager.reconcile_soon()
+
+async def on_shards_lost(shards):
+    """
+    Lease đã thuộc instance khác: không flush (checkpoint của chủ mới là bản đúng), chỉ dừng việc local
+    và bỏ state. Egress đã start phía server được chủ mới nhận lại qua list_egress ở vòng reconcile.
+    """
+    rooms = rooms_in_shards(set(shards))
+    await egress_manager.settle(rooms, timeout=0)
+    await ingress_supervisor.stop_rooms(
+        [r for r in rooms if ingress_supervisor.is_running(r)], "mất lease shard",
+    )
+    for room_name in rooms:
+        dispatcher_state.forget(room_name)
+        delay_scheduler.cancel_room(room_name)
+    state_store.discard(rooms)
+    print(f"{now()} 🧹 Bỏ state {len(rooms)} room của shard mất lease {sorted(shards)}")
+
+async def on_shards_released(shards):
+    rooms = rooms_in_shards(set(shards))
+    # start / stop egress đang chạy xong trước để checkpoint có đúng egress_id
+    await egress_manager.settle(rooms)
+    # video chờ do instance này phát: dừng hẳn (ffmpeg + ingress), bỏ cờ đã trigger và last state
+    # → instance nhận shard thấy room "đổi" ở tick đầu và tự phát lại nếu room vẫn cần
+    streaming = [r for r in rooms if ingress_supervisor.is_running(r)]
+    await ingress_supervisor.stop_rooms(streaming, "shard chuyển cho instance khác")
+    clear_ingress_flags(streaming)
+    # checkpoint lần cuối rồi bỏ state local; instance nhận shard sẽ nạp lại từ Redis
+    await state_store.flush()
+    for room_name in rooms:
+        dispatcher_state.forget(room_name)
+        delay_scheduler.cancel_room(room_name)
+    state_store.discard(rooms)
+
+shard_manager = (
+    ShardManager(
+        REDIS_HOST, REDIS_PORT, REDIS_PASSWORD, shard_count=SHARD_COUNT, lease_ttl=SHARD_LEASE_TTL,
+        instance_id=os.getenv("INSTANCE_ID") or None,
+        on_acquire=on_shards_acquired, on_release=on_shards_released, on_lost=on_shards_lost,
+    )
+    if SHARD_COUNT > 0 else None
+)
+
+async def restore_state(lkapi):
+    """
+    Nạp state đã checkpoint rồi đối chiếu với server:
+      - room không còn trên server → bỏ state
+      - egress_id không còn active → coi như đã dừng
+      - egress đang active của room có route egress nhưng không có trong state (crash giữa start và checkpoint) → nhận lại
+      - cờ video chờ còn bật (process chết trước khi kịp checkpoint lúc dừng) → bỏ, video chờ không sống qua restart
+    """
+    loaded = await state_store.load(include=owns_room)
+    clear_ingress_flags([r for r in list(ingress_state) if ingress_state.get(r) and not ingress_supervisor.is_running(r)])
+
+    rooms_resp = await safe_list_rooms(lkapi)
+    if rooms_resp is not None:
+        live_rooms = {r.name for r in rooms_resp.rooms}
+        for room_name in dispatcher_state.room_names() - live_rooms:
+            dispatcher_state.forget(room_name)
+
+    _, adopted = await reconcile_egress(lkapi) or (0, 0)
+
+    # room đủ người nhưng chưa record (start đang chạy dở lúc crash) → bỏ last state để tick đầu quyết định lại
+    for room_name, last in list(last_room_state.items()):
+        if not room_recording.get(room_name) and (last.get("count_egress") or 0) >= MIN_PARTICIPANTS_EGRESS:
+            last_room_state.pop(room_name, None)
 
-    url = f"{LIVEKIT_URL}/twirp/livekit.Egress/StartRoomCompositeEgress"
+    print(f"{now()} ♻️ Restored state: {loaded} room(s) from checkpoint, "
+          f"{len(dispatched_rooms)} dispatched, {len(egress_map)} recording, {adopted} egress adopted")
+    await state_store.flush()
 
+async def reconcile_egress(lkapi):
+    """
+    Đối chiếu egress với list_egress(active=True) toàn server (lúc restore + mỗi EGRESS_RECONCILE_INTERVAL giây):
+    egress đã kết thúc → trả slot; egress active chưa biết của room mình phụ trách → nhận lại;
+    egress của instance khác → tính vào giới hạn toàn cục. None nếu list_egress lỗi.
+    """
+    known = dict(egress_map)
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=15)
-        resp.raise_for_status()
-        egress_id = resp.json().get("egress_id")
-        egress_map[room_name] = egress_id
-        room_recording[room_name] = True
-        room_filepath[room_name] = filepath
-        # log only on change
-        print(f"{now()} 🚀 Egress started for {room_name} (file: {filepath})")
+        with track_api("list_egress"):
+            egress_resp = await lkapi.egress.list_egress(api.ListEgressRequest(active=True))
     except Exception as e:
-        print(f"{now()} ❌ Failed to start egress for {room_name}: {repr(e)}")
+        print(f"{now()} ⚠️ list_egress failed: {repr(e)}")
+        return None
 
-def stop_egress(room_name: str):
-    egress_id = egress_map.get(room_name)
-    if not egress_id:
-        room_recording[room_name] = False
+    def adopt(room_name):
+        route = route_for(room_name) if owns_room(room_name) else None
+        return route is not None and route.egress
+
+    return egress_manager.reconcile({info.egress_id: info for info in egress_resp.items}, known, adopt)
+
+# --- Logic to disconnect specific agents (original function) ---
+# --- Việc trễ (remove agent sau N giây), dedupe theo (room, identity, action) ---
+ASSISTANT_REMOVE_DELAY = 5
+RECORD_REMOVE_DELAY = 30
+delay_scheduler = DelayScheduler()
+
+def schedule_remove(lkapi, room_name: str, identity: str, delay: float, reason: str) -> bool:
+    async def _remove():
+        await safe_remove_participant(lkapi, room_name, identity, identity)
+        print(f"{now()} ⏱ Removed {identity} {reason} in {room_name}")
+
+    return delay_scheduler.schedule((room_name, identity, "remove"), delay, _remove)
+
+async def cleanup_agents_in_room(lkapi, view: RoomView):
+    """Áp dụng logic remove assistant/ingress/record agent cho 1 room."""
+    room_name = view.name
+    num = view.num_participants
+    participants = view.participants
+
+    # --- Logic: nếu có cả ingress_agent và assistant_agent, remove assistant_agent sau 5s ---
+    if view.has_identity("ingress_agent") and view.has_identity("assistant_agent"):
+        schedule_remove(lkapi, room_name, "assistant_agent", ASSISTANT_REMOVE_DELAY, "after delay")
+    else:
+        delay_scheduler.cancel((room_name, "assistant_agent", "remove"))
+
+    # --- record_agent ở lại với 1 user thật → remove sau 30s (hủy nếu có người vào lại) ---
+    if view.real_count == 1 and view.has_identity("record_agent"):
+        schedule_remove(lkapi, room_name, "record_agent", RECORD_REMOVE_DELAY, "due to lone real participant")
+    else:
+        delay_scheduler.cancel((room_name, "record_agent", "remove"))
+
+
+    # --- Trường hợp tổng > 3 ---
+    if num >= 3:
+        kicked_count = 0
+        for p in participants:
+            pid = (p.identity or "").strip()
+            pname = (p.name or "").strip()
+
+            if pid == "assistant_agent":
+                ok = await safe_remove_participant(lkapi, room_name, pid, pname)
+                if ok:
+                    kicked_count += 1
+            elif pid == "ingress_agent":
+                ok = await safe_remove_participant(lkapi, room_name, pid, pname)
+                if ok:
+                    kicked_count += 1
+                    stop_room_ingress(room_name, "đủ người, đã kick ingress_agent")
+                    await dispatch_agent(lkapi, room_name, "record_agent")
+
+        if kicked_count > 0:
+            print(f"{now()} ℹ️ Removed {kicked_count} participant(s) in {room_name}.")
+
+    # --- Trường hợp chỉ còn 1 người là ingress_agent ---
+    elif num == 1:
+        if not participants:
+            return
+        p = participants[0]
+        pid = (p.identity or "").strip()
+        pname = (p.name or "").strip()
+        if pid == "ingress_agent":
+            await safe_remove_participant(lkapi, room_name, pid, pname)
+            stop_room_ingress(room_name, "chỉ còn ingress_agent")
+            print(f"{now()} ℹ️ Removed lone ingress_agent in {room_name}")
+
+async def disconnect_specific_agents_in_tests(lkapi, snapshot: RoomSnapshot):
+    for view in snapshot.views():
+        route = route_for(view.name)
+        if route is None or not route.monitor or not view.ok:
+            continue
+
+        await cleanup_agents_in_room(lkapi, view)
+
+# --- Dispatch decision cho 1 room ---
+def route_for(room_name: str):
+    """Route của room theo config; rule "redis" khớp khi room có trong hash room:online."""
+    return router.resolve(room_name, room_name in room_registry.rooms)
+
+def room_needs_dispatch_check(room_name: str, num_participants: int, route) -> bool:
+    """Room có 1 participant, chưa dispatch và có agent tương ứng → cần xem participant là ai."""
+    return (
+        num_participants == 1
+        and room_name not in dispatched_rooms
+        and route is not None
+        and route.agent is not None
+    )
+
+async def dispatch_if_needed(lkapi, view: RoomView, route):
+    """Dispatch agent vào room có participant (giữ nguyên behavior gốc)."""
+    room_name = view.name
+    num_participants = view.num_participants
+    if num_participants <= 0 or room_name in dispatched_rooms:
         return
 
-    try:
-        jwt = create_egress_token(room_name)
-    except Exception as e:
-        print(f"{now()} ❌ Failed create egress token for stop {room_name}: {repr(e)}")
-        # still clear local state to avoid stuck
-        room_recording[room_name] = False
-        egress_map.pop(room_name, None)
-        room_filepath.pop(room_name, None)
+    if route is None or not route.agent:
         return
+    agent_name = route.agent
+
+    # Nếu chỉ có 1 participant, kiểm tra kỹ xem có phải bác sĩ hay ingress_agent
+    if num_participants == 1:
+        participants = view.participants
+        if not participants:
+            return
+
+        only_p = participants[0]
+        kind = classifier.classify(only_p)
+        # Bỏ qua nếu là ingress_agent
+        if kind == ParticipantKind.INGRESS:
+            return
+        #Tạm thời để vậy để test offline
+        # if "bsvinh" in pid.lower() or "bsvinh" in pname.lower():
+        #     if room_name not in dispatched_rooms:
+        #         await dispatch_agent(lkapi, room_name, "record")
+        #     return
+        # ✅ Nếu người đầu tiên là bác sĩ (có 'bs' trong tên/identity, không phân biệt hoa thường)
+        if route.doctor_first == "skip" and kind == ParticipantKind.DOCTOR:
+            if room_name not in doctor_first_rooms:
+                doctor_first_rooms.add(room_name)
+                print(f"{now()} 👨‍⚕️ Room {room_name}: bác sĩ vào trước → không dispatch agent (chỉ log 1 lần).")
+            return
+
+    await dispatch_agent(lkapi, room_name, agent_name)
+
+# --- Egress monitor cho 1 room ---
+async def monitor_egress_for_room(lkapi, view: RoomView):
+    room_name = view.name
+    participants = view.participants
+    count_all = count_all_participants(participants)
+    count_for_egress = view.real_count
+    identities = set(view.identities())
+
+    prev = last_room_state.get(room_name, {})
+    prev_count_all = prev.get("count_all", None)
+    prev_count_egress = prev.get("count_egress", None)
+    prev_recording = prev.get("recording", False)
+
+    # init per-room recording state if missing
+    if room_name not in room_recording:
+        room_recording[room_name] = False
 
-    headers = {"Authorization": f"Bearer {jwt}", "Content-Type": "application/json"}
-    url = f"{LIVEKIT_URL}/twirp/livekit.Egress/StopEgress"
+    recording = room_recording[room_name]
 
-    try:
-        resp = requests.post(url, headers=headers, json={"egress_id": egress_id}, timeout=10)
-        if resp.ok:
-            print(f"{now()} 🛑 Egress stopped for {room_name}. Saved: {room_filepath.get(room_name)}")
-        else:
-            print(f"{now()} ❌ Stop egress failed for {room_name}: {resp.status_code} {resp.text}")
-    except Exception as e:
-        print(f"{now()} ❌ Stop egress error for {room_name}: {repr(e)}")
+    # Only log when something changed (counts or identities or recording state)
+    changed = False
+    if prev_count_all != count_all or prev_count_egress != count_for_egress or prev_recording != recording or prev.get("identities") != identities:
+        changed = True
 
-    room_recording[room_name] = False
-    egress_map.pop(room_name, None)
-    room_filepath.pop(room_name, None)
+    # store new state
+    last_room_state[room_name] = {
+        "count_all": count_all,
+        "count_egress": count_for_egress,
+        "identities": identities,
+        "recording": recording
+    }
 
-# --- Logic to disconnect specific agents (original function) ---
-async def disconnect_specific_agents_in_tests(lkapi, rooms_to_monitor):
-    resp = await safe_list_rooms(lkapi)
-    if resp is None:
+    if not changed:
+        # nothing to do/log for this room this loop
         return
 
-    for room_info in resp.rooms:
-        room_name = getattr(room_info, "name", "")
-        if room_name not in rooms_to_monitor:
-            continue
+    # Minimal logging on changes
+    print(f"{now()} 🔎 Room {room_name} changed: total={count_all}, real_for_egress={count_for_egress}, recording={recording}, ids={sorted(list(identities))}")
 
-        num = getattr(room_info, "num_participants", 0)
+    if len(participants) == 0:
+        reset_room_ingress_state(room_name)
+    # --- Gọi ingress khi có assistant_agent ---
+    await trigger_ingress_if_needed(lkapi, room_name, participants)
 
-        participants_resp = await safe_list_participants(lkapi, room_name)
-        if participants_resp is None:
+    # Start egress: only when there are >= MIN_PARTICIPANTS_EGRESS **real** users (excl agents/EG_*)
+    if count_for_egress >= MIN_PARTICIPANTS_EGRESS and not recording:
+        start_egress(lkapi, room_name)
+
+    # Stop egress: when real users count drops below threshold and it was recording
+    elif count_for_egress < MIN_PARTICIPANTS_EGRESS and recording:
+        stop_egress(lkapi, room_name)
+
+# --- Một vòng quét đầy đủ (poll mode, hoặc reconciliation sweep của webhook mode) ---
+# --- Nhịp poll thích ứng + làn hot/cold theo room ---
+# list_rooms giữ nhịp CHECK_INTERVAL (chỉ rút ngắn sau thay đổi); phần giãn nhịp chỉ áp cho list_participants theo làn
+poll_interval = AdaptiveInterval(POLL_MIN_INTERVAL, CHECK_INTERVAL, start=CHECK_INTERVAL)
+
+def room_is_hot(room_name: str) -> bool:
+    # egress đang start/stop, hoặc bệnh nhân đang chờ (video chờ đang phát) → list_participants mỗi tick
+    return egress_manager.in_flight(room_name) or ingress_supervisor.is_running(room_name)
+
+room_lanes = RoomLanes(COLD_ROOM_INTERVAL, HOT_ROOM_TICKS, is_hot=room_is_hot)
+
+def tick_changed() -> bool:
+    return room_lanes.changed or egress_manager.busy()
+
+async def run_tick(lkapi):
+    router.maybe_reload()
+    room_lanes.begin_tick()
+
+    def needs_participants(room_info):
+        room_name = getattr(room_info, "name", "")
+        route = route_for(room_name)
+        if route is None:
+            return False
+        return (
+            route.monitor
+            or route.egress
+            or room_needs_dispatch_check(room_name, getattr(room_info, "num_participants", 0), route)
+        )
+
+    # --- Egress monitor logic ---
+    # Quyết định start/stop egress ngay khi room đó có kết quả, không chờ các room chậm
+    async def on_room(view):
+        route = route_for(view.name)
+        if route is not None and route.egress and view.ok:
+            started = time.monotonic()
+            await monitor_egress_for_room(lkapi, view)
+            observe_room(time.monotonic() - started)
+
+    # 1 lần list_rooms + tối đa 1 lần list_participants mỗi room, dùng chung cho cả 3 bước
+    snapshot = await RoomSnapshot.build(
+        lkapi, needs_participants, safe_list_rooms, safe_list_participants,
+        concurrency=SNAPSHOT_CONCURRENCY, timeout=FANOUT_TIMEOUT, jitter=FANOUT_JITTER, on_room=on_room,
+        include=owns_room if shard_manager is not None else None,
+        reuse=room_lanes.reuse,
+    )
+    if snapshot is None:
+        return
+    for view in snapshot.views():
+        room_lanes.observe(view.name, view.num_participants, view.participants)
+    room_lanes.retain(snapshot.names())
+
+    # Egress candidate không có trong list_rooms → room đã đóng, coi như trống
+    known_rooms = router.table.static_rooms() | room_registry.room_names() | set(last_room_state)
+    for room_name in known_rooms - snapshot.names():
+        if not owns_room(room_name):
             continue
+        route = route_for(room_name)
+        if route is not None and route.egress:
+            await monitor_egress_for_room(lkapi, snapshot.get(room_name))
+    prune_finished_rooms(snapshot.names())
+
+    # iterate rooms for dispatch decisions
+    for view in snapshot.views():
+        # --- Dispatch logic: dispatch agents to rooms with participants (preserve original behavior) ---
+        await dispatch_if_needed(lkapi, view, route_for(view.name))
+
+    # Clean up dispatched_rooms (if room empty or gone)
+    for room_name in list(dispatched_rooms):
+        if snapshot.get(room_name).num_participants == 0:
+            dispatched_rooms.remove(room_name)
+            print(f"{now()} 🧹 Reset dispatch state for empty room {room_name}")
+
+    # --- disconnect-specific-agents logic (original) ---
+    await disconnect_specific_agents_in_tests(lkapi, snapshot)
+
+    # slot egress có thể đã trống do egress kết thúc phía server / room đang chờ slot đã đóng
+    egress_manager.release_gone(snapshot.names())
+    if egress_manager.reconcile_due():
+        await reconcile_egress(lkapi)
+    egress_manager.admit()
+    update_gauges(len(snapshot.names()))
+
+def room_finalized(room_name: str) -> bool:
+    """Room không còn egress (đang ghi / đang start-stop / đang chờ slot) và không còn phát video chờ."""
+    return not (
+        room_recording.get(room_name) or egress_map.get(room_name)
+        or egress_manager.in_flight(room_name) or egress_manager.is_queued(room_name)
+        or ingress_supervisor.is_running(room_name)
+    )
 
-        # --- Logic: nếu có cả ingress_agent và assistant_agent, remove assistant_agent sau 5s ---
-        ingress_exists = any((p.identity or "").strip() == "ingress_agent" for p in participants_resp.participants)
-        assistant_exists = any((p.identity or "").strip() == "assistant_agent" for p in participants_resp.participants)
-
-        if ingress_exists and assistant_exists:
-            # copy room_name và danh sách participant identities
-            delayed_room_name = room_name
-            assistant_identities = [
-                (p.identity or "").strip() for p in participants_resp.participants if (p.identity or "").strip() == "assistant_agent"
-            ]
-
-            async def delayed_remove(room_name_to_remove, identities_to_remove):
-                await asyncio.sleep(5)
-                for pid in identities_to_remove:
-                    await safe_remove_participant(lkapi, room_name_to_remove, pid, pid)
-                    print(f"{now()} ⏱ Removed assistant_agent after delay in {room_name_to_remove}")
-
-            asyncio.create_task(delayed_remove(delayed_room_name, assistant_identities))
-
-        # global set track task đang chạy
-        record_agent_pending_remove = set()
-
-        # ở trong monitor/disconnect logic
-        real_count = count_real_for_egress(participants_resp.participants)
-        identities = [(p.identity or "").strip() for p in participants_resp.participants]
-
-        if real_count == 1 and "record_agent" in identities and room_name not in record_agent_pending_remove:
-            record_agent_pending_remove.add(room_name)
-
-            # chỉ truyền room_name và identity, không truyền participants_resp
-            async def delayed_remove_record(room_name_to_remove, identity_to_remove):
-                await asyncio.sleep(30)
-                await safe_remove_participant(lkapi, room_name_to_remove, identity_to_remove, identity_to_remove)
-                print(f"{now()} ⏱ Removed record_agent due to lone real participant in {room_name_to_remove}")
-                record_agent_pending_remove.discard(room_name_to_remove)
-
-            asyncio.create_task(delayed_remove_record(room_name, "record_agent"))
-
-
-        # --- Trường hợp tổng > 3 ---
-        if num >= 3:
-            kicked_count = 0
-            for p in participants_resp.participants:
-                pid = (p.identity or "").strip()
-                pname = (p.name or "").strip()
-
-                if pid == "assistant_agent":
-                    ok = await safe_remove_participant(lkapi, room_name, pid, pname)
-                    if ok:
-                        kicked_count += 1
-                elif pid == "ingress_agent":
-                    ok = await safe_remove_participant(lkapi, room_name, pid, pname)
-                    if ok:
-                        kicked_count += 1
-                        await dispatch_agent(lkapi, room_name, "record_agent")
-
-            if kicked_count > 0:
-                print(f"{now()} ℹ️ Removed {kicked_count} participant(s) in {room_name}.")
-
-        # --- Trường hợp chỉ còn 1 người là ingress_agent ---
-        elif num == 1:
-            if not participants_resp.participants:
-                continue
-            p = participants_resp.participants[0]
-            pid = (p.identity or "").strip()
-            pname = (p.name or "").strip()
-            if pid == "ingress_agent":
-                await safe_remove_participant(lkapi, room_name, pid, pname)
-                print(f"{now()} ℹ️ Removed lone ingress_agent in {room_name}")
+def prune_finished_rooms(live_rooms):
+    """
+    Room đã biến khỏi list_rooms và egress đã chốt → bỏ toàn bộ state của room
+    (flush kế tiếp HDEL field checkpoint), để vòng quét "room vanished" và checkpoint không phình mãi.
+    """
+    for room_name in dispatcher_state.tracked_rooms() - set(live_rooms):
+        if owns_room(room_name) and room_finalized(room_name):
+            dispatcher_state.forget(room_name)
+            delay_scheduler.cancel_room(room_name)
+
+def update_gauges(room_count: int):
+    set_room_gauges(
+        room_count, len(dispatched_rooms), sum(1 for v in room_recording.values() if v),
+        len(ingress_supervisor.rooms()),
+    )
+
+def serve_metrics():
+    if not METRICS_PORT:
+        return
+    try:
+        if start_metrics_server(METRICS_PORT, METRICS_HOST):
+            print(f"{now()} 📈 Metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"{now()} ⚠️ Không mở được metrics port {METRICS_PORT}: {repr(e)}")
+
+async def timed_tick(lkapi):
+    await apply_shard_transitions()
+    started = time.monotonic()
+    await run_tick(lkapi)
+    await state_store.flush()
+    elapsed = time.monotonic() - started
+    observe_tick(elapsed)
+    if elapsed > SLOW_TICK_SECONDS:
+        print(f"{now()} 🐢 Tick chậm: {elapsed:.2f}s")
+
+async def stop_ingress_for_shutdown():
+    """Dừng mọi video chờ; checkpoint không được giữ cờ đang phát, để sau restart patient đang chờ có video lại."""
+    clear_ingress_flags(ingress_supervisor.rooms())
+    await ingress_supervisor.stop_all()
 
 # --- Main loop (merge dispatch + egress monitor) ---
 async def monitor_and_dispatch():
@@ -513,154 +776,193 @@ async def monitor_and_dispatch():
         api_secret=LIVEKIT_API_SECRET,
     )
 
+    await room_registry.start()
+    if shard_manager is not None:
+        await shard_manager.start()
+    serve_metrics()
+    await restore_state(lkapi)
+    waiting_video.start()
+    start_media_prewarm()
+    if segment_watcher is not None:
+        segment_watcher.start()
+
     try:
         while True:
-            # --- fetch dynamic redis rooms ---
-            try:
-                redis_rooms = await fetch_redis_room_names()
-                redis_rooms.add("clinic")  # thêm room cố định
-            except Exception:
-                redis_rooms = set()
-
-            # compose rooms to monitor for disconnect logic
-            rooms_to_monitor = set(STATIC_ROOMS_TO_MONITOR) | set(redis_rooms)
-
-            # list all rooms
-            resp = await safe_list_rooms(lkapi)
-            if resp is None:
-                await asyncio.sleep(CHECK_INTERVAL)
-                continue
-
-            # For egress: consider EGRESS_ROOMS U dynamic redis rooms
-            egress_candidate_rooms = set(EGRESS_ROOMS) | set(redis_rooms)
-
-            # iterate rooms for dispatch decisions
-            for room in resp.rooms:
-                room_name = getattr(room, "name", "")
-                num_participants = getattr(room, "num_participants", 0)
-
-                # --- Dispatch logic: dispatch agents to rooms with participants (preserve original behavior) ---
-                if num_participants > 0 and room_name not in dispatched_rooms:
-                    # Nếu chỉ có 1 participant, kiểm tra kỹ xem có phải bác sĩ hay ingress_agent
-                    if num_participants == 1:
-                        participants_resp = await safe_list_participants(lkapi, room_name)
-                        if not participants_resp or not participants_resp.participants:
-                            continue
-
-                        only_p = participants_resp.participants[0]
-                        pid = (only_p.identity or "").strip()
-                        pname = (only_p.name or "").strip()
-                        pid_norm = pid.lower()
-                        pname_norm = pname.lower()
-                        # Bỏ qua nếu là ingress_agent
-                        if pid == "ingress_agent":
-                            continue
-                        #Tạm thời để vậy để test offline
-                        # if "bsvinh" in pid.lower() or "bsvinh" in pname.lower():
-                        #     if room_name not in dispatched_rooms:
-                        #         await dispatch_agent(lkapi, room_name, "record")
-                        #     continue
-                        # ✅ Nếu người đầu tiên là bác sĩ (có 'bs' trong tên/identity, không phân biệt hoa thường)
-                        if "bs" in pid.lower() or "bs" in pname.lower():
-                            if room_name not in doctor_first_rooms:
-                                doctor_first_rooms.add(room_name)
-                                print(f"{now()} 👨‍⚕️ Room {room_name}: bác sĩ vào trước → không dispatch agent (chỉ log 1 lần).")
-                            continue
-
-
-
-
-                    agent_name = None
-                    if room_name in MEDICAL_ROOMS:
-                        agent_name = "medical_agent"
-                    elif room_name in ASSISTANT_ROOMS:
-                        agent_name = "assistant_agent"
-                    elif room_name in RECORD_ROOMS:
-                        agent_name = "record_agent"
-                    elif room_name in TEST_ROOMS:
-                        agent_name = "test_agent"
-                    elif room_name in redis_rooms:
-                        agent_name = "assistant_agent"
-                    elif room_name in OFFLINE_ROOMS:
-                        agent_name ="record"
-
-                    if agent_name:
-                        await dispatch_agent(lkapi, room_name, agent_name)
-
-            # Clean up dispatched_rooms (if room empty or gone)
-            for room_name in list(dispatched_rooms):
-                room_obj = next((r for r in resp.rooms if getattr(r, "name", None) == room_name), None)
-                if not room_obj or getattr(room_obj, "num_participants", 0) == 0:
-                    dispatched_rooms.remove(room_name)
-                    print(f"{now()} 🧹 Reset dispatch state for empty room {room_name}")
-
-            # --- disconnect-specific-agents logic (original) ---
-            await disconnect_specific_agents_in_tests(lkapi, rooms_to_monitor)
-
-            # --- Egress monitor logic ---
-            # For each candidate egress room (static or dynamic), check participants and decide start/stop
-            for room_name in egress_candidate_rooms:
-                participants_resp = await safe_list_participants(lkapi, room_name)
-                if participants_resp is None:
-                    # if API failure, skip
-                    continue
+            await timed_tick(lkapi)
 
-                participants = participants_resp.participants
+            # vừa có thay đổi → tick lại sớm; yên tĩnh → về lại CHECK_INTERVAL
+            await asyncio.sleep(poll_interval.next(tick_changed()))
 
-                count_all = count_all_participants(participants)
-                count_for_egress = count_real_for_egress(participants)
-                identities = set((p.identity or "").strip() for p in participants)
+    finally:
+        await delay_scheduler.stop()
+        await stop_ingress_for_shutdown()
+        await waiting_video.stop()
+        await media_cache.stop()
+        await egress_manager.drain()
+        if segment_watcher is not None:
+            await segment_watcher.stop()
+        await state_store.flush()
+        if shard_manager is not None:
+            await shard_manager.stop()
+        await state_store.close()
+        await room_registry.stop()
+        await lkapi.aclose()
 
-                prev = last_room_state.get(room_name, {})
-                prev_count_all = prev.get("count_all", None)
-                prev_count_egress = prev.get("count_egress", None)
-                prev_recording = prev.get("recording", False)
+# --- Webhook mode: xử lý incremental theo từng room có event ---
+def on_egress_ended(room_name: str, egress_id: str):
+    """Egress kết thúc phía server (lỗi, hết giờ, ...) → clear state để lần sau start lại được."""
+    if egress_map.get(room_name) != egress_id:
+        return
+    print(f"{now()} 📼 Egress {egress_id} của {room_name} đã kết thúc. Saved: {room_filepath.get(room_name)}")
+    room_recording[room_name] = False
+    egress_map.pop(room_name, None)
+    room_filepath.pop(room_name, None)
+    egress_manager.admit()
 
-                # init per-room recording state if missing
-                if room_name not in room_recording:
-                    room_recording[room_name] = False
+async def process_room(lkapi, room_name, participants=None):
+    """Chạy đủ 3 bước dispatch / disconnect / egress cho 1 room, chỉ gọi list_participants 1 lần."""
+    if not owns_room(room_name):
+        # room thuộc shard của instance khác (event đã được chuyển cho instance đó)
+        return
+    router.maybe_reload()
+    if room_name not in router.table.static_rooms():
+        # room động (call_...) có thể vừa được ghi vào Redis ngay trước khi user join:
+        # registry chưa sync kịp thì HGET đúng room đó 1 lần
+        await room_registry.get_room_data(room_name)
+    route = route_for(room_name)
+    if route is None:
+        return
 
-                recording = room_recording[room_name]
+    if participants is None:
+        participants_resp = await safe_list_participants(lkapi, room_name)
+        if participants_resp is None:
+            return
+        participants = participants_resp.participants
+    view = RoomView(room_name, len(participants), participants)
+
+    await dispatch_if_needed(lkapi, view, route)
+    if view.num_participants == 0 and room_name in dispatched_rooms:
+        dispatched_rooms.remove(room_name)
+        print(f"{now()} 🧹 Reset dispatch state for empty room {room_name}")
+
+    if route.monitor:
+        await cleanup_agents_in_room(lkapi, view)
+
+    if route.egress:
+        await monitor_egress_for_room(lkapi, view)
+
+async def handle_room_events(lkapi, room_name, events):
+    names = [e.event for e in events]
+    for event in events:
+        if event.event == "egress_ended":
+            on_egress_ended(room_name, event.egress_info.egress_id)
+
+    if "room_finished" in names:
+        # room đã đóng: không còn participant để list, xử lý như room trống
+        await process_room(lkapi, room_name, participants=[])
+        doctor_first_rooms.discard(room_name)
+        last_room_state.pop(room_name, None)
+        delay_scheduler.cancel_room(room_name)
+    elif any(n in ("room_started", "participant_joined", "participant_left") for n in names):
+        await process_room(lkapi, room_name)
+
+async def monitor_with_webhooks():
+    """
+    Webhook mode: quyết định dispatch/egress/ingress ngay khi có event,
+    kèm 1 vòng quét đầy đủ mỗi RECONCILE_INTERVAL giây làm lưới an toàn (event bị mất, restart, ...).
+    Event và sweep chạy tuần tự trong cùng 1 task nên không tranh chấp state.
+    Sharded mode: LiveKit gửi mỗi webhook tới 1 instance bất kỳ sau load balancer; event của room thuộc
+    shard khác được chuyển cho chủ shard qua Redis pub/sub (ShardEventBus), không phải chờ vòng reconcile.
+    """
+    lkapi = api.LiveKitAPI(
+        url=LIVEKIT_URL,
+        api_key=LIVEKIT_API_KEY,
+        api_secret=LIVEKIT_API_SECRET,
+    )
+    event_bus = None
 
-                # Only log when something changed (counts or identities or recording state)
-                changed = False
-                if prev_count_all != count_all or prev_count_egress != count_for_egress or prev_recording != recording or prev.get("identities") != identities:
-                    changed = True
+    async def forward_event(room_name, event) -> bool:
+        if owns_room(room_name):
+            return False
+        await event_bus.forward(room_name, event.SerializeToString())
+        return True
 
-                # store new state
-                last_room_state[room_name] = {
-                    "count_all": count_all,
-                    "count_egress": count_for_egress,
-                    "identities": identities,
-                    "recording": recording
-                }
+    async def on_forwarded(payload: bytes):
+        event = api.WebhookEvent.FromString(payload)
+        ingest.push(event_room_name(event), event)
 
-                if not changed:
-                    # nothing to do/log for this room this loop
+    ingest = WebhookIngest(
+        LIVEKIT_API_KEY, LIVEKIT_API_SECRET, forward=forward_event if shard_manager is not None else None,
+    )
+    await room_registry.start()
+    if shard_manager is not None:
+        await shard_manager.start()
+        event_bus = ShardEventBus(shard_manager, on_forwarded, REDIS_HOST, REDIS_PORT, REDIS_PASSWORD)
+        await event_bus.start()
+    serve_metrics()
+    await restore_state(lkapi)
+    waiting_video.start()
+    start_media_prewarm()
+    if segment_watcher is not None:
+        segment_watcher.start()
+    await ingest.start(WEBHOOK_HOST, WEBHOOK_PORT)
+
+    get_task = None
+    shard_task = None
+    try:
+        await timed_tick(lkapi)
+        next_reconcile = time.monotonic() + RECONCILE_INTERVAL
+        while True:
+            if get_task is None:
+                get_task = asyncio.create_task(ingest.next_room())
+            if shard_task is None and shard_manager is not None:
+                shard_task = asyncio.create_task(shard_manager.wait_transitions())
+            timeout = max(0.0, next_reconcile - time.monotonic())
+            waiting = {get_task} if shard_task is None else {get_task, shard_task}
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if shard_task in done:
+                # nhận / nhả / mất shard: áp ngay giữa 2 event, không chờ vòng reconcile
+                shard_task = None
+                await apply_shard_transitions()
+            if get_task in done:
+                room_name, events = get_task.result()
+                get_task = None
+                await apply_shard_transitions()
+                if not owns_room(room_name):
+                    # shard vừa đổi chủ trong lúc event nằm trong queue → chuyển tiếp cho chủ mới
+                    for event in events:
+                        await forward_event(room_name, event)
                     continue
-
-                # Minimal logging on changes
-                print(f"{now()} 🔎 Room {room_name} changed: total={count_all}, real_for_egress={count_for_egress}, recording={recording}, ids={sorted(list(identities))}")
-
-                if len(participants) == 0:
-                    reset_room_ingress_state(room_name)
-                # --- Gọi ingress khi có assistant_agent ---
-                await trigger_ingress_if_needed(lkapi, room_name, participants)
-
-                # Start egress: only when there are >= MIN_PARTICIPANTS_EGRESS **real** users (excl agents/EG_*)
-                if count_for_egress >= MIN_PARTICIPANTS_EGRESS and not recording:
-                    start_egress(room_name)
-
-                # Stop egress: when real users count drops below threshold and it was recording
-                elif count_for_egress < MIN_PARTICIPANTS_EGRESS and recording:
-                    stop_egress(room_name)
-
-            # sleep small interval
-            await asyncio.sleep(CHECK_INTERVAL)
-
+                await handle_room_events(lkapi, room_name, events)
+                await state_store.flush()
+            elif not done:
+                await timed_tick(lkapi)
+                next_reconcile = time.monotonic() + RECONCILE_INTERVAL
     finally:
+        for task in (get_task, shard_task):
+            if task is not None:
+                task.cancel()
+        await ingest.stop()
+        if event_bus is not None:
+            await event_bus.stop()
+        await delay_scheduler.stop()
+        await stop_ingress_for_shutdown()
+        await waiting_video.stop()
+        await media_cache.stop()
+        await egress_manager.drain()
+        if segment_watcher is not None:
+            await segment_watcher.stop()
+        await state_store.flush()
+        if shard_manager is not None:
+            await shard_manager.stop()
+        await state_store.close()
+        await room_registry.stop()
         await lkapi.aclose()
 
 # --- Entrypoint ---
 if __name__ == "__main__":
-    asyncio.run(monitor_and_dispatch())
+    if DISPATCH_MODE == "webhook":
+        asyncio.run(monitor_with_webhooks())
+    else:
+        asyncio.run(monitor_and_dispatch())
@@ -0,0 +1,359 @@
+import asyncio
+import heapq
+import itertools
+import time
+import aiohttp
+from livekit import api
+
+from metrics import set_egress_queue_depth, observe_egress_wait, track_api
+
+# Twirp code coi là lỗi tạm thời → retry (thao tác idempotent như stop)
+RETRYABLE_CODES = {"unavailable", "deadline_exceeded", "resource_exhausted", "internal", "unknown"}
+# start không idempotent: chỉ retry khi chắc chắn server chưa tạo egress
+SAFE_RETRY_CODES = {"unavailable"}
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+def start_call(lkapi, req):
+    """Coroutine start egress đúng loại request (room composite / track composite)."""
+    if isinstance(req, api.TrackCompositeEgressRequest):
+        return lkapi.egress.start_track_composite_egress(req)
+    return lkapi.egress.start_room_composite_egress(req)
+
+
+def is_retryable(e: Exception, idempotent: bool = True) -> bool:
+    """
+    Lỗi có thể gửi lại request không.
+    idempotent=False (start egress): timeout / mất kết nối giữa chừng / lỗi lạ có thể là server đã start
+    → không retry mù, gửi lại sẽ tạo egress thứ 2 (egress đầu vẫn ghi và vẫn tính tiền).
+    """
+    if isinstance(e, api.TwirpError):
+        if idempotent:
+            return e.status >= 500 or e.code in RETRYABLE_CODES
+        return e.code in SAFE_RETRY_CODES
+    if isinstance(e, aiohttp.ClientConnectorError):
+        # chưa kết nối được → request chưa tới server
+        return True
+    # timeout / lỗi mạng giữa chừng
+    return idempotent
+
+
+def egress_filepath(info):
+    """File / playlist của 1 EgressInfo (file output, segment output hoặc file result)."""
+    for out in (*info.room_composite.file_outputs, *info.track_composite.file_outputs):
+        if out.filepath:
+            return out.filepath
+    for out in (*info.room_composite.segment_outputs, *info.track_composite.segment_outputs):
+        if out.playlist_name:
+            return out.playlist_name
+    for res in info.file_results:
+        if res.filename:
+            return res.filename
+    return None
+
+
+class EgressManager:
+    """
+    Start/stop egress qua async LiveKitAPI.egress (dùng chung aiohttp session của lkapi),
+    chạy trong background task để monitor loop không bị block.
+      - mỗi room chỉ có tối đa 1 thao tác đang chạy (chống double-start)
+      - stop gửi tới khi start đang chạy sẽ đợi start xong rồi mới stop
+      - lỗi tạm thời được retry với exponential backoff; start timeout / lỗi không rõ thì đối chiếu
+        list_egress(room, active) trước: server đã start thì nhận lại egress đó, không start lần 2
+      - governor: tối đa max_concurrent egress trên toàn server (đang record + đang start + egress active của
+        instance khác / ngoài dispatcher, đếm từ list_egress(active) ở vòng reconcile); vượt thì xếp hàng theo
+        priority(room) (cao trước, cùng mức thì FIFO) và được nhận vào khi có egress kết thúc
+      - reconcile(): egress local đã kết thúc phía server thì trả slot, egress active chưa biết của room mình
+        phụ trách thì nhận lại
+    State (egress_map / room_recording / room_filepath) là dict của dispatcher, manager cập nhật trực tiếp.
+    """
+
+    def __init__(self, egress_map, room_recording, room_filepath, build_request,
+                 max_attempts: int = 3, backoff: float = 1.0, timeout: float = 15,
+                 max_concurrent: int = None, priority=None, reconcile_interval: float = 30):
+        self.egress_map = egress_map
+        self.room_recording = room_recording
+        self.room_filepath = room_filepath
+        self._build_request = build_request  # async (lkapi, room_name) -> (Room/TrackCompositeEgressRequest, filepath)
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._timeout = timeout
+        self._tasks = {}  # room_name -> (kind, task)
+        self.max_concurrent = max_concurrent  # None = không giới hạn
+        self._priority = priority              # room_name -> int
+        self._queue = []                       # heap (-priority, seq, room_name)
+        self._queued = {}                      # room_name -> (seq, enqueued_at, lkapi)
+        self._seq = itertools.count()
+        self.reconcile_interval = reconcile_interval
+        self._reconciled_at = None
+        self._external = 0                     # egress active trên server không do instance này quản lý
+
+    def in_flight(self, room_name: str) -> bool:
+        return room_name in self._tasks
+
+    def busy(self) -> bool:
+        return bool(self._tasks)
+
+    def rooms(self):
+        """Room đang có start / stop chạy hoặc đang chờ slot."""
+        return set(self._tasks) | set(self._queued)
+
+    # ---------- governor ----------
+    def active_count(self) -> int:
+        recording = sum(1 for v in self.room_recording.values() if v)
+        starting = sum(1 for kind, _ in self._tasks.values() if kind == "start")
+        return recording + starting + self._external
+
+    def has_capacity(self) -> bool:
+        return self.max_concurrent is None or self.active_count() < self.max_concurrent
+
+    def queue_depth(self) -> int:
+        return len(self._queued)
+
+    def is_queued(self, room_name: str) -> bool:
+        return room_name in self._queued
+
+    def _enqueue(self, lkapi, room_name: str):
+        prio = self._priority(room_name) if self._priority is not None else 0
+        seq = next(self._seq)
+        self._queued[room_name] = (seq, time.monotonic(), lkapi)
+        heapq.heappush(self._queue, (-prio, seq, room_name))
+        set_egress_queue_depth(len(self._queued))
+        print(f"{now()} ⏳ Egress {room_name} chờ slot (priority={prio}, đang chạy {self.active_count()}/{self.max_concurrent}, "
+              f"hàng đợi {len(self._queued)})")
+
+    def dequeue(self, room_name: str) -> bool:
+        if self._queued.pop(room_name, None) is None:
+            return False
+        set_egress_queue_depth(len(self._queued))
+        return True
+
+    def release_gone(self, live_rooms) -> int:
+        """Room đang chờ slot mà đã biến khỏi server → bỏ khỏi hàng đợi."""
+        gone = [r for r in self._queued if r not in live_rooms]
+        for room_name in gone:
+            self.dequeue(room_name)
+            print(f"{now()} 🧹 Room {room_name} đã đóng → bỏ khỏi hàng đợi egress")
+        return len(gone)
+
+    def admit(self):
+        """Nhận room đang chờ vào khi còn slot (gọi sau mỗi lần egress kết thúc và mỗi tick)."""
+        while self._queue and self.has_capacity():
+            _, seq, room_name = heapq.heappop(self._queue)
+            entry = self._queued.get(room_name)
+            if entry is None or entry[0] != seq:
+                continue  # đã bị hủy (room hết đủ người) hoặc xếp hàng lại
+            del self._queued[room_name]
+            _, enqueued_at, lkapi = entry
+            waited = time.monotonic() - enqueued_at
+            observe_egress_wait(waited)
+            print(f"{now()} ✅ Egress {room_name} được nhận sau {waited:.1f}s chờ")
+            self._spawn(room_name, "start", self._start(lkapi, room_name))
+        set_egress_queue_depth(len(self._queued))
+
+    def _spawn(self, room_name: str, kind: str, coro):
+        task = asyncio.create_task(coro)
+        self._tasks[room_name] = (kind, task)
+
+        def _done(t):
+            if self._tasks.get(room_name, (None, None))[1] is t:
+                self._tasks.pop(room_name, None)
+            # start lỗi / stop xong → có thể đã trống slot
+            self.admit()
+
+        task.add_done_callback(_done)
+        return task
+
+    def request_start(self, lkapi, room_name: str) -> bool:
+        if self.room_recording.get(room_name, False) or self.in_flight(room_name) or self.is_queued(room_name):
+            return False
+        if not self.has_capacity():
+            self._enqueue(lkapi, room_name)
+            return False
+        self._spawn(room_name, "start", self._start(lkapi, room_name))
+        return True
+
+    def request_stop(self, lkapi, room_name: str) -> bool:
+        if self.dequeue(room_name):
+            # chưa kịp start → chỉ cần rời hàng đợi
+            return False
+        kind, prev = self._tasks.get(room_name, (None, None))
+        if kind == "stop":
+            return False
+        if prev is None and not self.egress_map.get(room_name):
+            self.room_recording[room_name] = False
+            return False
+        self._spawn(room_name, "stop", self._stop(lkapi, room_name, prev))
+        return True
+
+    async def _call_with_retry(self, label: str, room_name: str, fn, idempotent: bool = True, reconcile=None):
+        """
+        reconcile: coroutine function cho thao tác không idempotent; gọi khi lỗi không chắc server đã nhận hay chưa,
+        trả về kết quả đã có phía server (dùng luôn) hoặc None (chưa có → retry được).
+        """
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                with track_api(f"{label.lower()}_egress"):
+                    return await asyncio.wait_for(fn(), self._timeout)
+            except Exception as e:
+                if not is_retryable(e, idempotent):
+                    if reconcile is None or isinstance(e, api.TwirpError):
+                        raise
+                    try:
+                        found = await reconcile()
+                    except Exception as re:
+                        print(f"{now()} ⚠️ Không đối chiếu được {label.lower()} egress {room_name}: {repr(re)}")
+                        raise e
+                    if found is not None:
+                        return found
+                if attempt >= self._max_attempts:
+                    raise
+                delay = self._backoff * (2 ** (attempt - 1))
+                print(f"{now()} 🔁 {label} egress {room_name} lỗi (lần {attempt}): {repr(e)} → thử lại sau {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _start(self, lkapi, room_name: str):
+        try:
+            req, filepath = await self._build_request(lkapi, room_name)
+        except Exception as e:
+            print(f"{now()} ❌ Failed build egress request for {room_name}: {repr(e)}")
+            return
+
+        adopted = []
+
+        async def reconcile():
+            info = await self._find_active(lkapi, room_name)
+            if info is not None:
+                adopted.append(info)
+            return info
+
+        try:
+            info = await self._call_with_retry(
+                "Start", room_name, lambda: start_call(lkapi, req), idempotent=False, reconcile=reconcile,
+            )
+        except Exception as e:
+            print(f"{now()} ❌ Failed to start egress for {room_name}: {repr(e)}")
+            return
+
+        if adopted:
+            filepath = egress_filepath(info) or filepath
+        self.egress_map[room_name] = info.egress_id
+        self.room_recording[room_name] = True
+        self.room_filepath[room_name] = filepath
+        print(f"{now()} 🚀 Egress started for {room_name} (file: {filepath})")
+
+    async def _find_active(self, lkapi, room_name: str):
+        """Egress đang active của room mà dispatcher chưa biết (start trước đó đã thành công phía server)."""
+        with track_api("list_egress"):
+            resp = await asyncio.wait_for(
+                lkapi.egress.list_egress(api.ListEgressRequest(room_name=room_name, active=True)), self._timeout
+            )
+        known = set(self.egress_map.values())
+        for info in resp.items:
+            if info.egress_id not in known:
+                print(f"{now()} ♻️ Start egress {room_name} không rõ kết quả nhưng server đã có {info.egress_id} → nhận lại")
+                return info
+        return None
+
+    # ---------- reconcile với server ----------
+    def reconcile_due(self) -> bool:
+        return self._reconciled_at is None or time.monotonic() - self._reconciled_at >= self.reconcile_interval
+
+    def reconcile_soon(self):
+        """Đối chiếu ở tick kế tiếp (vd. vừa nhận shard: nhận lại egress instance cũ đã start)."""
+        self._reconciled_at = None
+
+    def reconcile(self, active, known, adopt=None):
+        """
+        Đối chiếu state với list_egress(active=True) của toàn server.
+          active: {egress_id: EgressInfo} đang active
+          known:  bản chụp egress_map ngay trước khi gọi list_egress (egress start xong sau đó chưa chắc có trong active)
+          adopt(room) -> bool: room do instance này phụ trách và cần record
+        Trả về (số egress đã kết thúc được clear, số egress nhận lại).
+        """
+        self._reconciled_at = time.monotonic()
+        released = 0
+        for room_name, egress_id in known.items():
+            if egress_id in active or self.egress_map.get(room_name) != egress_id or self.in_flight(room_name):
+                continue
+            # kết thúc phía server mà không có webhook (poll mode, event bị mất) → trả slot
+            print(f"{now()} 📼 Egress {egress_id} của {room_name} không còn active trên server → clear state")
+            self.room_recording[room_name] = False
+            self.egress_map.pop(room_name, None)
+            self.room_filepath.pop(room_name, None)
+            released += 1
+
+        adopted = 0
+        external = 0
+        known_ids = set(self.egress_map.values())
+        for egress_id, info in active.items():
+            room_name = info.room_name
+            if egress_id in known_ids or self.in_flight(room_name):
+                continue
+            if room_name and room_name not in self.egress_map and adopt is not None and adopt(room_name):
+                self.dequeue(room_name)
+                self.egress_map[room_name] = egress_id
+                self.room_recording[room_name] = True
+                filepath = egress_filepath(info)
+                if filepath:
+                    self.room_filepath[room_name] = filepath
+                print(f"{now()} ♻️ Nhận lại egress {egress_id} đang active của {room_name}")
+                adopted += 1
+            else:
+                external += 1
+        self._external = external
+        self.admit()
+        return released, adopted
+
+    async def _stop(self, lkapi, room_name: str, prev_task=None):
+        if prev_task is not None:
+            # đợi start đang chạy xong để có egress_id
+            await asyncio.gather(prev_task, return_exceptions=True)
+
+        egress_id = self.egress_map.get(room_name)
+        if egress_id:
+            try:
+                await self._call_with_retry(
+                    "Stop", room_name,
+                    lambda: lkapi.egress.stop_egress(api.StopEgressRequest(egress_id=egress_id)),
+                )
+                print(f"{now()} 🛑 Egress stopped for {room_name}. Saved: {self.room_filepath.get(room_name)}")
+            except api.TwirpError as e:
+                if e.code in ("not_found", "failed_precondition"):
+                    print(f"{now()} ℹ️ Egress {egress_id} của {room_name} đã dừng trước đó")
+                else:
+                    print(f"{now()} ❌ Stop egress failed for {room_name}: {repr(e)}")
+            except Exception as e:
+                print(f"{now()} ❌ Stop egress error for {room_name}: {repr(e)}")
+
+        # clear local state dù stop thành công hay không để tránh kẹt
+        self.room_recording[room_name] = False
+        self.egress_map.pop(room_name, None)
+        self.room_filepath.pop(room_name, None)
+
+    async def settle(self, rooms, timeout: float = None):
+        """
+        Room chuyển cho instance khác (nhả shard): bỏ khỏi hàng đợi, đợi start / stop đang chạy xong để checkpoint
+        có đúng egress_id; quá timeout thì hủy (instance nhận shard đối chiếu list_egress và nhận lại egress đã start).
+        """
+        rooms = set(rooms)
+        for room_name in rooms:
+            self.dequeue(room_name)
+        tasks = [task for room_name, (_, task) in self._tasks.items() if room_name in rooms]
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=self._timeout if timeout is None else timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            print(f"{now()} ⚠️ Hủy {len(pending)} thao tác egress chưa xong khi nhả shard")
+
+    async def drain(self):
+        """Đợi các thao tác start/stop đang chạy (dùng khi shutdown)."""
+        tasks = [t for _, t in self._tasks.values()]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+from livekit import api
+
+from participant_classifier import ParticipantKind, classifier
+
+PROFILE_TYPES = ("room_composite", "track_composite")
+# file: 1 file (MP4/OGG/...) dùng được sau khi egress dừng; segments: HLS (.ts + playlist .m3u8) dùng được ngay trong cuộc gọi
+OUTPUTS = ("file", "segments")
+PLAYLIST_NAME = "index.m3u8"
+FILE_TYPES = {
+    "mp4": (api.EncodedFileType.MP4, ".mp4"),
+    "ogg": (api.EncodedFileType.OGG, ".ogg"),
+    "mp3": (api.EncodedFileType.MP3, ".mp3"),
+}
+# video_from / audio_from của track_composite → loại participant lấy track
+TRACK_OWNERS = {"patient": ParticipantKind.PATIENT, "doctor": ParticipantKind.DOCTOR}
+ENCODING_KEYS = ("width", "height", "framerate", "video_bitrate", "key_frame_interval",
+                 "audio_bitrate", "audio_frequency")
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+class EgressProfile:
+    """
+    1 cấu hình egress có tên, compile từ config 1 lần:
+      - type:        room_composite (ghép cả room) hoặc track_composite (1 track video + 1 track audio, không render layout)
+      - audio_only:  room_composite chỉ ghi tiếng (vd. OGG/Opus cho phòng Offline, chỉ cần transcript)
+      - file_type:   mp4 / ogg / mp3
+      - output:      file (mặc định) hoặc segments (HLS, mỗi segment_duration giây 1 file .ts)
+      - video_from / audio_from: track_composite lấy track của "patient" hay "doctor"
+      - các key còn lại (width, height, framerate, *_codec, *_bitrate, ...) → EncodingOptions
+    """
+
+    __slots__ = ("name", "type", "audio_only", "file_type", "ext", "output", "segment_duration",
+                 "video_from", "audio_from", "encoding")
+
+    def __init__(self, name: str, conf: dict):
+        self.name = name
+        self.type = conf.get("type", "room_composite")
+        if self.type not in PROFILE_TYPES:
+            raise ValueError(f"Profile {name}: type không hợp lệ: {self.type!r}")
+        self.audio_only = bool(conf.get("audio_only", False))
+        file_type = conf.get("file_type", "mp4")
+        if file_type not in FILE_TYPES:
+            raise ValueError(f"Profile {name}: file_type không hợp lệ: {file_type!r}")
+        self.file_type, self.ext = FILE_TYPES[file_type]
+        self.output = conf.get("output", "file")
+        if self.output not in OUTPUTS:
+            raise ValueError(f"Profile {name}: output không hợp lệ: {self.output!r}")
+        self.segment_duration = int(conf.get("segment_duration", 6))
+        self.video_from = TRACK_OWNERS[conf.get("video_from", "patient")]
+        self.audio_from = TRACK_OWNERS[conf.get("audio_from", "patient")]
+
+        encoding = {k: int(conf[k]) for k in ENCODING_KEYS if k in conf}
+        if "video_codec" in conf:
+            encoding["video_codec"] = api.VideoCodec.Value(conf["video_codec"])
+        if "audio_codec" in conf:
+            encoding["audio_codec"] = api.AudioCodec.Value(conf["audio_codec"])
+        self.encoding = encoding
+
+    @property
+    def needs_tracks(self) -> bool:
+        return self.type == "track_composite"
+
+    def filepath(self, room_name: str, stamp: str) -> str:
+        """File bản ghi; với output segments là playlist, các segment nằm cùng thư mục."""
+        if self.output == "segments":
+            return f"default/recordings/{room_name}_{stamp}/{PLAYLIST_NAME}"
+        return f"default/recordings/{room_name}_{stamp}{self.ext}"
+
+    def _outputs(self, filepath: str):
+        if self.output == "segments":
+            directory = filepath.rsplit("/", 1)[0]
+            return {"segment_outputs": [api.SegmentedFileOutput(
+                protocol=api.SegmentedFileProtocol.HLS_PROTOCOL,
+                filename_prefix=f"{directory}/seg",
+                playlist_name=filepath,
+                segment_duration=self.segment_duration,
+            )]}
+        return {"file_outputs": [api.EncodedFileOutput(filepath=filepath, file_type=self.file_type)]}
+
+    def build(self, room_name: str, filepath: str, audio_track_id: str = "", video_track_id: str = ""):
+        advanced = api.EncodingOptions(**self.encoding)
+        if self.type == "track_composite":
+            return api.TrackCompositeEgressRequest(
+                room_name=room_name,
+                audio_track_id=audio_track_id,
+                video_track_id=video_track_id,
+                advanced=advanced,
+                **self._outputs(filepath),
+            )
+        return api.RoomCompositeEgressRequest(
+            room_name=room_name,
+            audio_only=self.audio_only,
+            advanced=advanced,
+            **self._outputs(filepath),
+        )
+
+    def pick_tracks(self, participants):
+        """(audio_track_id, video_track_id) theo audio_from / video_from; "" nếu không tìm thấy track."""
+        audio = video = ""
+        for p in participants or []:
+            kind = classifier.classify(p)
+            for t in p.tracks:
+                if t.type == api.TrackType.AUDIO and not audio and kind == self.audio_from:
+                    audio = t.sid
+                elif t.type == api.TrackType.VIDEO and kind == self.video_from:
+                    # ưu tiên camera hơn screen share
+                    if not video or t.source == api.TrackSource.CAMERA:
+                        video = t.sid
+        return audio, video
+
+
+class EgressProfiles:
+    """
+    Bảng profile egress theo tên, đọc từ file JSON {"default": ..., "profiles": {name: {...}}}.
+    Hot-reload khi file đổi (so mtime, tối đa 1 lần / check_interval giây); config lỗi → giữ bảng cũ.
+    """
+
+    def __init__(self, path: str, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.default, self.profiles = self._load(path)
+        self._mtime = os.path.getmtime(path)
+        self._last_check = time.monotonic()
+        print(f"{now()} 🎛️ Loaded {len(self.profiles)} egress profile(s) from {path} (default: {self.default})")
+
+    @staticmethod
+    def _load(path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        profiles = {name: EgressProfile(name, conf) for name, conf in config.get("profiles", {}).items()}
+        default = config.get("default")
+        if default not in profiles:
+            raise ValueError(f"Default profile {default!r} không có trong profiles")
+        return default, profiles
+
+    def maybe_reload(self):
+        if time.monotonic() - self._last_check < self.check_interval:
+            return False
+        self._last_check = time.monotonic()
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self._mtime:
+                return False
+            default, profiles = self._load(self.path)
+        except Exception as e:
+            print(f"{now()} ❌ Reload egress profiles failed, keep old profiles: {repr(e)}")
+            return False
+        self.default, self.profiles = default, profiles
+        self._mtime = mtime
+        print(f"{now()} 🔄 Reloaded {len(profiles)} egress profile(s) from {self.path}")
+        return True
+
+    def get(self, name: str = None) -> EgressProfile:
+        """Profile theo tên; không có tên / tên lạ → profile mặc định."""
+        if name and name in self.profiles:
+            return self.profiles[name]
+        if name:
+            print(f"{now()} ⚠️ Egress profile {name!r} không tồn tại → dùng {self.default}")
+        return self.profiles[self.default]
+
+    def default_profile(self) -> EgressProfile:
+        return self.profiles[self.default]
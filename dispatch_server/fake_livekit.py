@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import collections
+
+from aiohttp import web
+from livekit import api
+
+"""
+LiveKit server giả lập (Twirp protobuf) để chạy / đo dispatcher mà không cần cluster thật.
+Hỗ trợ đúng các call dispatcher dùng:
+  RoomService:          ListRooms, ListParticipants, RemoveParticipant
+  AgentDispatchService: CreateDispatch (agent join room ngay)
+  Egress:               StartRoomCompositeEgress, StartTrackCompositeEgress, StopEgress, ListEgress (EG_* join room)
+  Ingress:              CreateIngress, DeleteIngress, ListIngress (ingress_agent join room)
+Thêm:
+  GET /api/layouts → layout CMS giả (WAITING_VIDEO_API_URL trỏ vào đây, không gọi CMS thật)
+  GET /_stats      → số call theo method, số lỗi inject, số room / participant hiện tại
+Không kiểm tra token (chỉ dùng local).
+
+Cách chạy:
+  python fake_livekit.py --rooms 100 --users 2 --churn 0.05 --latency-ms 5 --jitter-ms 3 --error-rate 0.01
+  LIVEKIT_URL=http://127.0.0.1:7881 python dispatch.py
+"""
+
+FAKE_VIDEO_URL = "http://127.0.0.1/waiting.mp4"
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+class FakeLiveKit:
+    """
+    State in-memory: room -> {identity: ParticipantInfo}, egress / ingress đang active.
+      - latency_ms ± jitter_ms trước mỗi call, error_rate xác suất trả lỗi Twirp "unavailable" (503)
+      - churn: mỗi churn_interval giây, tỉ lệ churn số room có 1 user join hoặc leave (0..max_users user)
+    """
+
+    def __init__(self, rooms: int = 10, users: int = 2, prefix: str = "bench_", latency_ms: float = 0.0,
+                 jitter_ms: float = 0.0, error_rate: float = 0.0, churn: float = 0.0, churn_interval: float = 1.0,
+                 max_users: int = 4, seed: int = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.churn = churn
+        self.churn_interval = churn_interval
+        self.max_users = max_users
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.errors = 0
+        self.rooms = {}     # room_name -> {identity: ParticipantInfo}
+        self.egress = {}    # egress_id -> EgressInfo
+        self.ingress = {}   # ingress_id -> IngressInfo
+        self._seq = 0
+        self._churn_task = None
+        for i in range(rooms):
+            room_name = f"{prefix}{i:05d}"
+            self.rooms[room_name] = {}
+            for _ in range(users):
+                self._join_user(room_name)
+
+        self.routes = {
+            ("RoomService", "ListRooms"): (api.ListRoomsRequest, self.list_rooms),
+            ("RoomService", "ListParticipants"): (api.ListParticipantsRequest, self.list_participants),
+            ("RoomService", "RemoveParticipant"): (api.RoomParticipantIdentity, self.remove_participant),
+            ("AgentDispatchService", "CreateDispatch"): (api.CreateAgentDispatchRequest, self.create_dispatch),
+            ("Egress", "StartRoomCompositeEgress"): (api.RoomCompositeEgressRequest, self.start_egress),
+            ("Egress", "StartTrackCompositeEgress"): (api.TrackCompositeEgressRequest, self.start_egress),
+            ("Egress", "StopEgress"): (api.StopEgressRequest, self.stop_egress),
+            ("Egress", "ListEgress"): (api.ListEgressRequest, self.list_egress),
+            ("Ingress", "CreateIngress"): (api.CreateIngressRequest, self.create_ingress),
+            ("Ingress", "DeleteIngress"): (api.DeleteIngressRequest, self.delete_ingress),
+            ("Ingress", "ListIngress"): (api.ListIngressRequest, self.list_ingress),
+        }
+
+    def _next_id(self, prefix: str) -> str:
+        self._seq += 1
+        return f"{prefix}{self._seq:08d}"
+
+    def _join(self, room_name: str, identity: str, name: str = ""):
+        self.rooms.setdefault(room_name, {})[identity] = api.ParticipantInfo(
+            sid=self._next_id("PA_"), identity=identity, name=name or identity,
+            state=api.ParticipantInfo.State.ACTIVE, joined_at=int(time.time()),
+        )
+
+    def _join_user(self, room_name: str):
+        self._join(room_name, self._next_id("user_"), "Benh nhan")
+
+    # ---------- RoomService ----------
+    def list_rooms(self, req):
+        rooms = [
+            api.Room(sid=f"RM_{name}", name=name, num_participants=len(ps))
+            for name, ps in self.rooms.items()
+            if not req.names or name in req.names
+        ]
+        return api.ListRoomsResponse(rooms=rooms)
+
+    def list_participants(self, req):
+        return api.ListParticipantsResponse(participants=list(self.rooms.get(req.room, {}).values()))
+
+    def remove_participant(self, req):
+        if self.rooms.get(req.room, {}).pop(req.identity, None) is None:
+            raise web.HTTPNotFound(text=json.dumps({"code": "not_found", "msg": "participant not found"}),
+                                   content_type="application/json")
+        return api.RemoveParticipantResponse()
+
+    # ---------- AgentDispatchService ----------
+    def create_dispatch(self, req):
+        self._join(req.room, req.agent_name)
+        return api.AgentDispatch(id=self._next_id("AD_"), agent_name=req.agent_name, room=req.room)
+
+    # ---------- Egress ----------
+    def start_egress(self, req):
+        egress_id = self._next_id("EG_")
+        info = api.EgressInfo(egress_id=egress_id, room_name=req.room_name, status=api.EgressStatus.EGRESS_ACTIVE)
+        self.egress[egress_id] = info
+        self._join(req.room_name, egress_id)
+        return info
+
+    def stop_egress(self, req):
+        info = self.egress.pop(req.egress_id, None)
+        if info is None:
+            raise web.HTTPNotFound(text=json.dumps({"code": "not_found", "msg": "egress not found"}),
+                                   content_type="application/json")
+        self.rooms.get(info.room_name, {}).pop(req.egress_id, None)
+        info.status = api.EgressStatus.EGRESS_COMPLETE
+        return info
+
+    def list_egress(self, req):
+        items = [i for i in self.egress.values() if not req.room_name or i.room_name == req.room_name]
+        return api.ListEgressResponse(items=items)
+
+    # ---------- Ingress ----------
+    def create_ingress(self, req):
+        ingress_id = self._next_id("IN_")
+        info = api.IngressInfo(
+            ingress_id=ingress_id, name=req.name, room_name=req.room_name, input_type=req.input_type,
+            url="rtmp://127.0.0.1/live", stream_key=ingress_id,
+            participant_identity=req.participant_identity,
+        )
+        self.ingress[ingress_id] = info
+        self._join(req.room_name, req.participant_identity or "ingress_agent", req.participant_name)
+        return info
+
+    def delete_ingress(self, req):
+        info = self.ingress.pop(req.ingress_id, None)
+        if info is None:
+            raise web.HTTPNotFound(text=json.dumps({"code": "not_found", "msg": "ingress not found"}),
+                                   content_type="application/json")
+        self.rooms.get(info.room_name, {}).pop(info.participant_identity or "ingress_agent", None)
+        return info
+
+    def list_ingress(self, req):
+        items = [i for i in self.ingress.values() if not req.room_name or i.room_name == req.room_name]
+        return api.ListIngressResponse(items=items)
+
+    # ---------- churn ----------
+    def churn_once(self):
+        """Tỉ lệ churn số room: có user join (room chưa đủ max_users) hoặc user leave."""
+        names = list(self.rooms)
+        if not names:
+            return
+        for room_name in self.random.sample(names, max(1, int(len(names) * self.churn))):
+            ps = self.rooms[room_name]
+            users = [i for i in ps if i.startswith("user_")]
+            if users and (len(users) >= self.max_users or self.random.random() < 0.5):
+                ps.pop(self.random.choice(users))
+            else:
+                self._join_user(room_name)
+
+    async def _churn_loop(self):
+        while True:
+            await asyncio.sleep(self.churn_interval)
+            self.churn_once()
+
+    # ---------- HTTP ----------
+    async def _twirp(self, request: web.Request) -> web.Response:
+        service = request.match_info["service"]
+        method = request.match_info["method"]
+        route = self.routes.get((service, method))
+        if route is None:
+            return web.json_response({"code": "bad_route", "msg": f"{service}/{method}"}, status=404)
+        self.calls[method] += 1
+
+        delay = self.latency_ms + (self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"code": "unavailable", "msg": "injected error"}, status=503)
+
+        request_class, handler = route
+        req = request_class.FromString(await request.read())
+        resp = handler(req)
+        return web.Response(body=resp.SerializeToString(), content_type="application/protobuf")
+
+    async def _layouts(self, request: web.Request) -> web.Response:
+        media = [{"type": "VIDEO", "url": FAKE_VIDEO_URL}]
+        return web.json_response({"data": [{"attributes": {"banners": {"data": [{"attributes": {"media": media}}]}}}]})
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": dict(self.calls),
+            "errors": self.errors,
+            "rooms": len(self.rooms),
+            "participants": sum(len(ps) for ps in self.rooms.values()),
+            "egress": len(self.egress),
+            "ingress": len(self.ingress),
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/twirp/livekit.{service}/{method}", self._twirp)
+        app.router.add_get("/api/layouts", self._layouts)
+        app.router.add_get("/_stats", self._stats)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 7881):
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        if self.churn > 0:
+            self._churn_task = asyncio.create_task(self._churn_loop())
+        return runner
+
+
+async def _serve(args):
+    fake = FakeLiveKit(
+        rooms=args.rooms, users=args.users, prefix=args.prefix, latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms, error_rate=args.error_rate, churn=args.churn,
+        churn_interval=args.churn_interval, max_users=args.max_users, seed=args.seed,
+    )
+    await fake.start(args.host, args.port)
+    print(f"{now()} 🧪 Fake LiveKit http://{args.host}:{args.port} ({args.rooms} room, {args.users} user/room)", flush=True)
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiveKit server giả lập cho dispatcher")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("FAKE_LIVEKIT_PORT", "7881")))
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--users", type=int, default=2, help="số user mỗi room lúc khởi tạo")
+    parser.add_argument("--prefix", default="bench_")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="xác suất 1 call trả lỗi 503 unavailable")
+    parser.add_argument("--churn", type=float, default=0.0, help="tỉ lệ room có join/leave mỗi churn-interval")
+    parser.add_argument("--churn-interval", type=float, default=1.0)
+    parser.add_argument("--max-users", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import hashlib
+import argparse
+from dotenv import load_dotenv
+from livekit import api
+from google.protobuf.json_format import MessageToJson
+import requests
+
+"""
+Giả lập LiveKit gửi webhook tới dispatcher (DISPATCH_MODE=webhook) để test offline.
+Body được ký giống LiveKit server: JWT (api key/secret) chứa sha256 của body.
+
+Cách chạy:
+  python fake_webhook_sender.py participant_joined Phong01 --identity user_1 --name "Nguyen Van A"
+  python fake_webhook_sender.py participant_left Phong01 --identity user_1
+  python fake_webhook_sender.py egress_ended Phong01 --egress-id EG_xxx
+  python fake_webhook_sender.py room_finished Phong01
+  python fake_webhook_sender.py participant_joined Phong01 --bad-signature   # phải bị 401
+"""
+
+load_dotenv()
+LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY")
+LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
+WEBHOOK_URL = os.getenv("FAKE_WEBHOOK_URL", f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8089')}/webhook")
+
+
+def build_event(event_name: str, room_name: str, identity: str = "", name: str = "", egress_id: str = ""):
+    event = api.WebhookEvent(
+        event=event_name,
+        id=f"EV_{uuid.uuid4().hex[:12]}",
+        created_at=int(time.time()),
+    )
+    if event_name == "egress_ended":
+        event.egress_info.CopyFrom(api.EgressInfo(egress_id=egress_id, room_name=room_name))
+    else:
+        event.room.CopyFrom(api.Room(name=room_name, sid=f"RM_{room_name}"))
+    if identity:
+        event.participant.CopyFrom(api.ParticipantInfo(identity=identity, name=name or identity))
+    return event
+
+
+def sign_body(body: str, secret: str) -> str:
+    sha = base64.b64encode(hashlib.sha256(body.encode()).digest()).decode()
+    return api.AccessToken(LIVEKIT_API_KEY, secret).with_sha256(sha).to_jwt()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gửi webhook giả lập LiveKit tới dispatcher")
+    parser.add_argument("event", choices=["room_started", "room_finished", "participant_joined",
+                                          "participant_left", "egress_ended"])
+    parser.add_argument("room")
+    parser.add_argument("--identity", default="")
+    parser.add_argument("--name", default="")
+    parser.add_argument("--egress-id", default="")
+    parser.add_argument("--url", default=WEBHOOK_URL)
+    parser.add_argument("--bad-signature", action="store_true", help="ký bằng secret sai để test verify")
+    args = parser.parse_args()
+
+    if not LIVEKIT_API_KEY or not LIVEKIT_API_SECRET:
+        print("❌ Thiếu LIVEKIT_API_KEY / LIVEKIT_API_SECRET trong .env")
+        sys.exit(1)
+
+    event = build_event(args.event, args.room, args.identity, args.name, args.egress_id)
+    body = MessageToJson(event)
+    secret = LIVEKIT_API_SECRET + "_wrong" if args.bad_signature else LIVEKIT_API_SECRET
+    headers = {
+        "Authorization": sign_body(body, secret),
+        "Content-Type": "application/webhook+json",
+    }
+
+    resp = requests.post(args.url, data=body.encode(), headers=headers, timeout=5)
+    print(f"➡️ {args.event} room={args.room} → {resp.status_code}")
+    print(json.dumps(json.loads(body), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
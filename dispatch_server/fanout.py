@@ -0,0 +1,45 @@
+import asyncio
+import random
+import time
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+async def fan_out(items, fn, limit: int = 16, timeout: float = None, jitter: float = 0.0):
+    """
+    Chạy fn(item) song song cho tất cả items và yield (item, result) theo thứ tự HOÀN THÀNH,
+    để item nhanh không phải chờ item chậm.
+      - limit:   số call chạy cùng lúc tối đa
+      - timeout: giới hạn thời gian mỗi call (giây); quá hạn → result = None
+      - jitter:  delay ngẫu nhiên [0, jitter) trước mỗi call để tránh dồn request cùng 1 thời điểm;
+                 ngủ TRƯỚC khi lấy slot nên không chiếm chỗ của call khác (mặc định 0 = tắt)
+    fn lỗi cũng trả result = None (fn nên tự log lỗi như các safe_* wrapper).
+    """
+    sem = asyncio.Semaphore(max(1, limit))
+
+    async def run(item):
+        if jitter > 0:
+            await asyncio.sleep(random.uniform(0, jitter))
+        async with sem:
+            try:
+                if timeout:
+                    return item, await asyncio.wait_for(fn(item), timeout)
+                return item, await fn(item)
+            except asyncio.TimeoutError:
+                print(f"{now()} ⚠️ fan-out call timed out after {timeout}s for {item!r}")
+                return item, None
+            except Exception as e:
+                print(f"{now()} ⚠️ fan-out call failed for {item!r}: {repr(e)}")
+                return item, None
+
+    tasks = [asyncio.create_task(run(item)) for item in items]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        # consumer dừng sớm → hủy các call còn lại
+        for t in tasks:
+            if not t.done():
+                t.cancel()
@@ -0,0 +1,249 @@
+import asyncio
+import collections
+import time
+
+TS_PACKET = 188
+CHUNK_SIZE = TS_PACKET * 64          # đọc theo bội số gói TS → room mới gắn vào luôn bắt đầu đúng biên gói
+MAX_WRITER_BUFFER = 4 * 1024 * 1024  # writer tụt quá xa (RTMP nghẽn) → bỏ room đó, không làm chậm các room khác
+STDERR_TAIL_LINES = 20
+
+# encode trực tiếp (chỉ dùng khi media cache không có bản encode sẵn) — 1 lần cho mọi room cùng video
+LIVE_ENCODE_ARGS = [
+    "-vf", "scale=1280:720",
+    "-c:v", "libx264",
+    "-preset", "veryfast",
+    "-b:v", "1300k",
+    "-maxrate", "1500k",
+    "-bufsize", "2200k",
+    "-g", "60",
+    "-c:a", "aac",
+    "-b:a", "96k",
+    "-ac", "2",
+    "-ar", "22050",
+]
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+def reader_cmd(source: str, copy: bool):
+    """1 reader / video: đọc lặp theo thời gian thực, xuất MPEG-TS ra stdout (SPS/PPS lặp lại ở mỗi keyframe)."""
+    codec = ["-c", "copy", "-bsf:v", "h264_mp4toannexb"] if copy else LIVE_ENCODE_ARGS
+    return [
+        "ffmpeg", "-v", "error", "-re",
+        "-stream_loop", "-1",
+        "-i", source,
+        *codec,
+        "-f", "mpegts", "-mpegts_flags", "+resend_headers", "pipe:1",
+    ]
+
+
+def writer_cmd(rtmp_url: str):
+    """1 writer / room: nhận MPEG-TS từ stdin, remux (không encode) sang FLV đẩy lên RTMP ingress."""
+    return [
+        "ffmpeg", "-v", "error",
+        "-f", "mpegts", "-i", "pipe:0",
+        "-c", "copy", "-bsf:a", "aac_adtstoasc",
+        "-f", "flv", rtmp_url,
+    ]
+
+
+class FfmpegProcess:
+    """ffmpeg chạy bằng asyncio subprocess, giữ lại STDERR_TAIL_LINES dòng stderr cuối để log khi process chết."""
+
+    def __init__(self, label: str, proc):
+        self.label = label
+        self.proc = proc
+        self.tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        self._stderr_task = asyncio.create_task(self._drain_stderr())
+
+    @classmethod
+    async def spawn(cls, label: str, cmd, stdin=None, stdout=None):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=stdin if stdin is not None else asyncio.subprocess.DEVNULL,
+            stdout=stdout if stdout is not None else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        return cls(label, proc)
+
+    async def _drain_stderr(self):
+        while True:
+            line = await self.proc.stderr.readline()
+            if not line:
+                return
+            self.tail.append(line.decode(errors="replace").rstrip())
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    async def wait(self):
+        rc = await self.proc.wait()
+        await asyncio.gather(self._stderr_task, return_exceptions=True)
+        return rc
+
+    def stderr_tail(self) -> str:
+        return " | ".join(self.tail)
+
+    async def terminate(self, timeout: float = 3.0):
+        if self.proc.stdin is not None and not self.proc.stdin.is_closing():
+            self.proc.stdin.close()
+        await _terminate(self.proc, timeout)
+        await asyncio.gather(self._stderr_task, return_exceptions=True)
+
+
+async def _terminate(proc, timeout: float = 3.0):
+    if proc.returncode is not None:
+        return
+    try:
+        proc.terminate()
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+class _Pipeline:
+    """1 reader ffmpeg cho 1 video, chia chunk TS ra nhiều writer ffmpeg (mỗi room 1 writer, copy mode)."""
+
+    def __init__(self, source: str, copy: bool):
+        self.source = source
+        self.copy = copy
+        self.reader = None
+        self.writers = {}  # room_name -> FfmpegProcess
+        self.task = None
+
+    async def start(self):
+        self.reader = await FfmpegProcess.spawn(
+            f"reader {self.source}", reader_cmd(self.source, self.copy), stdout=asyncio.subprocess.PIPE,
+        )
+        self.task = asyncio.create_task(self._pump())
+
+    async def add(self, room_name: str, rtmp_url: str):
+        writer = await FfmpegProcess.spawn(f"writer {room_name}", writer_cmd(rtmp_url), stdin=asyncio.subprocess.PIPE)
+        self.writers[room_name] = writer
+        return writer
+
+    async def remove(self, room_name: str):
+        writer = self.writers.pop(room_name, None)
+        if writer is not None:
+            await writer.terminate()
+
+    def _drop(self, room_name: str, reason: str):
+        # writer bị bỏ → process kết thúc → supervisor của room thấy và tự xử lý (restart / dọn ingress)
+        writer = self.writers.pop(room_name, None)
+        if writer is not None:
+            print(f"{now()} ⚠️ Writer ingress của {room_name} {reason}")
+            asyncio.create_task(writer.terminate())
+
+    async def _pump(self):
+        try:
+            while True:
+                try:
+                    chunk = await self.reader.proc.stdout.readexactly(CHUNK_SIZE)
+                except asyncio.IncompleteReadError:
+                    rc = await self.reader.wait()
+                    print(f"{now()} ⚠️ Reader video chờ dừng ({self.source}), exit={rc}: {self.reader.stderr_tail()}")
+                    return
+                for room_name, writer in list(self.writers.items()):
+                    stdin = writer.proc.stdin
+                    if writer.returncode is not None or stdin.is_closing():
+                        self.writers.pop(room_name, None)
+                        continue
+                    if stdin.transport.get_write_buffer_size() > MAX_WRITER_BUFFER:
+                        self._drop(room_name, "bị nghẽn → tách khỏi broadcaster")
+                        continue
+                    try:
+                        stdin.write(chunk)
+                    except (BrokenPipeError, ConnectionResetError):
+                        self.writers.pop(room_name, None)
+        finally:
+            for room_name in list(self.writers):
+                self._drop(room_name, "dừng theo reader")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        for room_name in list(self.writers):
+            await self.remove(room_name)
+        if self.reader is not None:
+            await self.reader.terminate()
+
+    @property
+    def alive(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+
+class IngressBroadcaster:
+    """
+    Phát video chờ cho nhiều room với 1 pipeline / video:
+      - attach(room, source, rtmp_url): gắn room vào pipeline của video đó (tạo pipeline nếu chưa có)
+      - detach(room): tách room; pipeline không còn room nào thì dừng reader
+    Mỗi room chỉ tốn 1 ffmpeg remux (-c copy), phần đọc / encode chạy 1 lần cho mọi room cùng video.
+    """
+
+    def __init__(self, max_live_encoders: int = 2):
+        self.max_live_encoders = max_live_encoders
+        self._pipelines = {}  # (source, copy) -> _Pipeline
+        self._rooms = {}      # room_name -> (source, copy)
+        self._lock = asyncio.Lock()
+
+    def rooms(self):
+        return set(self._rooms)
+
+    def pipeline_count(self) -> int:
+        return len(self._pipelines)
+
+    def live_encoder_count(self) -> int:
+        return sum(1 for (_, copy), p in self._pipelines.items() if not copy and p.alive)
+
+    async def attach(self, room_name: str, source: str, rtmp_url: str, copy: bool = True) -> FfmpegProcess:
+        """Trả về writer ffmpeg của room; writer kết thúc = room không còn nhận video."""
+        async with self._lock:
+            if room_name in self._rooms:
+                await self._detach(room_name)
+            key = (source, copy)
+            pipeline = self._pipelines.get(key)
+            if pipeline is None or not pipeline.alive:
+                if pipeline is not None:
+                    await pipeline.stop()
+                    self._pipelines.pop(key, None)
+                if not copy and self.live_encoder_count() >= self.max_live_encoders:
+                    raise RuntimeError(f"Đạt giới hạn {self.max_live_encoders} pipeline encode trực tiếp")
+                pipeline = _Pipeline(source, copy)
+                await pipeline.start()
+                self._pipelines[key] = pipeline
+                print(f"{now()} 📡 Bắt đầu pipeline video chờ ({'copy' if copy else 'encode'}): {source}")
+            writer = await pipeline.add(room_name, rtmp_url)
+            self._rooms[room_name] = key
+            print(f"{now()} ➕ Gắn {room_name} vào pipeline ({len(pipeline.writers)} room)")
+            return writer
+
+    async def detach(self, room_name: str):
+        async with self._lock:
+            await self._detach(room_name)
+
+    async def _detach(self, room_name: str):
+        key = self._rooms.pop(room_name, None)
+        if key is None:
+            return
+        pipeline = self._pipelines.get(key)
+        if pipeline is None:
+            return
+        await pipeline.remove(room_name)
+        if not pipeline.writers:
+            await pipeline.stop()
+            self._pipelines.pop(key, None)
+            print(f"{now()} ⏹️ Dừng pipeline video chờ: {key[0]}")
+
+    async def stop(self):
+        async with self._lock:
+            for pipeline in self._pipelines.values():
+                await pipeline.stop()
+            self._pipelines.clear()
+            self._rooms.clear()
@@ -0,0 +1,244 @@
+import asyncio
+import time
+from livekit import api
+
+from metrics import track_api
+
+STABLE_SECONDS = 60  # writer chạy được lâu hơn mức này thì reset bộ đếm restart
+
+# rtmp: ffmpeg trên máy dispatcher đẩy RTMP vào ingress (qua broadcaster)
+# url:  LiveKit ingress tự kéo video từ URL (URL_INPUT), máy dispatcher không xử lý media
+INGRESS_MODES = ("rtmp", "url")
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+class IngressSupervisor:
+    """
+    Quản lý vòng đời video chờ của từng room:
+      - start(lkapi, room, mode="rtmp"): tạo ingress RTMP, gắn room vào broadcaster, theo dõi writer ffmpeg của room
+        writer chết bất thường → restart với exponential backoff (tối đa max_restarts lần liên tiếp)
+      - start(lkapi, room, mode="url"): tạo ingress URL_INPUT trỏ thẳng vào URL video, không chạy ffmpeg
+        URL_INPUT chỉ phát 1 lượt → theo dõi state ingress, phát hết (ENDPOINT_COMPLETE) thì xóa + tạo lại để lặp;
+        ENDPOINT_ERROR thì tạo lại với backoff như writer RTMP
+      - stop(room): dừng ngay (room trống, bác sĩ vào, ingress_agent bị kick, ...) → tách khỏi broadcaster + xóa ingress;
+        teardown chạy nốt trong task cũ, start lại cùng room sẽ đợi teardown đó xong rồi mới tạo ingress mới
+      - hết max_seconds cũng tự dọn như trên (dùng chung cho cả 2 mode)
+      - tối đa max_streams room phát cùng lúc
+    resolve_url(): coroutine trả về URL video chờ hiện tại, hoặc None.
+    prepare_media(url): coroutine trả về file đã encode sẵn (stream copy) hoặc None → broadcaster encode trực tiếp.
+    """
+
+    def __init__(self, broadcaster, resolve_url, prepare_media=None, max_streams: int = 20,
+                 max_seconds: float = 3600, max_restarts: int = 5, backoff: float = 2.0, max_backoff: float = 60.0,
+                 participant_name: str = "Video giới thiệu", url_poll_interval: float = 5.0):
+        self.broadcaster = broadcaster
+        self.resolve_url = resolve_url
+        self.prepare_media = prepare_media
+        self.max_streams = max_streams
+        self.max_seconds = max_seconds
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.participant_name = participant_name
+        self.url_poll_interval = url_poll_interval
+        self._tasks = {}     # room_name -> task
+        self._stopping = {}  # room_name -> task đã stop, đang teardown
+        self._ingress = {}   # room_name -> ingress_id
+        self._refused = set()  # room bị từ chối vì đủ max_streams (chỉ log 1 lần)
+
+    def is_running(self, room_name: str) -> bool:
+        return room_name in self._tasks
+
+    def rooms(self):
+        return set(self._tasks)
+
+    def start(self, lkapi, room_name: str, mode: str = "rtmp") -> bool:
+        if mode not in INGRESS_MODES:
+            print(f"{now()} ⚠️ Ingress mode không hợp lệ {mode!r} cho {room_name} → dùng rtmp")
+            mode = "rtmp"
+        if room_name in self._tasks:
+            return False
+        if len(self._tasks) >= self.max_streams:
+            if room_name not in self._refused:
+                self._refused.add(room_name)
+                print(f"{now()} ⚠️ Đạt giới hạn {self.max_streams} stream video chờ → {room_name} chờ lượt sau")
+            return False
+        self._refused.discard(room_name)
+        task = asyncio.create_task(self._run(lkapi, room_name, mode, prev=self._stopping.get(room_name)))
+        self._tasks[room_name] = task
+
+        def _done(t):
+            if self._tasks.get(room_name) is t:
+                self._tasks.pop(room_name, None)
+            if self._stopping.get(room_name) is t:
+                self._stopping.pop(room_name, None)
+
+        task.add_done_callback(_done)
+        return True
+
+    def stop(self, room_name: str, reason: str = "") -> bool:
+        self._refused.discard(room_name)
+        task = self._tasks.pop(room_name, None)
+        if task is None:
+            return False
+        if reason:
+            print(f"{now()} ⏹️ Dừng video chờ {room_name}: {reason}")
+        task.cancel()
+        if not task.done():
+            self._stopping[room_name] = task
+        return True
+
+    async def stop_rooms(self, rooms, reason: str = ""):
+        """Dừng các room và đợi teardown (tách broadcaster + xóa ingress) xong."""
+        for room_name in rooms:
+            self.stop(room_name, reason)
+        tasks = [self._stopping[r] for r in rooms if r in self._stopping]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def stop_all(self):
+        tasks = list(self._tasks.values()) + list(self._stopping.values())
+        self._tasks.clear()
+        self._refused.clear()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await self.broadcaster.stop()
+
+    async def _create_ingress(self, lkapi, room_name: str, url: str = None):
+        req = api.CreateIngressRequest(
+            input_type=api.IngressInput.URL_INPUT if url else api.IngressInput.RTMP_INPUT,
+            name="ingress_agent",
+            room_name=room_name,
+            participant_identity="ingress_agent",
+            participant_name=self.participant_name,
+        )
+        if url:
+            req.url = url
+        with track_api("create_ingress"):
+            ingress = await lkapi.ingress.create_ingress(req)
+        self._ingress[room_name] = ingress.ingress_id
+        return ingress
+
+    async def _delete_ingress(self, lkapi, room_name: str):
+        ingress_id = self._ingress.pop(room_name, None)
+        if not ingress_id:
+            return
+        try:
+            with track_api("delete_ingress"):
+                await lkapi.ingress.delete_ingress(api.DeleteIngressRequest(ingress_id=ingress_id))
+            print(f"{now()} ✅ Stream đã kết thúc và ingress bị xóa ({room_name}).")
+        except Exception as e:
+            print(f"{now()} ⚠️ Delete ingress {ingress_id} của {room_name} lỗi: {repr(e)}")
+
+    async def _run(self, lkapi, room_name: str, mode: str, prev=None):
+        if prev is not None:
+            # stop → start nhanh cùng room: đợi task cũ tách broadcaster + xóa ingress xong,
+            # để teardown của nó không gỡ nhầm stream mới
+            await asyncio.gather(prev, return_exceptions=True)
+        try:
+            video_url = await self.resolve_url()
+            if not video_url:
+                return
+            deadline = time.monotonic() + self.max_seconds
+            if mode == "url":
+                await self._run_url(lkapi, room_name, video_url, deadline)
+            else:
+                await self._run_rtmp(lkapi, room_name, video_url, deadline)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"{now()} ❌ Video chờ {room_name} lỗi: {repr(e)}")
+        finally:
+            # teardown chung cho cả 2 mode
+            await self.broadcaster.detach(room_name)
+            await self._delete_ingress(lkapi, room_name)
+
+    async def _ingress_status(self, lkapi, room_name: str):
+        """Status của ingress hiện tại của room; None nếu ingress không còn trên server."""
+        ingress_id = self._ingress.get(room_name)
+        with track_api("list_ingress"):
+            resp = await lkapi.ingress.list_ingress(api.ListIngressRequest(ingress_id=ingress_id))
+        for info in resp.items:
+            if info.ingress_id == ingress_id:
+                return info.state.status
+        return None
+
+    async def _run_url(self, lkapi, room_name: str, video_url: str, deadline: float):
+        await self._create_ingress(lkapi, room_name, url=video_url)
+        print(f"{now()} ▶️ Ingress URL_INPUT phát video vào {room_name}: {video_url}")
+
+        restarts = 0
+        while True:
+            started = time.monotonic()
+            status = api.IngressState.ENDPOINT_INACTIVE
+            while status in (api.IngressState.ENDPOINT_INACTIVE, api.IngressState.ENDPOINT_BUFFERING,
+                             api.IngressState.ENDPOINT_PUBLISHING):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"{now()} ⏰ Hết {int(self.max_seconds)}s video chờ cho {room_name}")
+                    return
+                await asyncio.sleep(min(self.url_poll_interval, remaining))
+                try:
+                    status = await self._ingress_status(lkapi, room_name)
+                except Exception as e:
+                    print(f"{now()} ⚠️ Không đọc được state ingress {room_name}: {repr(e)}")
+
+            delay = 0.0
+            if status == api.IngressState.ENDPOINT_COMPLETE:
+                # phát hết 1 lượt → tạo lại ingress để lặp video
+                restarts = 0
+            else:
+                print(f"{now()} ⚠️ Ingress URL_INPUT {room_name} dừng (status={status})")
+                if time.monotonic() - started > STABLE_SECONDS:
+                    restarts = 0
+                restarts += 1
+                if restarts > self.max_restarts:
+                    print(f"{now()} ❌ Ingress {room_name} lỗi {self.max_restarts} lần liên tiếp → dừng video chờ")
+                    return
+                delay = min(self.max_backoff, self.backoff * (2 ** (restarts - 1)))
+            if time.monotonic() + delay >= deadline:
+                return
+            await self._delete_ingress(lkapi, room_name)
+            if delay:
+                print(f"{now()} 🔁 Tạo lại ingress video chờ {room_name} sau {delay:.0f}s (lần {restarts})")
+                await asyncio.sleep(delay)
+            await self._create_ingress(lkapi, room_name, url=video_url)
+            print(f"{now()} 🔁 Phát lại video chờ vào {room_name}")
+
+    async def _run_rtmp(self, lkapi, room_name: str, video_url: str, deadline: float):
+        cached_path = await self.prepare_media(video_url) if self.prepare_media else None
+        path, copy = (cached_path, True) if cached_path else (video_url, False)
+        ingress = await self._create_ingress(lkapi, room_name)
+        full_rtmp = f"{ingress.url}/{ingress.stream_key}"
+        print(f"{now()} ▶️ Đang stream video vào {room_name}...")
+
+        restarts = 0
+        while True:
+            started = time.monotonic()
+            try:
+                writer = await self.broadcaster.attach(room_name, path, full_rtmp, copy=copy)
+                rc = await asyncio.wait_for(writer.wait(), max(0.0, deadline - time.monotonic()))
+                detail = writer.stderr_tail()
+            except asyncio.TimeoutError:
+                print(f"{now()} ⏰ Hết {int(self.max_seconds)}s video chờ cho {room_name}")
+                return
+            except (OSError, RuntimeError) as e:
+                rc, detail = None, repr(e)
+
+            print(f"{now()} ⚠️ ffmpeg video chờ {room_name} dừng (exit={rc}): {detail}")
+            if time.monotonic() - started > STABLE_SECONDS:
+                restarts = 0
+            restarts += 1
+            if restarts > self.max_restarts:
+                print(f"{now()} ❌ ffmpeg {room_name} lỗi {self.max_restarts} lần liên tiếp → dừng video chờ")
+                return
+            delay = min(self.max_backoff, self.backoff * (2 ** (restarts - 1)))
+            if time.monotonic() + delay >= deadline:
+                return
+            print(f"{now()} 🔁 Restart video chờ {room_name} sau {delay:.0f}s (lần {restarts})")
+            await asyncio.sleep(delay)
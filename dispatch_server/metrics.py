@@ -0,0 +1,141 @@
+import time
+from contextlib import contextmanager
+
+# optional prometheus_client: thiếu module thì các hàm observe_* / set_* thành no-op
+try:
+    from prometheus_client import Histogram, Gauge, Counter, start_http_server
+except Exception:
+    Histogram = Gauge = Counter = start_http_server = None
+
+TICK_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+TICK_SECONDS = (
+    Histogram("dispatcher_tick_seconds", "Thời gian 1 vòng quét monitor_and_dispatch", buckets=TICK_BUCKETS)
+    if Histogram else None
+)
+
+TICK_API_CALL_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+TICK_API_CALLS = (
+    Histogram("dispatcher_tick_api_calls", "Số call LiveKit API trong 1 tick", buckets=TICK_API_CALL_BUCKETS)
+    if Histogram else None
+)
+
+API_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+
+API_CALLS = (
+    Counter("dispatcher_api_calls_total", "Số call LiveKit API theo method / kết quả", ["method", "outcome"])
+    if Counter else None
+)
+API_SECONDS = (
+    Histogram("dispatcher_api_call_seconds", "Latency call LiveKit API theo method", ["method"], buckets=API_BUCKETS)
+    if Histogram else None
+)
+ROOM_SECONDS = (
+    Histogram("dispatcher_room_seconds", "Thời gian xử lý 1 room (quyết định egress / ingress) trong tick",
+              buckets=API_BUCKETS)
+    if Histogram else None
+)
+REDIS_SECONDS = (
+    Histogram("dispatcher_redis_seconds", "Latency đọc Redis room registry theo lệnh", ["op"], buckets=API_BUCKETS)
+    if Histogram else None
+)
+
+ROOMS = Gauge("dispatcher_rooms", "Số room trong list_rooms ở tick gần nhất") if Gauge else None
+DISPATCHED_ROOMS = Gauge("dispatcher_dispatched_rooms", "Số room đã dispatch agent") if Gauge else None
+ACTIVE_EGRESS = Gauge("dispatcher_active_egress", "Số egress đang record") if Gauge else None
+ACTIVE_INGRESS = Gauge("dispatcher_active_ingress", "Số room đang phát video chờ (ingress)") if Gauge else None
+
+EGRESS_WAIT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600)
+
+EGRESS_QUEUE_DEPTH = (
+    Gauge("dispatcher_egress_queue_depth", "Số room đang chờ slot egress") if Gauge else None
+)
+EGRESS_WAIT_SECONDS = (
+    Histogram("dispatcher_egress_wait_seconds", "Thời gian room chờ trong hàng đợi egress", buckets=EGRESS_WAIT_BUCKETS)
+    if Histogram else None
+)
+
+PENDING_DELAYED = (
+    Gauge("dispatcher_pending_delayed_actions", "Số việc trễ (remove agent, ...) đang chờ", ["action"])
+    if Gauge else None
+)
+_pending_actions = set()
+
+
+_tick_api_calls = 0
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> bool:
+    """Prometheus text trên http://host:port/metrics; False nếu thiếu prometheus_client."""
+    if start_http_server is None:
+        return False
+    start_http_server(port, addr=host)
+    return True
+
+
+def observe_tick(seconds: float):
+    global _tick_api_calls
+    if TICK_SECONDS is not None:
+        TICK_SECONDS.observe(seconds)
+    if TICK_API_CALLS is not None:
+        TICK_API_CALLS.observe(_tick_api_calls)
+    _tick_api_calls = 0
+
+
+def observe_api(method: str, outcome: str, seconds: float):
+    global _tick_api_calls
+    _tick_api_calls += 1
+    if API_CALLS is not None:
+        API_CALLS.labels(method=method, outcome=outcome).inc()
+    if API_SECONDS is not None:
+        API_SECONDS.labels(method=method).observe(seconds)
+
+
+@contextmanager
+def track_api(method: str):
+    """with track_api("list_rooms"): await ...  → đếm call + latency, exception tính outcome=error."""
+    started = time.monotonic()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        observe_api(method, outcome, time.monotonic() - started)
+
+
+def observe_room(seconds: float):
+    if ROOM_SECONDS is not None:
+        ROOM_SECONDS.observe(seconds)
+
+
+def observe_redis(op: str, seconds: float):
+    if REDIS_SECONDS is not None:
+        REDIS_SECONDS.labels(op=op).observe(seconds)
+
+
+def set_room_gauges(rooms: int, dispatched: int, egress: int, ingress: int):
+    for gauge, value in ((ROOMS, rooms), (DISPATCHED_ROOMS, dispatched), (ACTIVE_EGRESS, egress),
+                         (ACTIVE_INGRESS, ingress)):
+        if gauge is not None:
+            gauge.set(value)
+
+
+def set_pending_delayed(counts: dict):
+    """counts: action -> số việc đang chờ; action không còn trong counts được đặt về 0."""
+    if PENDING_DELAYED is None:
+        return
+    for action in _pending_actions | set(counts):
+        PENDING_DELAYED.labels(action=action).set(counts.get(action, 0))
+    _pending_actions.update(counts)
+
+
+def set_egress_queue_depth(depth: int):
+    if EGRESS_QUEUE_DEPTH is not None:
+        EGRESS_QUEUE_DEPTH.set(depth)
+
+
+def observe_egress_wait(seconds: float):
+    if EGRESS_WAIT_SECONDS is not None:
+        EGRESS_WAIT_SECONDS.observe(seconds)
@@ -0,0 +1,66 @@
+import enum
+import unicodedata
+from functools import lru_cache
+
+
+class ParticipantKind(enum.IntEnum):
+    PATIENT = 0   # user thật, không phải bác sĩ
+    DOCTOR = 1
+    AGENT = 2     # *_agent (assistant_agent, record_agent, ...)
+    EGRESS = 3    # EG_*
+    INGRESS = 4   # ingress_agent (video chờ)
+
+
+def normalize(text: str) -> str:
+    """Chuẩn hóa chuỗi về dạng thường, bỏ khoảng trắng và dấu tiếng Việt."""
+    if not text:
+        return ""
+    text = text.lower().strip()
+    text = "".join(
+        c for c in unicodedata.normalize("NFD", text)
+        if unicodedata.category(c) != "Mn"
+    )
+    return text
+
+
+# từ khóa nhận diện bác sĩ (so trên identity/name đã normalize)
+DOCTOR_KEYWORDS = tuple(normalize(k) for k in ["bs", "bacsi", "bac si", "bac-si", "bac_sĩ"])
+
+
+class ParticipantClassifier:
+    """
+    Phân loại participant dùng chung cho dispatch / ingress / egress.
+    Kết quả cache LRU theo (identity, name) → mỗi participant chỉ normalize 1 lần trong suốt thời gian ở room,
+    không phải mỗi tick.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self._classify = lru_cache(maxsize=maxsize)(self._classify_uncached)
+
+    @staticmethod
+    def _classify_uncached(identity: str, name: str) -> ParticipantKind:
+        if identity.startswith("EG_"):
+            return ParticipantKind.EGRESS
+        if identity == "ingress_agent":
+            return ParticipantKind.INGRESS
+        if not identity or identity.endswith("_agent"):
+            return ParticipantKind.AGENT
+        pid_norm = normalize(identity)
+        pname_norm = normalize(name)
+        if any(k in pid_norm or k in pname_norm for k in DOCTOR_KEYWORDS):
+            return ParticipantKind.DOCTOR
+        return ParticipantKind.PATIENT
+
+    def classify(self, p) -> ParticipantKind:
+        return self._classify((p.identity or "").strip(), (p.name or "").strip())
+
+    def is_real(self, p) -> bool:
+        """User thật (bệnh nhân hoặc bác sĩ) — dùng cho điều kiện egress."""
+        return self.classify(p) in (ParticipantKind.PATIENT, ParticipantKind.DOCTOR)
+
+    def cache_info(self):
+        return self._classify.cache_info()
+
+
+# instance dùng chung trong process dispatcher
+classifier = ParticipantClassifier()
@@ -0,0 +1,115 @@
+from fanout import fan_out
+from participant_classifier import ParticipantKind, classifier
+
+
+class RoomView:
+    """
+    Trạng thái 1 room trong 1 tick.
+    participants = None nghĩa là room có người nhưng list_participants bị lỗi → các bước quyết định nên bỏ qua.
+    """
+
+    __slots__ = ("name", "num_participants", "participants", "kinds", "listed")
+
+    def __init__(self, name: str, num_participants: int = 0, participants=None, listed: bool = True):
+        self.name = name
+        self.num_participants = num_participants
+        self.participants = list(participants) if participants is not None else None
+        self.listed = listed
+        self.kinds = {}  # identity -> ParticipantKind
+        for p in self.participants or []:
+            self.kinds[(p.identity or "").strip()] = classifier.classify(p)
+
+    @property
+    def ok(self) -> bool:
+        return self.participants is not None
+
+    def identities(self):
+        return list(self.kinds.keys())
+
+    def has_identity(self, identity: str) -> bool:
+        return identity in self.kinds
+
+    def count(self, *kinds) -> int:
+        return sum(1 for k in self.kinds.values() if k in kinds)
+
+    @property
+    def real_count(self) -> int:
+        """Số user thật (bệnh nhân + bác sĩ), không tính agent / EG_* / ingress."""
+        return self.count(ParticipantKind.PATIENT, ParticipantKind.DOCTOR)
+
+
+class RoomSnapshot:
+    """
+    Ảnh chụp toàn bộ room trong 1 tick: 1 lần list_rooms + tối đa 1 lần list_participants mỗi room,
+    các room được fetch song song (giới hạn bởi semaphore). Dùng chung cho cả 3 bước quyết định.
+    """
+
+    def __init__(self, rooms):
+        self.rooms = rooms  # room_name -> RoomView (chỉ các room có trong list_rooms)
+
+    def get(self, room_name: str) -> RoomView:
+        """Room không có trong list_rooms coi như trống (không cần gọi API)."""
+        view = self.rooms.get(room_name)
+        if view is None:
+            return RoomView(room_name, 0, [], listed=False)
+        return view
+
+    def views(self):
+        return list(self.rooms.values())
+
+    def names(self):
+        return set(self.rooms.keys())
+
+    @classmethod
+    async def build(cls, lkapi, needs_participants, list_rooms, list_participants,
+                    concurrency: int = 16, timeout: float = None, jitter: float = 0.0, on_room=None,
+                    include=None, reuse=None):
+        """
+        needs_participants(room_info) -> bool: room nào cần danh sách participant trong tick này.
+        list_rooms / list_participants: các safe wrapper (trả None khi lỗi).
+        on_room(view): coroutine gọi ngay khi từng room có kết quả (room nhanh không chờ room chậm).
+        include(room_name) -> bool: chỉ giữ các room này trong snapshot (sharded mode), None = mọi room.
+        reuse(room_info) -> list | None: danh sách participant còn dùng được từ tick trước
+            (room ở làn cold), None = phải gọi list_participants.
+        Trả None nếu list_rooms lỗi.
+        """
+        resp = await list_rooms(lkapi)
+        if resp is None:
+            return None
+
+        rooms = {}
+        to_fetch = []
+        for room_info in resp.rooms:
+            name = getattr(room_info, "name", "")
+            num = getattr(room_info, "num_participants", 0)
+            if include is not None and not include(name):
+                continue
+            # room trống thì không cần gọi list_participants
+            if num <= 0:
+                rooms[name] = RoomView(name, num, [])
+            elif not needs_participants(room_info):
+                rooms[name] = RoomView(name, num, None)
+            else:
+                cached = reuse(room_info) if reuse is not None else None
+                if cached is not None:
+                    rooms[name] = RoomView(name, num, cached)
+                else:
+                    to_fetch.append((name, num))
+
+        if on_room is not None:
+            for view in list(rooms.values()):
+                await on_room(view)
+
+        async def fetch(item):
+            return await list_participants(lkapi, item[0])
+
+        async for (name, num), participants_resp in fan_out(
+            to_fetch, fetch, limit=concurrency, timeout=timeout, jitter=jitter
+        ):
+            participants = participants_resp.participants if participants_resp is not None else None
+            view = RoomView(name, num, participants)
+            rooms[name] = view
+            if on_room is not None:
+                await on_room(view)
+
+        return cls(rooms)
@@ -0,0 +1,143 @@
+import os
+import re
+import json
+import time
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+class Route:
+    """
+    Kết quả định tuyến của 1 room:
+      - agent:        agent_name cần dispatch (None = không dispatch)
+      - monitor:      áp dụng logic remove assistant/ingress/record agent
+      - egress:       theo dõi để start/stop egress (+ ingress video chờ)
+      - doctor_first: "skip" = bác sĩ vào trước thì không dispatch agent, "dispatch" = vẫn dispatch
+      - rule:         tên rule khớp (để log/debug)
+      - options:      các key khác trong rule (để các phần khác của dispatcher đọc thêm, vd. "ingress_mode", "egress_profile")
+    """
+
+    __slots__ = ("agent", "monitor", "egress", "doctor_first", "rule", "options")
+
+    def __init__(self, rule: dict, name: str):
+        self.agent = rule.get("agent")
+        self.monitor = bool(rule.get("monitor", False))
+        self.egress = bool(rule.get("egress", False))
+        self.doctor_first = rule.get("doctor_first", "skip")
+        self.rule = name
+        known = {"name", "match", "rooms", "prefixes", "patterns", "agent", "monitor", "egress", "doctor_first"}
+        self.options = {k: v for k, v in rule.items() if k not in known}
+
+
+class RoutingTable:
+    """
+    Bảng định tuyến room -> Route, compile từ config 1 lần:
+      - exact:  dict room_name -> index rule (O(1))
+      - prefix / regex: gộp thành 1 regex duy nhất, mỗi rule 1 named group
+      - redis:  room có trong hash room:online
+    Các rule xét theo thứ tự trong file, rule đầu tiên khớp thắng.
+    Kết quả được cache theo (room_name, in_redis) nên các tick sau chỉ là 1 lần tra dict.
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        self._exact = {}
+        self._redis_index = None
+        alternatives = []
+        for i, rule in enumerate(rules):
+            match = rule.get("match", "exact")
+            name = rule.get("name") or f"rule{i}"
+            self.rules.append(Route(rule, name))
+            if match == "exact":
+                for room_name in rule.get("rooms", []):
+                    self._exact.setdefault(room_name, i)
+            elif match == "prefix":
+                for prefix in rule.get("prefixes", []):
+                    alternatives.append((i, re.escape(prefix) + ".*"))
+            elif match == "regex":
+                for pattern in rule.get("patterns", []):
+                    re.compile(pattern)  # báo lỗi sớm nếu pattern sai
+                    alternatives.append((i, f"(?:{pattern})"))
+            elif match == "redis":
+                if self._redis_index is None:
+                    self._redis_index = i
+            else:
+                raise ValueError(f"Rule {name}: match không hợp lệ: {match!r}")
+
+        # nhiều pattern của cùng 1 rule gộp chung 1 group; thứ tự group = thứ tự rule
+        grouped = {}
+        for i, pat in alternatives:
+            grouped.setdefault(i, []).append(pat)
+        self._pattern = (
+            re.compile("|".join(f"(?P<r{i}>{'|'.join(pats)})" for i, pats in sorted(grouped.items())))
+            if grouped else None
+        )
+        self._cache = {}
+
+    def resolve(self, room_name: str, in_redis: bool = False):
+        """Trả về Route của room hoặc None nếu không rule nào khớp."""
+        key = (room_name, in_redis)
+        if key in self._cache:
+            return self._cache[key]
+
+        candidates = []
+        i = self._exact.get(room_name)
+        if i is not None:
+            candidates.append(i)
+        if self._pattern is not None:
+            m = self._pattern.fullmatch(room_name)
+            if m:
+                candidates.append(int(m.lastgroup[1:]))
+        if in_redis and self._redis_index is not None:
+            candidates.append(self._redis_index)
+
+        route = self.rules[min(candidates)] if candidates else None
+        if len(self._cache) > 50000:
+            self._cache.clear()
+        self._cache[key] = route
+        return route
+
+    def static_rooms(self):
+        """Các room khai báo exact trong config."""
+        return set(self._exact.keys())
+
+    @classmethod
+    def from_file(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return cls(config.get("rules", []))
+
+
+class Router:
+    """Giữ RoutingTable hiện hành và hot-reload khi file config đổi (so mtime, tối đa 1 lần / check_interval giây)."""
+
+    def __init__(self, path: str, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.table = RoutingTable.from_file(path)
+        self._mtime = os.path.getmtime(path)
+        self._last_check = time.monotonic()
+        print(f"{now()} 🧭 Loaded {len(self.table.rules)} routing rule(s) from {path}")
+
+    def maybe_reload(self):
+        if time.monotonic() - self._last_check < self.check_interval:
+            return False
+        self._last_check = time.monotonic()
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self._mtime:
+                return False
+            table = RoutingTable.from_file(self.path)
+        except Exception as e:
+            # config lỗi → giữ bảng cũ
+            print(f"{now()} ❌ Reload routing config failed, keep old rules: {repr(e)}")
+            return False
+        self.table = table
+        self._mtime = mtime
+        print(f"{now()} 🔄 Reloaded {len(table.rules)} routing rule(s) from {self.path}")
+        return True
+
+    def resolve(self, room_name: str, in_redis: bool = False):
+        return self.table.resolve(room_name, in_redis)
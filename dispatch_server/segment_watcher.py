@@ -0,0 +1,219 @@
+import os
+import json
+import asyncio
+import time
+
+import aiohttp
+
+PLAYLIST_SUFFIX = ".m3u8"
+MANIFEST_NAME = "segments.jsonl"
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+def parse_playlist(text: str):
+    """
+    Đọc playlist HLS → (list segment, ended).
+    Mỗi segment: {"index", "uri", "start", "duration", "wall_clock"}; start = offset (giây) tính từ đầu bản ghi,
+    wall_clock = #EXT-X-PROGRAM-DATE-TIME (ISO) nếu egress có ghi, dùng để khớp với timestamp của transcript.
+    Playlist chỉ liệt kê segment đã ghi xong nên mọi segment trả về đều đọc được.
+    """
+    segments = []
+    ended = False
+    start = 0.0
+    duration = None
+    wall_clock = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXTINF:"):
+            try:
+                duration = float(line[8:].split(",", 1)[0])
+            except ValueError:
+                duration = 0.0
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            wall_clock = line.split(":", 1)[1]
+        elif line.startswith("#EXT-X-ENDLIST"):
+            ended = True
+        elif not line.startswith("#"):
+            d = duration or 0.0
+            segments.append({
+                "index": len(segments), "uri": line, "start": round(start, 3),
+                "duration": d, "wall_clock": wall_clock,
+            })
+            start += d
+            duration = wall_clock = None
+    return segments, ended
+
+
+def _manifest_count(playlist: str) -> int:
+    try:
+        with open(os.path.join(os.path.dirname(playlist), MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return sum(1 for line in f if line.strip())
+    except OSError:
+        return 0
+
+
+class _Recording:
+    __slots__ = ("room_name", "playlist", "emitted", "mtime", "finish_by")
+
+    def __init__(self, room_name: str, playlist: str):
+        self.room_name = room_name
+        self.playlist = playlist
+        self.emitted = _manifest_count(playlist)  # số segment đã đưa sang post-processing (restart thì đọc lại manifest)
+        self.mtime = None
+        self.finish_by = None     # egress đã dừng → đợi #EXT-X-ENDLIST tới mốc này
+
+
+class SegmentWatcher:
+    """
+    Theo dõi các bản ghi HLS (segment .ts + playlist .m3u8) trên thư mục local mà egress ghi ra
+    (volume dùng chung, root_dir), đẩy từng segment đã ghi xong sang post-processing ngay trong cuộc gọi:
+      - room_filepath là dict của dispatcher; room nào có filepath .m3u8 thì được theo dõi
+      - mỗi poll_interval: stat playlist, mtime đổi mới đọc lại, segment mới → queue → on_segment(room, segment)
+      - mỗi segment được ghi thêm 1 dòng vào segments.jsonl cạnh playlist (offset + wall clock để khớp transcript)
+      - room rời room_filepath (egress dừng) → đọc nốt tới #EXT-X-ENDLIST, tối đa finish_timeout giây
+    Post-processing: on_segment (coroutine (room_name, segment)) và/hoặc POST JSON {"room", ...segment} tới hook_url,
+    segment = {"index", "path", "start", "duration", "wall_clock", "final"}.
+    """
+
+    def __init__(self, room_filepath, root_dir: str, on_segment=None, hook_url: str = None,
+                 poll_interval: float = 1.0, finish_timeout: float = 60.0, workers: int = 2):
+        self.room_filepath = room_filepath
+        self.root_dir = root_dir
+        self.on_segment = on_segment
+        self.hook_url = hook_url
+        self.poll_interval = poll_interval
+        self.finish_timeout = finish_timeout
+        self.workers = workers
+        self._recordings = {}  # playlist path -> _Recording
+        self._finished = set()  # playlist đã có ENDLIST nhưng room_filepath chưa kịp bỏ → không theo dõi lại
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._session = None
+
+    def watching(self):
+        return {rec.room_name for rec in self._recordings.values()}
+
+    def backlog(self) -> int:
+        return self._queue.qsize()
+
+    def _local_path(self, filepath: str) -> str:
+        return os.path.join(self.root_dir, filepath)
+
+    def _sync(self):
+        active = set()
+        for room_name, filepath in list(self.room_filepath.items()):
+            if not filepath or not filepath.endswith(PLAYLIST_SUFFIX):
+                continue
+            playlist = self._local_path(filepath)
+            active.add(playlist)
+            if playlist in self._finished:
+                continue
+            rec = self._recordings.get(playlist)
+            if rec is None:
+                self._recordings[playlist] = _Recording(room_name, playlist)
+                print(f"{now()} 🎞️ Theo dõi segment HLS của {room_name}: {playlist}")
+            elif rec.finish_by is not None:
+                rec.finish_by = None
+        for playlist, rec in self._recordings.items():
+            if playlist not in active and rec.finish_by is None:
+                rec.finish_by = time.monotonic() + self.finish_timeout
+        self._finished &= active
+
+    def _scan(self, rec: _Recording) -> bool:
+        """Đưa segment mới của 1 bản ghi vào queue; True nếu bản ghi đã xong (ENDLIST hoặc hết finish_timeout)."""
+        try:
+            mtime = os.stat(rec.playlist).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != rec.mtime:
+            rec.mtime = mtime
+            try:
+                with open(rec.playlist, "r", encoding="utf-8") as f:
+                    segments, ended = parse_playlist(f.read())
+            except OSError as e:
+                print(f"{now()} ⚠️ Không đọc được playlist {rec.playlist}: {repr(e)}")
+                return False
+            base = os.path.dirname(rec.playlist)
+            for seg in segments[rec.emitted:]:
+                seg["path"] = os.path.join(base, seg.pop("uri"))
+                seg["final"] = ended and seg["index"] == len(segments) - 1
+                self._queue.put_nowait((rec, seg))
+            rec.emitted = max(rec.emitted, len(segments))
+            if ended:
+                return True
+        return rec.finish_by is not None and time.monotonic() >= rec.finish_by
+
+    async def _run(self):
+        while True:
+            try:
+                self._sync()
+                for playlist, rec in list(self._recordings.items()):
+                    if self._scan(rec):
+                        del self._recordings[playlist]
+                        self._finished.add(playlist)
+                        print(f"{now()} ✅ Bản ghi HLS của {rec.room_name} xong: {rec.emitted} segment")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{now()} ⚠️ Segment watcher lỗi: {repr(e)}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _worker(self):
+        while True:
+            rec, seg = await self._queue.get()
+            try:
+                self._append_manifest(rec, seg)
+                if self.on_segment is not None:
+                    await self.on_segment(rec.room_name, seg)
+                if self.hook_url:
+                    await self._post(rec.room_name, seg)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{now()} ⚠️ Post-process segment {seg['path']} của {rec.room_name} lỗi: {repr(e)}")
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _append_manifest(rec: _Recording, seg: dict):
+        manifest = os.path.join(os.path.dirname(rec.playlist), MANIFEST_NAME)
+        line = dict(seg, room=rec.room_name)
+        with open(manifest, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    async def _post(self, room_name: str, seg: dict):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        async with self._session.post(self.hook_url, json=dict(seg, room=room_name)) as resp:
+            if resp.status >= 300:
+                raise RuntimeError(f"hook HTTP {resp.status}")
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._run())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 5.0):
+        if not self._tasks:
+            return
+        runner, workers = self._tasks[0], self._tasks[1:]
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        try:
+            # segment đã vào queue vẫn được xử lý nốt
+            await asyncio.wait_for(self._queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"{now()} ⚠️ Còn {self._queue.qsize()} segment chưa post-process khi dừng")
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._tasks = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,378 @@
+import asyncio
+import base64
+import collections
+import math
+import os
+import socket
+import time
+import zlib
+
+# optional redis (async client). Thiếu module thì không chạy được sharded mode.
+try:
+    import redis.asyncio as aioredis
+except Exception:
+    aioredis = None
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+# gia hạn lease chỉ khi vẫn là chủ (tránh gia hạn lease đã bị instance khác lấy)
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def shard_of(room_name: str, shard_count: int) -> int:
+    """
+    Chia không gian crc32 (0..2^32) thành shard_count dải liên tiếp; room thuộc dải chứa crc32(room_name).
+    crc32 ổn định giữa các process (khác hash() của Python bị random theo process).
+    """
+    return (zlib.crc32(room_name.encode("utf-8")) * shard_count) >> 32
+
+
+def default_instance_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ShardManager:
+    """
+    Giữ lease Redis cho 1 phần các shard, để nhiều dispatcher chạy song song, mỗi instance chỉ xử lý room thuộc shard của mình.
+      - lease:   SET {prefix}:lease:{shard} instance_id NX PX ttl, gia hạn mỗi ttl/3
+      - member:  ZSET {prefix}:members (score = hạn heartbeat) → số instance còn sống → mỗi instance giữ ceil(N / live) shard
+      - instance mới vào: instance đang giữ nhiều hơn phần của mình nhả bớt → instance mới lấy
+      - instance chết: lease hết hạn sau ttl → instance khác lấy lại (failover)
+    owns(room) chỉ đúng khi lease còn hạn theo đồng hồ local (trừ hao margin), nên mất kết nối Redis
+    thì instance tự ngừng xử lý shard trước khi instance khác có thể lấy.
+    Task nền chỉ giữ lease; chuyển giao shard được xếp hàng và áp trong main loop giữa các tick
+    (apply_transitions), không đụng state của dispatcher song song với tick / webhook:
+      - on_acquire(shards): nạp state; shard vừa lấy lease chỉ được owns() sau khi nạp xong
+      - on_release(shards): checkpoint state rồi mới nhả lease (rebalance / stop)
+      - on_lost(shards): lease đã thuộc instance khác → bỏ state local, không checkpoint (tránh ghi đè chủ mới)
+    """
+
+    def __init__(self, host: str, port: int, password: str = None, shard_count: int = 64,
+                 lease_ttl: float = 10.0, instance_id: str = None, prefix: str = "dispatcher",
+                 on_acquire=None, on_release=None, on_lost=None, db: int = 0):
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        self.renew_interval = lease_ttl / 3
+        self.margin = lease_ttl / 5
+        self.instance_id = instance_id or default_instance_id()
+        self.prefix = prefix
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.on_lost = on_lost
+        self._conn = dict(host=host, port=port, password=password or None, db=db)
+        self._client = None
+        self._owned = {}  # shard -> hạn lease theo time.monotonic()
+        self._acquiring = set()  # đã có lease, chờ main loop nạp state
+        self._releasing = set()  # chờ main loop checkpoint rồi nhả lease
+        self._transitions = collections.deque()  # (kind, shards), kind: acquire / release / lost
+        self._transition_event = asyncio.Event()
+        self._task = None
+        self.live_members = 1
+
+    # ---------- đọc ----------
+    def holds_lease(self, shard: int) -> bool:
+        deadline = self._owned.get(shard)
+        return deadline is not None and deadline > time.monotonic()
+
+    def owns_shard(self, shard: int) -> bool:
+        return shard not in self._acquiring and self.holds_lease(shard)
+
+    def owns(self, room_name: str) -> bool:
+        return self.owns_shard(shard_of(room_name, self.shard_count))
+
+    def owned_shards(self):
+        """Shard đang xử lý (lease còn hạn, state đã nạp)."""
+        return sorted(s for s in self._owned if self.owns_shard(s))
+
+    def leased_shards(self):
+        """Shard đang giữ lease, kể cả shard chưa nạp xong state."""
+        return sorted(s for s in self._owned if self.holds_lease(s))
+
+    # ---------- chuyển giao shard (main loop) ----------
+    def _queue(self, kind: str, shards):
+        self._transitions.append((kind, list(shards)))
+        self._transition_event.set()
+
+    def has_transitions(self) -> bool:
+        return bool(self._transitions)
+
+    async def wait_transitions(self):
+        """Đợi tới khi có chuyển giao shard cần áp (dùng cho vòng chờ event của webhook mode)."""
+        while not self._transitions:
+            self._transition_event.clear()
+            await self._transition_event.wait()
+
+    async def apply_transitions(self):
+        """Áp các chuyển giao đang chờ theo đúng thứ tự; chỉ gọi từ main loop, giữa các tick / event."""
+        while self._transitions:
+            kind, shards = self._transitions.popleft()
+            if kind == "acquire":
+                held = [s for s in shards if s in self._owned]
+                try:
+                    if held and self.on_acquire is not None:
+                        await self.on_acquire(held)
+                finally:
+                    self._acquiring.difference_update(shards)
+            elif kind == "release":
+                self._releasing.difference_update(shards)
+                held = [s for s in shards if s in self._owned]
+                if held:
+                    await self._release(held)
+            elif self.on_lost is not None:
+                await self.on_lost(shards)
+
+    def target(self) -> int:
+        return math.ceil(self.shard_count / max(1, self.live_members))
+
+    # ---------- vòng đời ----------
+    async def start(self):
+        if aioredis is None:
+            raise RuntimeError("Sharded mode cần redis-py (redis.asyncio)")
+        self._client = aioredis.Redis(
+            **self._conn, decode_responses=True, socket_connect_timeout=3, socket_timeout=3,
+        )
+        await self.rebalance()
+        await self.apply_transitions()
+        self._task = asyncio.create_task(self._run())
+        print(f"{now()} 🧩 Instance {self.instance_id} giữ {len(self.owned_shards())}/{self.shard_count} shard")
+
+    async def stop(self):
+        """Gọi từ main loop (đã dừng tick): áp nốt chuyển giao đang chờ rồi checkpoint + nhả hết lease."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self.apply_transitions()
+            # nhả hết lease để instance khác nhận ngay, không phải chờ hết ttl
+            owned = self.leased_shards()
+            if owned:
+                await self._release(owned)
+            try:
+                await self._client.zrem(self._members_key, self.instance_id)
+            except Exception:
+                pass
+            await self._client.aclose()
+            self._client = None
+
+    # ---------- lease ----------
+    @property
+    def _members_key(self):
+        return f"{self.prefix}:members"
+
+    def _lease_key(self, shard: int) -> str:
+        return f"{self.prefix}:lease:{shard}"
+
+    async def _heartbeat(self):
+        wall = time.time()
+        pipe = self._client.pipeline(transaction=False)
+        pipe.zadd(self._members_key, {self.instance_id: wall + self.lease_ttl})
+        pipe.zremrangebyscore(self._members_key, "-inf", wall)
+        pipe.zcard(self._members_key)
+        _, _, live = await pipe.execute()
+        self.live_members = max(1, int(live))
+
+    async def _renew(self):
+        ttl_ms = int(self.lease_ttl * 1000)
+        lost = []
+        for shard in list(self._owned):
+            sent = time.monotonic()
+            try:
+                ok = await self._client.eval(RENEW_SCRIPT, 1, self._lease_key(shard), self.instance_id, ttl_ms)
+            except Exception as e:
+                print(f"{now()} ⚠️ Renew lease shard {shard} failed: {repr(e)}")
+                ok = None
+            if ok:
+                self._owned[shard] = sent + self.lease_ttl - self.margin
+            elif ok == 0 or not self.owns_shard(shard):
+                # lease đã thuộc instance khác, hoặc không gia hạn được tới khi hết hạn
+                lost.append(shard)
+        if lost:
+            for shard in lost:
+                self._owned.pop(shard, None)
+            self._releasing.difference_update(lost)
+            print(f"{now()} ⚠️ Mất lease shard {lost}")
+            # state local của các shard này có thể đã cũ so với chủ mới → main loop bỏ đi, không checkpoint
+            self._queue("lost", lost)
+
+    async def _release(self, shards):
+        """Checkpoint rồi nhả lease; chạy trong main loop (apply_transitions / stop)."""
+        if self.on_release is not None:
+            # checkpoint state trước khi nhả để instance nhận shard đọc được state mới nhất
+            await self.on_release(shards)
+        for shard in shards:
+            self._owned.pop(shard, None)
+            try:
+                await self._client.eval(RELEASE_SCRIPT, 1, self._lease_key(shard), self.instance_id)
+            except Exception as e:
+                print(f"{now()} ⚠️ Release lease shard {shard} failed: {repr(e)}")
+
+    async def _acquire(self, want: int):
+        ttl_ms = int(self.lease_ttl * 1000)
+        acquired = []
+        # mỗi instance bắt đầu dò từ 1 vị trí khác nhau để giảm tranh chấp
+        start = zlib.crc32(self.instance_id.encode("utf-8")) % self.shard_count
+        for i in range(self.shard_count):
+            if len(acquired) >= want:
+                break
+            shard = (start + i) % self.shard_count
+            if shard in self._owned:
+                continue
+            sent = time.monotonic()
+            try:
+                ok = await self._client.set(self._lease_key(shard), self.instance_id, nx=True, px=ttl_ms)
+            except Exception as e:
+                print(f"{now()} ⚠️ Acquire lease shard {shard} failed: {repr(e)}")
+                break
+            if ok:
+                self._owned[shard] = sent + self.lease_ttl - self.margin
+                acquired.append(shard)
+        if acquired:
+            self._acquiring.update(acquired)
+            self._queue("acquire", acquired)
+        return acquired
+
+    async def rebalance(self):
+        """Chạy trong task nền: heartbeat, gia hạn, lấy thêm lease; nạp / nhả state thì xếp hàng cho main loop."""
+        await self._heartbeat()
+        await self._renew()
+        target = self.target()
+        owned = [s for s in self.leased_shards() if s not in self._releasing]
+        if len(owned) > target:
+            extra = owned[target:]
+            self._releasing.update(extra)
+            self._queue("release", extra)
+            print(f"{now()} 🧩 Nhả {len(extra)} shard cho instance khác ({self.live_members} instance)")
+        elif len(owned) < target:
+            acquired = await self._acquire(target - len(owned))
+            if acquired:
+                print(f"{now()} 🧩 Nhận {len(acquired)} shard → giữ {len(self.leased_shards())}/{self.shard_count}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                await self.rebalance()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{now()} ⚠️ Shard rebalance error: {repr(e)}")
+
+
+class ShardEventBus:
+    """
+    Chuyển webhook event tới instance đang giữ shard của room qua Redis pub/sub, kênh {prefix}:events:{shard}.
+    LiveKit gửi mỗi webhook tới đúng 1 receiver (load balancer chọn 1 instance), nên instance nhận event của room
+    thuộc shard khác phải publish sang kênh của shard đó; mỗi instance subscribe kênh các shard đang giữ.
+      - forward(room, payload): publish; chưa ai nghe (shard đang đổi chủ) → thử lại vài lần, vẫn không được thì
+        để vòng quét reconcile xử lý room đó
+      - on_event(payload): coroutine nhận payload (bytes) của event thuộc shard mình
+    """
+
+    def __init__(self, shard_manager: ShardManager, on_event, host: str, port: int, password: str = None,
+                 prefix: str = None, db: int = 0, retries: int = 3, retry_delay: float = 0.5):
+        self.shard_manager = shard_manager
+        self.on_event = on_event
+        self.prefix = prefix or shard_manager.prefix
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._conn = dict(host=host, port=port, password=password or None, db=db)
+        self._client = None
+        self._pubsub = None
+        self._subscribed = set()
+        self._task = None
+        self._pending = set()  # task forward đang thử lại
+
+    def channel(self, shard: int) -> str:
+        return f"{self.prefix}:events:{shard}"
+
+    async def start(self):
+        if aioredis is None:
+            raise RuntimeError("Sharded mode cần redis-py (redis.asyncio)")
+        self._client = aioredis.Redis(**self._conn, socket_connect_timeout=3)
+        self._pubsub = self._client.pubsub()
+        await self.sync_subscriptions()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._task, *self._pending):
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(t for t in (self._task, *self._pending) if t is not None), return_exceptions=True)
+        self._task = None
+        self._pending.clear()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def sync_subscriptions(self):
+        """Subscribe đúng các kênh của shard đang giữ; chỉ gọi từ _run (1 connection pubsub, không dùng song song)."""
+        if self._pubsub is None:
+            return
+        # cả shard chưa nạp xong state: event tới sớm nằm trong queue, main loop áp chuyển giao trước khi xử lý
+        owned = set(self.shard_manager.leased_shards())
+        added = owned - self._subscribed
+        removed = self._subscribed - owned
+        if added:
+            await self._pubsub.subscribe(*(self.channel(s) for s in added))
+        if removed:
+            await self._pubsub.unsubscribe(*(self.channel(s) for s in removed))
+        self._subscribed = owned
+
+    async def forward(self, room_name: str, payload: bytes) -> bool:
+        """Publish event sang chủ shard của room; True nếu có instance nhận."""
+        shard = shard_of(room_name, self.shard_manager.shard_count)
+        data = base64.b64encode(payload)
+        try:
+            if await self._client.publish(self.channel(shard), data):
+                return True
+        except Exception as e:
+            print(f"{now()} ⚠️ Forward event {room_name} → shard {shard} lỗi: {repr(e)}")
+        task = asyncio.create_task(self._retry(room_name, shard, data))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return False
+
+    async def _retry(self, room_name: str, shard: int, data: bytes):
+        for _ in range(self.retries):
+            await asyncio.sleep(self.retry_delay)
+            try:
+                if await self._client.publish(self.channel(shard), data):
+                    return
+            except Exception:
+                pass
+        print(f"{now()} ⚠️ Shard {shard} chưa có chủ nhận event {room_name} → để vòng quét reconcile xử lý")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync_subscriptions()
+                if not self._subscribed:
+                    await asyncio.sleep(1.0)
+                    continue
+                msg = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if msg and msg.get("type") == "message":
+                    await self.on_event(base64.b64decode(msg["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{now()} ⚠️ Shard event bus lỗi: {repr(e)}")
+                await asyncio.sleep(1.0)
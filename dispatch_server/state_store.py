@@ -0,0 +1,276 @@
+import json
+import time
+
+# optional redis (async client). Thiếu module thì store chỉ là no-op, dispatcher chạy như cũ.
+try:
+    import redis.asyncio as aioredis
+except Exception:
+    aioredis = None
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+_MISSING = object()
+
+
+class TrackedDict(dict):
+    """dict ghi tên room (key) vừa đổi vào dirty (set dùng chung) → checkpoint chỉ serialize room đã đổi."""
+
+    def __init__(self, dirty, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = dirty
+
+    def __setitem__(self, key, value):
+        if self.get(key, _MISSING) != value:
+            self.dirty.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty.add(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.dirty.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.dirty.update(self)
+        super().clear()
+
+
+class TrackedSet(set):
+    """set ghi tên room vừa thêm / bỏ vào dirty (set dùng chung)."""
+
+    def __init__(self, dirty, *args):
+        super().__init__(*args)
+        self.dirty = dirty
+
+    def add(self, item):
+        if item not in self:
+            self.dirty.add(item)
+        super().add(item)
+
+    def discard(self, item):
+        if item in self:
+            self.dirty.add(item)
+        super().discard(item)
+
+    def remove(self, item):
+        super().remove(item)
+        self.dirty.add(item)
+
+    def pop(self):
+        item = super().pop()
+        self.dirty.add(item)
+        return item
+
+    def clear(self):
+        self.dirty.update(self)
+        super().clear()
+
+
+class DispatcherState:
+    """
+    Các dict/set trạng thái của dispatcher (dùng chung by-reference với dispatch.py, egress_manager, ...).
+    Mỗi room được đóng gói thành 1 record gọn để checkpoint:
+      d=dispatched, f=doctor_first, e=egress_id, r=recording, p=filepath, i=ingress triggered,
+      s=[count_all, count_egress, identities, recording] (last_room_state)
+    dirty: room có state đổi từ lần checkpoint trước (dict/set là TrackedDict / TrackedSet tự ghi vào);
+    None = không theo dõi, mỗi lần flush so toàn bộ room.
+    """
+
+    def __init__(self, dispatched_rooms, doctor_first_rooms, egress_map, room_recording,
+                 room_filepath, ingress_state, last_room_state, dirty=None):
+        self.dispatched_rooms = dispatched_rooms
+        self.doctor_first_rooms = doctor_first_rooms
+        self.egress_map = egress_map
+        self.room_recording = room_recording
+        self.room_filepath = room_filepath
+        self.ingress_state = ingress_state
+        self.last_room_state = last_room_state
+        self.dirty = dirty
+
+    def room_names(self):
+        return (
+            set(self.dispatched_rooms) | set(self.doctor_first_rooms) | set(self.egress_map)
+            | {r for r, v in self.room_recording.items() if v} | set(self.room_filepath)
+            | {r for r, v in self.ingress_state.items() if v} | set(self.last_room_state)
+        )
+
+    def tracked_rooms(self):
+        """Mọi room còn key trong state (kể cả recording / ingress = False)."""
+        return self.room_names() | set(self.room_recording) | set(self.ingress_state)
+
+    def take_dirty(self):
+        """Room cần checkpoint lại; None nếu không theo dõi dirty (→ so toàn bộ)."""
+        if self.dirty is None:
+            return None
+        rooms = set(self.dirty)
+        self.dirty.clear()
+        return rooms
+
+    def mark_dirty(self, rooms):
+        if self.dirty is not None:
+            self.dirty.update(rooms)
+
+    def record(self, room_name: str) -> dict:
+        rec = {}
+        if room_name in self.dispatched_rooms:
+            rec["d"] = 1
+        if room_name in self.doctor_first_rooms:
+            rec["f"] = 1
+        if self.egress_map.get(room_name):
+            rec["e"] = self.egress_map[room_name]
+        if self.room_recording.get(room_name):
+            rec["r"] = 1
+        if self.room_filepath.get(room_name):
+            rec["p"] = self.room_filepath[room_name]
+        if self.ingress_state.get(room_name):
+            rec["i"] = 1
+        last = self.last_room_state.get(room_name)
+        if last:
+            rec["s"] = [last.get("count_all"), last.get("count_egress"),
+                        sorted(last.get("identities") or ()), bool(last.get("recording"))]
+        return rec
+
+    def apply(self, room_name: str, rec: dict):
+        if rec.get("d"):
+            self.dispatched_rooms.add(room_name)
+        if rec.get("f"):
+            self.doctor_first_rooms.add(room_name)
+        if rec.get("e"):
+            self.egress_map[room_name] = rec["e"]
+        if rec.get("r"):
+            self.room_recording[room_name] = True
+        if rec.get("p"):
+            self.room_filepath[room_name] = rec["p"]
+        if rec.get("i"):
+            self.ingress_state[room_name] = True
+        if rec.get("s"):
+            count_all, count_egress, identities, recording = rec["s"]
+            self.last_room_state[room_name] = {
+                "count_all": count_all,
+                "count_egress": count_egress,
+                "identities": set(identities),
+                "recording": recording,
+            }
+
+    def forget(self, room_name: str):
+        self.dispatched_rooms.discard(room_name)
+        self.doctor_first_rooms.discard(room_name)
+        self.egress_map.pop(room_name, None)
+        self.room_recording.pop(room_name, None)
+        self.room_filepath.pop(room_name, None)
+        self.ingress_state.pop(room_name, None)
+        self.last_room_state.pop(room_name, None)
+
+
+class StateStore:
+    """
+    Checkpoint DispatcherState vào 1 Redis hash (field = room_name, value = record JSON).
+      - flush(): chỉ serialize room dirty, so với lần ghi trước, HSET room đổi / HDEL room đã hết state (1 pipeline)
+      - load(): đọc lại hash khi khởi động (hoặc khi nhận thêm shard ở sharded mode)
+    Redis lỗi thì chỉ log; lần flush sau ghi lại phần chưa lưu được.
+    """
+
+    def __init__(self, state: DispatcherState, host: str, port: int, password: str = None,
+                 key: str = "dispatcher:state", db: int = 0):
+        self.state = state
+        self.key = key
+        self._conn = dict(host=host, port=port, password=password or None, db=db)
+        self._client = None
+        self._persisted = {}  # room_name -> JSON đã ghi
+
+    async def _ensure_client(self):
+        if self._client is None and aioredis is not None:
+            self._client = aioredis.Redis(
+                **self._conn, decode_responses=True, socket_connect_timeout=3, socket_timeout=3,
+            )
+        return self._client
+
+    async def load(self, include=None) -> int:
+        """
+        Nạp state đã checkpoint vào DispatcherState. Trả về số room nạp được.
+        include(room_name) -> bool: chỉ nạp các room này (sharded mode: room thuộc shard của instance).
+        """
+        client = await self._ensure_client()
+        if client is None:
+            return 0
+        try:
+            raw = await client.hgetall(self.key)
+        except Exception as e:
+            print(f"{now()} ⚠️ Load dispatcher state failed: {repr(e)}")
+            return 0
+        loaded = 0
+        for room_name, value in raw.items():
+            if include is not None and not include(room_name):
+                continue
+            try:
+                rec = json.loads(value)
+                self.state.apply(room_name, rec)
+            except Exception:
+                continue
+            self._persisted[room_name] = value
+            loaded += 1
+        return loaded
+
+    def discard(self, rooms):
+        """Bỏ theo dõi các room (đã chuyển cho instance khác) mà không xóa checkpoint của chúng."""
+        for room_name in rooms:
+            self._persisted.pop(room_name, None)
+
+    async def flush(self):
+        client = await self._ensure_client()
+        if client is None:
+            return
+        rooms = self.state.take_dirty()
+        if rooms is None:
+            rooms = self.state.room_names() | set(self._persisted)
+        changed, removed = {}, []
+        for room_name in rooms:
+            rec = self.state.record(room_name)
+            if rec:
+                value = json.dumps(rec, separators=(",", ":"))
+                if self._persisted.get(room_name) != value:
+                    changed[room_name] = value
+            elif room_name in self._persisted:
+                removed.append(room_name)
+        if not changed and not removed:
+            return
+        try:
+            pipe = client.pipeline(transaction=False)
+            if changed:
+                pipe.hset(self.key, mapping=changed)
+            if removed:
+                pipe.hdel(self.key, *removed)
+            await pipe.execute()
+        except Exception as e:
+            print(f"{now()} ⚠️ Checkpoint dispatcher state failed: {repr(e)}")
+            # lần flush sau ghi lại
+            self.state.mark_dirty(changed.keys() | set(removed))
+            return
+        self._persisted.update(changed)
+        for room_name in removed:
+            self._persisted.pop(room_name, None)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
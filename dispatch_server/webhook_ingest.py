@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from aiohttp import web
+from livekit import api
+
+# Các event LiveKit mà dispatcher quan tâm; các event khác (track_published, ...) bỏ qua
+HANDLED_EVENTS = {
+    "room_started",
+    "room_finished",
+    "participant_joined",
+    "participant_left",
+    "egress_ended",
+}
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+def event_room_name(event) -> str:
+    """Lấy room_name từ webhook event (room / egress_info / ingress_info tùy loại event)."""
+    if event.HasField("room") and event.room.name:
+        return event.room.name
+    if event.HasField("egress_info") and event.egress_info.room_name:
+        return event.egress_info.room_name
+    if event.HasField("ingress_info") and event.ingress_info.room_name:
+        return event.ingress_info.room_name
+    return ""
+
+
+class WebhookIngest:
+    """
+    HTTP receiver cho LiveKit webhook.
+    - Verify chữ ký (JWT + sha256 body) bằng api.WebhookReceiver
+    - Đẩy event hợp lệ vào queue để dispatcher xử lý tuần tự
+    - Gộp event theo room: nhiều event dồn dập của cùng 1 room chỉ xử lý 1 lần
+    - forward(room_name, event): coroutine tùy chọn (sharded mode), trả về True nếu event đã được chuyển
+      cho instance khác (room không thuộc shard của mình) → không xếp vào queue local
+    """
+
+    def __init__(self, api_key: str, api_secret: str, path: str = "/webhook", forward=None):
+        self._receiver = api.WebhookReceiver(api.TokenVerifier(api_key, api_secret))
+        self._path = path
+        self._forward = forward
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending = {}  # room_name -> list[event] chưa được xử lý
+        self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        body = await request.text()
+        auth_token = request.headers.get("Authorization", "")
+        if auth_token.lower().startswith("bearer "):
+            auth_token = auth_token[7:]
+        try:
+            event = self._receiver.receive(body, auth_token)
+        except Exception as e:
+            print(f"{now()} ⚠️ Webhook bị từ chối (chữ ký không hợp lệ): {repr(e)}")
+            return web.Response(status=401)
+
+        if event.event not in HANDLED_EVENTS:
+            return web.Response(status=200)
+
+        room_name = event_room_name(event)
+        if not room_name:
+            return web.Response(status=200)
+
+        if self._forward is not None and await self._forward(room_name, event):
+            return web.Response(status=200)
+        self.push(room_name, event)
+        return web.Response(status=200)
+
+    def push(self, room_name: str, event):
+        """Xếp 1 event (nhận trực tiếp hoặc do instance khác chuyển sang) vào queue theo room."""
+        if room_name in self._pending:
+            self._pending[room_name].append(event)
+        else:
+            self._pending[room_name] = [event]
+            self._queue.put_nowait(room_name)
+
+    async def next_room(self):
+        """Chờ room kế tiếp có event; trả về (room_name, [events])."""
+        room_name = await self._queue.get()
+        events = self._pending.pop(room_name, [])
+        return room_name, events
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_post(self._path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"{now()} 📡 Webhook receiver đang lắng nghe tại http://{host}:{port}{self._path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
 import asyncio
+from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime
 
 import aiohttp
-import redis
 
 from livekit.agents import Agent, AgentSession, ConversationItemAddedEvent, RunContext, function_tool
 # event types referenced in handlers (may be provided by livekit SDK)
@@ -18,6 +19,10 @@ from livekit.plugins.turn_detector.multilingual import MultilingualModel
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# cho phép import utils_ khi chạy trực tiếp `python pre-checkup/ask_sick_with_tool.py`
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils_.connect_redis import room_registry
+
 # -------------------------
 # Configuration / Constants
 # -------------------------
@@ -32,32 +37,18 @@ PATIENT_SENDER_ID = "456"                 # cố định cho patient (user)
 EMPLOYEE_RECEIVE_ID = EMPLOYEE_SENDER_ID
 PATIENT_RECEIVE_ID = PATIENT_SENDER_ID
 WEBHOOK_URL = "https://com-hub.dev.longvan.vn/com-hub/v1/web-hook/sendMessage/AICHAT"
-# Redis client (synchronous redis-py client)
-r = redis.Redis(
-    host='redis-connect.dev.longvan.vn',
-    port=32276,
-    password='111111aA',
-    decode_responses=True
-)
 
 
 # -------------------------
 # Redis helper
 # -------------------------
-def get_topic_id_by_room(room_name: str) -> str | None:
-    """Lấy topicId từ Redis theo roomName"""
-    hash_key = "room:online"
-    value_json = r.hget(hash_key, room_name)
-    if not value_json:
+async def get_topic_id_by_room(room_name: str) -> str | None:
+    """Lấy topicId theo roomName từ Redis (room registry: cache ngắn, HGET room:online khi miss / hết hạn)"""
+    data = await room_registry.get_room_data(room_name)
+    if not data:
         print(f"[WARN] Không tìm thấy room {room_name} trong Redis", flush=True)
         return None
-    try:
-        data = json.loads(value_json)
-        topic_id = data.get("topicId")
-        return topic_id
-    except Exception as e:
-        print(f"[ERROR] Lỗi decode JSON room={room_name}: {e}", flush=True)
-        return None
+    return data.get("topicId")
 
 
 # -------------------------
@@ -280,7 +271,7 @@ async def entrypoint(ctx):
 
         topic_id = None
         if room_name:
-            topic_id = get_topic_id_by_room(room_name)
+            topic_id = await get_topic_id_by_room(room_name)
         if not topic_id:
             topic_id = FIXED_TOPIC_ID
         return room_name, topic_id
@@ -373,7 +364,7 @@ async def entrypoint(ctx):
 
             topic_id = None
             if room_name:
-                topic_id = get_topic_id_by_room(room_name)
+                topic_id = await get_topic_id_by_room(room_name)
             if not topic_id:
                 topic_id = FIXED_TOPIC_ID
 
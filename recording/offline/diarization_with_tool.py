@@ -1,12 +1,13 @@
 import asyncio
 import re
 import json
+import sys
+from pathlib import Path
 from datetime import datetime
 from typing import AsyncIterable, Optional
 from dotenv import load_dotenv
 import os
 import aiohttp
-import redis
 from livekit.api import LiveKitAPI, ListParticipantsRequest
 from livekit.agents import WorkerOptions, JobRequest
 from livekit import agents, rtc
@@ -16,6 +17,10 @@ from livekit.agents import stt as agents_stt
 
 load_dotenv()
 
+# cho phép import utils_ khi chạy trực tiếp `python recording/offline/diarization_with_tool.py`
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from utils_.connect_redis import room_registry
+
 # --- Config ---
 GRAPHQL_URL = os.getenv("GRAPHQL_URL", "https://crm-ticket-gateway.dev.longvan.vn/crm-graph-gateway/graphql")
 WEBHOOK_URL = "https://com-hub.dev.longvan.vn/com-hub/v1/web-hook/sendMessage/AICHAT"
@@ -23,13 +28,6 @@ CHANNEL_ID = "68aedccde472aa8afe432664"
 CUSTOMER_ID = "123"
 OTHER_CUSTOMER_ID = "321"
 
-r = redis.Redis(
-    host='redis-connect.dev.longvan.vn',
-    port=32276,
-    password='111111aA',
-    decode_responses=True
-)
-
 SPEAKER_TAG_RE = re.compile(r"\[SP(\d+)\]\s*(.*)", re.DOTALL)
 async def get_current_participants(room_name: str) -> list:
     """Trả về danh sách participant thực tế trong room"""
@@ -44,24 +42,15 @@ async def get_current_participants(room_name: str) -> list:
         return []
 
 # --- Redis / GraphQL helpers ---
-def get_topic_id_by_room(room_name: str) -> Optional[str]:
+async def get_topic_id_by_room(room_name: str) -> Optional[str]:
     if not room_name:
         print(f"[WARN] room_name is empty", flush=True)
         return None
-    try:
-        value_json = r.hget("room:online", room_name)
-    except Exception as e:
-        print(f"[ERROR] Redis hget failed for room={room_name}: {e}", flush=True)
-        return None
-    if not value_json:
+    data = await room_registry.get_room_data(room_name)
+    if not data:
         print(f"[WARN] Không tìm thấy room {room_name} trong Redis", flush=True)
         return None
-    try:
-        data = json.loads(value_json)
-        return data.get("topicId")
-    except Exception as e:
-        print(f"[ERROR] Lỗi decode JSON room={room_name}: {e}", flush=True)
-        return None
+    return data.get("topicId")
 
 async def assign_topic_to_doctor(room_name: str, topic_id: str) -> Optional[str]:
     if not topic_id:
@@ -127,20 +116,14 @@ async def send_message_to_webhook(message: dict):
             print(f"[WEBHOOK ERROR] {message['senderName']} ➜ {message['content']} | Error: {e}", flush=True)
 
 
-def get_room_data(room_name: str) -> dict:
-    """Trả về dict chứa topicId và prescriptionId"""
+async def get_room_data(room_name: str) -> dict:
+    """Trả về dict chứa topicId và prescriptionId (room registry: HGET room:online, cache tối đa cache_ttl giây)"""
     if not room_name:
         return {}
-    try:
-        value_json = r.hget("room:online", room_name)
-        if not value_json:
-            print(f"[WARN] Không tìm thấy room {room_name} trong Redis", flush=True)
-            return {}
-        data = json.loads(value_json)
-        return data
-    except Exception as e:
-        print(f"[ERROR] Lỗi lấy room data từ Redis room={room_name}: {e}", flush=True)
-        return {}
+    data = await room_registry.get_room_data(room_name)
+    if not data:
+        print(f"[WARN] Không tìm thấy room {room_name} trong Redis", flush=True)
+    return data
 # --- bổ sung hàm đóng topic ---
 async def close_topic(topic_id: str):
     if not topic_id:
@@ -343,7 +326,7 @@ Trả về JSON với các field: chiefComplaint, medicalHistory, symptoms, các
             print(f"✅ OpenAI summary: {summary}", flush=True)
 
             # --- lấy prescriptionId từ Redis ---
-            room_data = get_room_data(room_name)
+            room_data = await get_room_data(room_name)
             prescriptionId = room_data.get("prescriptionId")
             if not prescriptionId:
                 print(f"[WARN] Không tìm thấy prescriptionId cho room {ctx.room.name}, bỏ qua fill_medical_form")
@@ -1,11 +1,16 @@
 import os
+import sys
 import asyncio
 import time
+from pathlib import Path
 from dotenv import load_dotenv
 from livekit import api
-import requests
 import datetime
 
+# dùng chung logic retry / đối chiếu egress với dispatcher
+sys.path.append(str(Path(__file__).resolve().parents[1] / "dispatch_server"))
+from egress_manager import is_retryable, egress_filepath
+
 # --- Load env ---
 load_dotenv()
 LIVEKIT_URL = os.getenv("LIVEKIT_URL")
@@ -21,19 +26,11 @@ CHECK_INTERVAL = 5  # giây
 egress_map = {}        # room_name -> egress_id
 room_recording = {}    # room_name -> bool
 room_filepath = {}     # room_name -> current file path
+egress_tasks = {}      # room_name -> asyncio.Task start/stop đang chạy (chống double-start)
 
 def now():
     return time.strftime("[%H:%M:%S]")
 
-# --- Token helper ---
-def create_egress_token(room_name: str) -> str:
-    grants = api.VideoGrants(room_record=True, room_join=True, room=room_name)
-    token = api.AccessToken(LIVEKIT_API_KEY, LIVEKIT_API_SECRET)
-    token.identity = f"egress_agent_{room_name}"
-    token.with_grants(grants)
-    token.ttl = datetime.timedelta(hours=1)
-    return token.to_jwt()
-
 # --- Safe participant list ---
 async def safe_list_participants(lkapi, room_name):
     try:
@@ -43,66 +40,85 @@ async def safe_list_participants(lkapi, room_name):
         print(f"{now()} ⚠️ list_participants failed for {room_name}: {repr(e)}")
         return []
 
+# --- Egress active của room mà script chưa biết (start trước đó đã thành công phía server) ---
+async def find_active_egress(lkapi, room_name: str):
+    resp = await asyncio.wait_for(
+        lkapi.egress.list_egress(api.ListEgressRequest(room_name=room_name, active=True)), timeout=10
+    )
+    known = set(egress_map.values())
+    for info in resp.items:
+        if info.egress_id not in known:
+            return info
+    return None
+
 # --- Start egress ---
-# --- Start egress ---
-def start_egress(room_name: str):
+async def start_egress(lkapi, room_name: str):
     if room_recording.get(room_name, False):
         print(f"{now()} ⏳ Room {room_name} đang record rồi, bỏ qua start.")
         return
 
-    jwt = create_egress_token(room_name)
-    headers = {"Authorization": f"Bearer {jwt}", "Content-Type": "application/json"}
     now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     filepath = f"clinic/recordings/{room_name}_{now_str}.mp4"
 
-    payload = {
-        "room_name": room_name,
-        "file_outputs": [{"filepath": filepath, "file_type": "MP4"}],
-        "advanced": {
-            "width": 1280,
-            "height": 720,
-            "framerate": 30,
-            "video_codec": "H264_MAIN",
-            "video_bitrate": 1000,       # kbps
-            "key_frame_interval": 4,
-            "audio_codec": "AAC",
-            "audio_bitrate": 96,
-            "audio_frequency": 22050
-        }
-    }
-
-    url = f"{LIVEKIT_URL}/twirp/livekit.Egress/StartRoomCompositeEgress"
+    req = api.RoomCompositeEgressRequest(
+        room_name=room_name,
+        file_outputs=[api.EncodedFileOutput(filepath=filepath, file_type=api.EncodedFileType.MP4)],
+        advanced=api.EncodingOptions(
+            width=1280,
+            height=720,
+            framerate=30,
+            video_codec=api.VideoCodec.H264_MAIN,
+            video_bitrate=1000,       # kbps
+            key_frame_interval=4,
+            audio_codec=api.AudioCodec.AAC,
+            audio_bitrate=96,
+            audio_frequency=22050,
+        ),
+    )
 
-    try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=15)
-        resp.raise_for_status()
-        egress_id = resp.json().get("egress_id")
-        egress_map[room_name] = egress_id
-        room_recording[room_name] = True
-        room_filepath[room_name] = filepath
-        print(f"{now()} 🚀 Room {room_name} có ≥{MIN_PARTICIPANTS} người thực → Bắt đầu record")
-        print(f"{now()} 📁 Video sẽ lưu tại: {filepath}")
-    except Exception as e:
-        print(f"{now()} ❌ Failed to start egress for {room_name}: {repr(e)}")
+    # start không idempotent: chỉ gửi lại khi chắc chắn server chưa tạo egress,
+    # lỗi không rõ (timeout, mất kết nối giữa chừng) thì đối chiếu list_egress và nhận lại egress đã start
+    info = None
+    for attempt in range(1, 4):
+        try:
+            info = await asyncio.wait_for(lkapi.egress.start_room_composite_egress(req), timeout=15)
+            break
+        except Exception as e:
+            print(f"{now()} ❌ Failed to start egress for {room_name} (lần {attempt}): {repr(e)}")
+            if not is_retryable(e, idempotent=False):
+                if isinstance(e, api.TwirpError):
+                    return  # server từ chối rõ ràng → không start
+                try:
+                    info = await find_active_egress(lkapi, room_name)
+                except Exception as le:
+                    print(f"{now()} ⚠️ Không đối chiếu được egress {room_name}: {repr(le)} → không start lại")
+                    return
+                if info is not None:
+                    print(f"{now()} ♻️ Server đã có egress {info.egress_id} cho {room_name} → nhận lại")
+                    filepath = egress_filepath(info) or filepath
+                    break
+            if attempt < 3:
+                await asyncio.sleep(2 ** (attempt - 1))
+    if info is None:
+        return
+
+    egress_map[room_name] = info.egress_id
+    room_recording[room_name] = True
+    room_filepath[room_name] = filepath
+    print(f"{now()} 🚀 Room {room_name} có ≥{MIN_PARTICIPANTS} người thực → Bắt đầu record")
+    print(f"{now()} 📁 Video sẽ lưu tại: {filepath}")
 
 # --- Stop egress ---
-def stop_egress(room_name: str):
+async def stop_egress(lkapi, room_name: str):
     egress_id = egress_map.get(room_name)
     if not egress_id:
         room_recording[room_name] = False
         return
 
-    jwt = create_egress_token(room_name)
-    headers = {"Authorization": f"Bearer {jwt}", "Content-Type": "application/json"}
-    url = f"{LIVEKIT_URL}/twirp/livekit.Egress/StopEgress"
-
     try:
-        resp = requests.post(url, headers=headers, json={"egress_id": egress_id}, timeout=10)
-        if resp.ok:
-            print(f"{now()} 🛑 Room {room_name} dưới {MIN_PARTICIPANTS} người thực → Dừng record")
-            print(f"{now()} 📁 Video đã lưu tại: {room_filepath.get(room_name)}")
-        else:
-            print(f"{now()} ❌ Stop failed for {room_name}: {resp.status_code} {resp.text}")
+        await asyncio.wait_for(lkapi.egress.stop_egress(api.StopEgressRequest(egress_id=egress_id)), timeout=10)
+        print(f"{now()} 🛑 Room {room_name} dưới {MIN_PARTICIPANTS} người thực → Dừng record")
+        print(f"{now()} 📁 Video đã lưu tại: {room_filepath.get(room_name)}")
     except Exception as e:
         print(f"{now()} ❌ Stop egress error for {room_name}: {repr(e)}")
 
@@ -110,6 +126,12 @@ def stop_egress(room_name: str):
     egress_map.pop(room_name, None)
     room_filepath.pop(room_name, None)
 
+def run_egress_task(room_name: str, coro):
+    """Chạy start/stop ở background để vòng monitor không bị block; mỗi room 1 task tại 1 thời điểm."""
+    task = asyncio.create_task(coro)
+    egress_tasks[room_name] = task
+    task.add_done_callback(lambda t: egress_tasks.pop(room_name, None))
+
 # --- Main monitor loop ---
 async def monitor_record_rooms():
     lkapi = api.LiveKitAPI(
@@ -143,11 +165,15 @@ async def monitor_record_rooms():
                 print(f"{now()} 👥 Room {room_name} hiện có {count_real} participant(s) thực: {[p.identity for p in real_participants]}")
                 print(f"{now()} Debug: recording={recording}, egress_map={egress_map.get(room_name)}")
 
+                if room_name in egress_tasks:
+                    print(f"{now()} ⏳ Room {room_name} đang start/stop egress, đợi vòng sau")
+                    continue
+
                 # --- Logic start/stop ---
                 if count_real >= MIN_PARTICIPANTS and not recording:
-                    start_egress(room_name)
+                    run_egress_task(room_name, start_egress(lkapi, room_name))
                 elif count_real < MIN_PARTICIPANTS and recording:
-                    stop_egress(room_name)
+                    run_egress_task(room_name, stop_egress(lkapi, room_name))
                 else:
                     print(f"{now()} ⏹ Không thay đổi trạng thái record cho {room_name}")
 
@@ -1,13 +1,15 @@
 from fastmcp import FastMCP
-import requests
-from datetime import datetime, time
+import asyncio
+import time as _time
+import bisect
+import heapq
+from itertools import islice
+from urllib.parse import urlsplit
+import httpx
+from datetime import datetime, time, timedelta
 import logging
-import requests
-import logging
-from datetime import datetime, time
 #from dateutil import parser
 import os
-import requests
 from dotenv import load_dotenv
 from langchain.schema import HumanMessage, SystemMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -44,6 +46,388 @@ FIXED_PAYLOAD = {
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ==================== HTTP CLIENT ==================== #
+# HTTP/2 cần package h2 (pip install "httpx[http2]"); thiếu thì dùng HTTP/1.1 keep-alive
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+HTTP_MAX_KEEPALIVE_PER_HOST = int(os.getenv("HTTP_MAX_KEEPALIVE_PER_HOST", "10"))
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+
+# 1 AsyncClient / host (user-gateway, portal, ...): connection pool + TLS session dùng lại giữa các tool call,
+# giới hạn connection tính riêng cho từng host
+_http_clients = {}
+
+
+def http_client(url: str) -> httpx.AsyncClient:
+    host = urlsplit(url).netloc
+    client = _http_clients.get(host)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=HTTP2,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_PER_HOST,
+                keepalive_expiry=60,
+            ),
+        )
+        _http_clients[host] = client
+    return client
+
+
+async def http_get(url: str, timeout: float = None, **kwargs) -> httpx.Response:
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    return await http_client(url).get(url, **kwargs)
+
+
+async def http_post(url: str, timeout: float = None, **kwargs) -> httpx.Response:
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    return await http_client(url).post(url, **kwargs)
+
+# ==================== CUSTOMER INDEX ==================== #
+CUSTOMER_REFRESH_INTERVAL = float(os.getenv("CUSTOMER_REFRESH_INTERVAL", "300"))  # refresh nền (giây)
+CUSTOMER_MISS_REFRESH_INTERVAL = float(os.getenv("CUSTOMER_MISS_REFRESH_INTERVAL", "30"))  # miss → tải lại tối đa 1 lần / N giây
+
+
+def normalize_phone(phone) -> str:
+    """Chuẩn hóa SĐT VN về dạng 0xxxxxxxxx: bỏ ký tự không phải số, +84 / 84 → 0."""
+    digits = "".join(ch for ch in str(phone or "") if ch.isdigit())
+    if digits.startswith("84") and len(digits) >= 11:
+        digits = "0" + digits[2:]
+    elif digits and not digits.startswith("0") and len(digits) == 9:
+        digits = "0" + digits
+    return digits
+
+
+class CustomerIndex:
+    """
+    Bản sao in-memory của bảng OWNER (danh_sach_khach_hang), index theo SĐT đã chuẩn hóa → tra O(1):
+      - warm(): tải đồng bộ 1 lần lúc start server
+      - refresh nền mỗi refresh_interval giây bằng conditional GET (ETag / Last-Modified), chỉ áp phần thay đổi
+      - upsert(): ghi ngay 1 dòng OWNER đã biết _id; giữ qua các lần load tới khi bảng tải về có dòng đó
+      - invalidate(): SĐT vừa tạo khách bên hệ thống khác (id gateway ≠ _id OWNER) → lookup kế tiếp tải lại ngay
+      - lookup() miss → tải lại 1 lần (tối đa 1 lần / miss_refresh_interval) rồi mới báo không tìm thấy
+    """
+
+    def __init__(self, url: str, refresh_interval: float = CUSTOMER_REFRESH_INTERVAL,
+                 miss_refresh_interval: float = CUSTOMER_MISS_REFRESH_INTERVAL):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self.by_phone = {}
+        self.loaded = False
+        self._pending = {}   # phone -> record upsert chưa có trong bảng tải về
+        self._stale = set()  # phone đã invalidate, miss thì tải lại không chờ miss_refresh_interval
+        self._etag = None
+        self._last_modified = None
+        self._refreshed_at = 0.0
+        self._refresh_task = None
+        self._loop_task = None
+
+    def get(self, phone: str):
+        return self.by_phone.get(normalize_phone(phone))
+
+    def upsert(self, record: dict):
+        key = normalize_phone(record.get("phone"))
+        if key:
+            self.by_phone[key] = self._pending[key] = {**self.by_phone.get(key, {}), **record}
+
+    def invalidate(self, phone: str):
+        key = normalize_phone(phone)
+        if key:
+            self.by_phone.pop(key, None)
+            self._pending.pop(key, None)
+            self._stale.add(key)
+
+    def load(self, owners):
+        """Áp danh sách owner mới vào index (giữ các upsert bảng chưa có); trả về (thêm, sửa, xóa)."""
+        fresh = {}
+        for o in owners or []:
+            key = normalize_phone(o.get("phone"))
+            if key and key not in fresh:
+                fresh[key] = o
+        for key in list(self._pending):
+            if key in fresh:
+                del self._pending[key]
+            else:
+                fresh[key] = self._pending[key]
+        self._stale -= fresh.keys()
+        added = sum(1 for k in fresh if k not in self.by_phone)
+        updated = sum(1 for k, o in fresh.items() if k in self.by_phone and self.by_phone[k] != o)
+        removed = sum(1 for k in self.by_phone if k not in fresh)
+        self.by_phone = fresh
+        self.loaded = True
+        self._refreshed_at = _time.monotonic()
+        return added, updated, removed
+
+    def warm(self):
+        """Tải đồng bộ lúc start (chưa có event loop của MCP server)."""
+        try:
+            res = httpx.get(self.url, timeout=HTTP_TIMEOUT)
+            res.raise_for_status()
+            self._etag = res.headers.get("ETag")
+            self._last_modified = res.headers.get("Last-Modified")
+            self.load(res.json())
+            logger.info(f"👥 Customer index: {len(self.by_phone)} khách hàng")
+        except Exception as e:
+            logger.warning(f"⚠️ Warm customer index lỗi, sẽ tải lại khi có request: {e}")
+
+    async def refresh(self) -> bool:
+        headers = {}
+        if self.loaded:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        res = await http_get(self.url, headers=headers)
+        if res.status_code == 304 and self.loaded:
+            self._refreshed_at = _time.monotonic()
+            return True
+        res.raise_for_status()
+        self._etag = res.headers.get("ETag")
+        self._last_modified = res.headers.get("Last-Modified")
+        added, updated, removed = self.load(res.json())
+        if added or updated or removed:
+            logger.info(f"👥 Customer index: +{added} ~{updated} -{removed} (tổng {len(self.by_phone)})")
+        return True
+
+    def _ensure_refresh(self):
+        # nhiều tool call cùng lúc dùng chung 1 lần tải
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+        return self._refresh_task
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self._ensure_refresh()
+            except Exception as e:
+                logger.warning(f"⚠️ Refresh customer index lỗi: {e}")
+
+    async def lookup(self, phone: str):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+        if not self.loaded:
+            await self._ensure_refresh()
+        key = normalize_phone(phone)
+        record = self.by_phone.get(key)
+        if record is None and (key in self._stale
+                               or _time.monotonic() - self._refreshed_at >= self.miss_refresh_interval):
+            await self._ensure_refresh()
+            record = self.by_phone.get(key)
+        return record
+
+
+customer_index = CustomerIndex(OWNER_API)
+
+
+# ==================== SLOT CACHE ==================== #
+SLOT_CACHE_TTL = float(os.getenv("SLOT_CACHE_TTL", "30"))  # giây; check_slot → create_booking trong TTL chỉ gọi API 1 lần
+
+
+def to_minutes(hhmm: str) -> int:
+    h, m = hhmm.split(":")[:2]
+    return int(h) * 60 + int(m)
+
+
+def floor_minutes(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+
+def ceil_minutes(t: time) -> int:
+    return t.hour * 60 + t.minute + (1 if t.second or t.microsecond else 0)
+
+
+def slot_label(s: dict) -> str:
+    return f"{s['fromTime']}-{s['toTime']}"
+
+
+def slot_key(s: dict):
+    """Định danh 1 slot giữa các lần compile (dict slot được copy lại mỗi lần book)."""
+    return s.get("shiftId"), s.get("fromTime"), s.get("toTime")
+
+
+class SlotIndex:
+    """
+    Slot của 1 (phòng khám, ngày) compile 1 lần sang phút trong ngày:
+      - starts / ends sắp theo giờ bắt đầu, max_end[i] = max(ends[:i+1]) → tìm slot chứa [f, t] bằng bisect
+      - giờ làm việc (start_work, end_work), các khoảng nghỉ giữa 2 slot liên tiếp
+      - free: slot ACTIVE còn chỗ (check_slot), suggested: "HH:MM-HH:MM" các slot còn chỗ (create_booking)
+    Slot thiếu / sai fromTime, toTime bị bỏ qua.
+    """
+
+    def __init__(self, slots):
+        compiled = []
+        for s in slots or []:
+            try:
+                compiled.append((to_minutes(s["fromTime"]), to_minutes(s["toTime"]), s))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                logger.warning(f"⚠️ Bỏ qua slot thiếu / sai giờ: {s}")
+        compiled.sort(key=lambda c: c[0])
+        self.slots = [c[2] for c in compiled]
+        self.starts = [c[0] for c in compiled]
+        self.ends = [c[1] for c in compiled]
+        self.max_end = []
+        for e in self.ends:
+            self.max_end.append(max(e, self.max_end[-1]) if self.max_end else e)
+        self.start_work = self.starts[0] if self.slots else None
+        self.end_work = self.ends[-1] if self.slots else None
+        self.gaps = sorted(
+            (self.ends[i], self.starts[i + 1])
+            for i in range(len(self.slots) - 1)
+            if self.ends[i] < self.starts[i + 1]
+        )
+        self.gap_starts = [g[0] for g in self.gaps]
+        self.free = [
+            {"fromTime": s.get("fromTime"), "toTime": s.get("toTime"), "availableSlot": s.get("availableSlot", 0)}
+            for s in self.slots
+            if s.get("status") == "ACTIVE" and s.get("availableSlot", 0) > 0
+        ]
+        self.suggested = [slot_label(s) for s in self.slots if s.get("availableSlot", 0) > 0]
+
+    def __bool__(self):
+        return bool(self.slots)
+
+    def containing(self, f: int, t: int):
+        """Slot đầu tiên (theo giờ bắt đầu) chứa trọn [f, t], hoặc None."""
+        found = None
+        i = bisect.bisect_right(self.starts, f) - 1
+        # slot phía trước chỉ có thể chứa [f, t] khi max_end của đoạn đó còn >= t
+        while i >= 0 and self.max_end[i] >= t:
+            if self.ends[i] >= t:
+                found = i
+            i -= 1
+        return self.slots[found] if found is not None else None
+
+    def in_gap(self, f: int, t: int) -> bool:
+        i = bisect.bisect_right(self.gap_starts, f) - 1
+        return i >= 0 and t <= self.gaps[i][1]
+
+
+class SlotCache:
+    """
+    Cache slot theo (clinicId, ngày), TTL ngắn:
+      - nhiều tool call cùng key trong lúc đang tải dùng chung 1 request
+      - booking thành công → book() trừ availableSlot của slot vừa đặt (không phải gọi lại API)
+      - invalidate() khi booking lỗi phía server để lần sau đọc lại số liệu thật
+    """
+
+    def __init__(self, url: str, ttl: float = SLOT_CACHE_TTL):
+        self.url = url
+        self.ttl = ttl
+        self._entries = {}   # (clinicId, date) -> (expires_at, SlotIndex)
+        self._inflight = {}  # (clinicId, date) -> task
+
+    async def get(self, clinic_id: str, date: str) -> SlotIndex:
+        key = (clinic_id, date)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > _time.monotonic():
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(clinic_id, date))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, clinic_id: str, date: str) -> SlotIndex:
+        slot_url = f"{self.url}/{clinic_id}/{date}"
+        logger.info(f"🔍 Gọi API slot: {slot_url}")
+        response = await http_get(slot_url)
+        logger.debug(f"🔹 Raw Response ({response.status_code}): {response.text[:200]}")
+        response.raise_for_status()
+        try:
+            data = response.json()
+        except ValueError:
+            raise ValueError(f"Phản hồi không phải JSON hợp lệ: {response.text[:200]}")
+        slots = data if isinstance(data, list) else data.get("data", [])
+        index = SlotIndex(slots)
+        self._entries[(clinic_id, date)] = (_time.monotonic() + self.ttl, index)
+        return index
+
+    def book(self, clinic_id: str, date: str, slot: dict):
+        """Trừ 1 chỗ của slot vừa đặt trong bản cache (nếu còn hạn)."""
+        entry = self._entries.get((clinic_id, date))
+        if entry is None:
+            return
+        key = slot_key(slot)
+        slots = [
+            {**s, "availableSlot": max(0, s.get("availableSlot", 0) - 1)} if slot_key(s) == key else s
+            for s in entry[1].slots
+        ]
+        self._entries[(clinic_id, date)] = (entry[0], SlotIndex(slots))
+
+    def invalidate(self, clinic_id: str, date: str):
+        self._entries.pop((clinic_id, date), None)
+
+
+slot_cache = SlotCache(SLOT_API)
+
+
+# ==================== SLOT SEARCH ==================== #
+SLOT_SEARCH_CONCURRENCY = int(os.getenv("SLOT_SEARCH_CONCURRENCY", "8"))  # số request slot song song tối đa / tool call
+SLOT_SEARCH_MAX_DAYS = int(os.getenv("SLOT_SEARCH_MAX_DAYS", "14"))
+SLOT_SEARCH_MAX_LIMIT = 20
+# buổi trong ngày → [from, to) theo phút
+DAY_WINDOWS = {
+    "sáng": (0, 12 * 60), "morning": (0, 12 * 60),
+    "trưa": (11 * 60, 14 * 60), "noon": (11 * 60, 14 * 60),
+    "chiều": (12 * 60, 18 * 60), "afternoon": (12 * 60, 18 * 60),
+    "tối": (18 * 60, 24 * 60), "evening": (18 * 60, 24 * 60),
+}
+
+
+def parse_window(window: str):
+    """ "HH:MM-HH:MM" hoặc tên buổi (sáng / chiều / tối, ...) → (from, to) theo phút; rỗng → None."""
+    if not window or not window.strip():
+        return None
+    w = window.strip().lower()
+    if w in DAY_WINDOWS:
+        return DAY_WINDOWS[w]
+    try:
+        f, t = (to_minutes(x.strip()) for x in w.split("-", 1))
+    except ValueError:
+        raise ValueError(f"preferred_window không hợp lệ: {window!r} (HH:MM-HH:MM hoặc sáng / chiều / tối)")
+    if f >= t:
+        raise ValueError(f"preferred_window không hợp lệ: {window!r} (giờ bắt đầu phải trước giờ kết thúc)")
+    return f, t
+
+
+def date_range(date_from: str, date_to: str = None):
+    """Các ngày YYYY-MM-DD trong [date_from, date_to], bỏ ngày đã qua, tối đa SLOT_SEARCH_MAX_DAYS ngày."""
+    start = datetime.strptime(date_from, "%Y-%m-%d").date()
+    end = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else start
+    if end < start:
+        raise ValueError("date_to phải sau hoặc bằng date_from")
+    start = max(start, datetime.now().date())
+    days = min((end - start).days + 1, SLOT_SEARCH_MAX_DAYS)
+    return [(start + timedelta(days=i)).isoformat() for i in range(max(days, 0))]
+
+
+def rank_openings(clinic_id: str, date: str, index: SlotIndex, window=None, not_before: int = None):
+    """
+    Slot trống của 1 (phòng khám, ngày) kèm key xếp hạng, đã sắp tăng dần:
+    (0 nếu giao với preferred_window / 1 nếu không, ngày, giờ bắt đầu, clinicId).
+    """
+    ranked = []
+    for s in index.free:
+        f, t = to_minutes(s["fromTime"]), to_minutes(s["toTime"])
+        if not_before is not None and t <= not_before:
+            continue
+        miss = 0 if window is None or (f < window[1] and t > window[0]) else 1
+        ranked.append(((miss, date, f, clinic_id), {"clinicId": clinic_id, "date": date, **s}))
+    ranked.sort(key=lambda r: r[0])
+    return ranked
+
+
 # ==================== FUNCTION ==================== #
 def parse_time(t: str) -> time:
     return datetime.strptime(t, "%H:%M").time()
@@ -51,7 +435,7 @@ def parse_time(t: str) -> time:
 
 # ================================================ #
 @mcp.tool()
-def save_customer(name: str, phone: str, email: str = None):
+async def save_customer(name: str, phone: str, email: str = None):
     """
     🔹 Kiểm tra khách hàng theo số điện thoại.
     Nếu chưa có, tạo mới trong hệ thống.
@@ -62,7 +446,7 @@ def save_customer(name: str, phone: str, email: str = None):
     try:
         # --- Check khách hàng đã tồn tại ---
         query = {"query": f'{{ customers(phone: "{phone}") {{ id name phone email }} }}'}
-        res = requests.post(CUSTOMER_API, json=query, timeout=5)
+        res = await http_post(CUSTOMER_API, json=query, timeout=5)
         res.raise_for_status()
         customers = res.json().get("data", {}).get("customers", [])
         if customers:
@@ -74,9 +458,13 @@ def save_customer(name: str, phone: str, email: str = None):
             fields.append(f'email: "{email}"')
 
         mutation = {"query": f"mutation {{ createCustomer({', '.join(fields)}) {{ id name phone email }} }}"}
-        res = requests.post(CUSTOMER_API, json=mutation, timeout=5)
+        res = await http_post(CUSTOMER_API, json=mutation, timeout=5)
         res.raise_for_status()
         created = res.json().get("data", {}).get("createCustomer")
+        if created:
+            # id trả về là id bên customer gateway, không phải _id của bảng OWNER → không upsert vào index;
+            # bỏ bản cũ của SĐT để booking ngay sau đó tải lại bảng OWNER thay vì chờ miss_refresh_interval
+            customer_index.invalidate(created.get("phone") or phone)
         return {"success": True, "data": created, "msg": "Tạo khách hàng mới thành công."}
 
     except Exception as e:
@@ -86,10 +474,10 @@ def save_customer(name: str, phone: str, email: str = None):
 
 # ================================================ #
 @mcp.tool()
-def get_clinics():
+async def get_clinics():
     """🏥 Lấy danh sách phòng khám khả dụng."""
     try:
-        res = requests.get(CLINIC_API, timeout=10)
+        res = await http_get(CLINIC_API)
         res.raise_for_status()
         data = res.json()
         clinics = [{"_id": c["_id"], "name": c["name"]} for c in data]
@@ -100,7 +488,7 @@ def get_clinics():
 # ================================================ #
 
 @mcp.tool()
-def check_slot(clinicId: str, bookingDate: str):
+async def check_slot(clinicId: str, bookingDate: str):
     """
     ⏰ Lấy tất cả slot trống trong ngày cho phòng khám.
     - clinicId: _id phòng khám (từ get_clinics)
@@ -117,36 +505,12 @@ def check_slot(clinicId: str, bookingDate: str):
     }
     """
     try:
-        # ✅ Ghép đúng endpoint: BASE + /{clinicId}/{bookingDate}
-        slot_url = f"{SLOT_API}/{clinicId}/{bookingDate}"
-        logger.info(f"🔍 Gọi API slot: {slot_url}")
-
-        response = requests.get(slot_url, timeout=10)
-        logger.debug(f"🔹 Raw Response ({response.status_code}): {response.text[:200]}")
-
-        # Kiểm tra lỗi HTTP
-        response.raise_for_status()
-
-        # Parse JSON
+        # cache theo (clinicId, ngày): create_booking ngay sau đó dùng lại, không gọi API lần 2
         try:
-            data = response.json()
-        except ValueError:
-            return {
-                "success": False,
-                "error": f"Phản hồi không phải JSON hợp lệ: {response.text[:200]}"
-            }
-
-        # Dữ liệu hợp lệ dạng list
-        slots = data if isinstance(data, list) else data.get("data", [])
-        free_slots = [
-            {
-                "fromTime": s.get("fromTime"),
-                "toTime": s.get("toTime"),
-                "availableSlot": s.get("availableSlot", 0)
-            }
-            for s in slots
-            if s.get("status") == "ACTIVE" and s.get("availableSlot", 0) > 0
-        ]
+            index = await slot_cache.get(clinicId, bookingDate)
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+        free_slots = index.free
 
         if not free_slots:
             return {
@@ -161,7 +525,7 @@ def check_slot(clinicId: str, bookingDate: str):
             "slots": free_slots
         }
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"❌ Lỗi kết nối tới API slot: {e}")
         return {"success": False, "error": f"Lỗi kết nối API: {str(e)}"}
 
@@ -170,6 +534,99 @@ def check_slot(clinicId: str, bookingDate: str):
         return {"success": False, "error": str(e)} 
 
 
+@mcp.tool()
+async def find_available_slots(clinicIds: list[str] = None, date_from: str = "", date_to: str = "",
+                               preferred_window: str = "", limit: int = 5):
+    """
+    🔎 Tìm các slot trống sớm nhất trên nhiều ngày / nhiều phòng khám trong 1 lần gọi
+    (thay cho gọi check_slot từng ngày, vd. bệnh nhân nói "trong tuần này").
+    - clinicIds: danh sách _id phòng khám (từ get_clinics); bỏ trống → tất cả phòng khám
+    - date_from: Ngày bắt đầu (YYYY-MM-DD), bỏ trống → hôm nay
+    - date_to: Ngày kết thúc (YYYY-MM-DD), bỏ trống → bằng date_from; tối đa 14 ngày
+    - preferred_window: "HH:MM-HH:MM" hoặc "sáng" / "trưa" / "chiều" / "tối"; slot trong khung này được xếp trước
+    - limit: số slot trả về (mặc định 5, tối đa 20)
+
+    ✅ Output:
+    {
+        "success": True/False,
+        "msg": "Mô tả kết quả",
+        "slots": [
+            {"clinicId": "...", "date": "2025-10-07", "fromTime": "07:00", "toTime": "09:00", "availableSlot": 2},
+            ...
+        ]
+    }
+    """
+    try:
+        window = parse_window(preferred_window)
+        today = datetime.now().date().isoformat()
+        dates = date_range(date_from or today, date_to or None)
+        if not dates:
+            return {"success": False, "msg": "Khoảng ngày đã qua, không còn ngày nào để tìm.", "slots": []}
+        limit = max(1, min(int(limit or 5), SLOT_SEARCH_MAX_LIMIT))
+
+        if not clinicIds:
+            clinics = await get_clinics_2()
+            if not clinics.get("success"):
+                return {"success": False, "error": clinics.get("error")}
+            clinicIds = [c["_id"] for c in clinics["clinics"]]
+
+        # tải song song mọi (phòng khám, ngày), tối đa SLOT_SEARCH_CONCURRENCY request cùng lúc;
+        # kết quả nằm lại slot_cache nên check_slot / create_booking ngay sau đó không gọi API lần 2
+        sem = asyncio.Semaphore(SLOT_SEARCH_CONCURRENCY)
+        keys = [(clinic_id, date) for date in dates for clinic_id in dict.fromkeys(clinicIds)]
+
+        async def load(clinic_id, date):
+            async with sem:
+                return await slot_cache.get(clinic_id, date)
+
+        results = await asyncio.gather(*(load(c, d) for c, d in keys), return_exceptions=True)
+
+        now_minutes = floor_minutes(datetime.now().time())
+        ranked, failed = [], []
+        for (clinic_id, date), res in zip(keys, results):
+            if isinstance(res, Exception):
+                logger.warning(f"⚠️ Lỗi tải slot {clinic_id} ngày {date}: {res}")
+                failed.append({"clinicId": clinic_id, "date": date})
+                continue
+            ranked.append(rank_openings(clinic_id, date, res, window, now_minutes if date == today else None))
+
+        # mỗi danh sách đã sắp theo key → heap merge, chỉ lấy limit phần tử đầu
+        best = list(islice(heapq.merge(*ranked, key=lambda r: r[0]), limit))
+        slots = [s for _key, s in best]
+
+        if not slots:
+            if failed and len(failed) == len(keys):
+                return {"success": False, "error": "Không tải được slot của phòng khám nào.", "slots": []}
+            return {
+                "success": False,
+                "msg": f"Không có slot trống nào từ {dates[0]} đến {dates[-1]}.",
+                "slots": [],
+                **({"failed": failed} if failed else {}),
+            }
+
+        result = {
+            "success": True,
+            "msg": f"{len(slots)} slot trống sớm nhất từ {dates[0]} đến {dates[-1]}.",
+            "slots": slots,
+        }
+        if window is not None and all(key[0] for key, _s in best):
+            result["msg"] += f" Không có slot nào trong khung {preferred_window}."
+        if failed:
+            result["failed"] = failed
+        return result
+
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+
+    except httpx.HTTPError as e:
+        logger.error(f"❌ Lỗi kết nối tới API: {e}")
+        return {"success": False, "error": f"Lỗi kết nối API: {str(e)}"}
+
+    except Exception as e:
+        logger.exception("❌ Lỗi khi xử lý find_available_slots:")
+        return {"success": False, "error": str(e)}
+
+
 
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
@@ -194,10 +651,10 @@ def parse_iso_datetime(s: str) -> datetime:
     raise ValueError(f"Không parse được datetime: {s}")
 
 
-def get_clinics_2():
+async def get_clinics_2():
     """🏥 Lấy danh sách phòng khám khả dụng."""
     try:
-        res = requests.get(CLINIC_API, timeout=10)
+        res = await http_get(CLINIC_API)
         res.raise_for_status()
         data = res.json()
         clinics = [{"_id": c["_id"], "name": c["name"]} for c in data]
@@ -207,14 +664,14 @@ def get_clinics_2():
     
 
 @mcp.tool()
-def doctor_advice(user_input: str) -> str:
+async def doctor_advice(user_input: str) -> str:
     """
     Nhận input là text: tên, tuổi, triệu chứng thu thập được
     Trả về text: gợi ý dịch vụ và phòng khám nếu đủ thông tin
     """
     try:
         # Lấy danh sách phòng khám
-        clinics_data = get_clinics_2()
+        clinics_data = await get_clinics_2()
         if clinics_data["success"]:
             clinics_list_text = "\n".join([f"{c['_id']}: {c['name']}" for c in clinics_data["clinics"]])
         else:
@@ -243,7 +700,7 @@ Bạn là một bác sĩ hơn 10 năm kinh nghiệm trong chuẩn đoán và đ
             HumanMessage(content=user_input)
         ]
 
-        response = llm.invoke(messages)
+        response = await llm.ainvoke(messages)
 
         # Luôn trả về string
         return str(response.content)
@@ -256,7 +713,7 @@ Bạn là một bác sĩ hơn 10 năm kinh nghiệm trong chuẩn đoán và đ
 # ==================== FUNCTION ==================== #
 
 @mcp.tool()
-def create_booking(phone: str, startDateExpect: str, endDateExpect: str, clinicId: str):
+async def create_booking(phone: str, startDateExpect: str, endDateExpect: str, clinicId: str):
     """
     Đặt lịch khám tự động theo slot thực tế (dạng ISO datetime).
 
@@ -277,11 +734,8 @@ def create_booking(phone: str, startDateExpect: str, endDateExpect: str, clinicI
     """
 
     try:
-        # 1️⃣ Lấy thông tin khách hàng
-        resp = requests.get(OWNER_API, timeout=10)
-        resp.raise_for_status()
-        owners = resp.json()
-        owner = next((o for o in owners if o.get("phone") == phone), None)
+        # 1️⃣ Lấy thông tin khách hàng (index theo SĐT, không tải lại cả bảng OWNER)
+        owner = await customer_index.lookup(phone)
         if not owner:
             return {"status": "FAILED", "message": f"Không tìm thấy khách hàng với SĐT {phone}"}
         owner_id = owner["_id"]
@@ -298,62 +752,33 @@ def create_booking(phone: str, startDateExpect: str, endDateExpect: str, clinicI
         fromTime_val, toTime_val = start_dt.strftime("%H:%M"), end_dt.strftime("%H:%M")
         booking_date = start_dt.date().isoformat()
 
-        # 3️⃣ Gọi Slot API
-        slot_url = f"{SLOT_API}/{clinicId}/{booking_date}"
-        logger.info(f"🔍 Gọi slot API: {slot_url}")
-        slot_resp = requests.get(slot_url, timeout=10)
-        slot_resp.raise_for_status()
-        slots = slot_resp.json()
-        slots = slots if isinstance(slots, list) else slots.get("data", [])
-
-        if not slots:
+        # 3️⃣ Slot trong ngày (cache, đã compile sang phút trong ngày)
+        index = await slot_cache.get(clinicId, booking_date)
+        if not index:
             return {"status": "FAILED", "message": "Không có dữ liệu slot trong ngày này."}
 
-        sorted_slots = sorted(slots, key=lambda s: parse_time(s["fromTime"]))
-        start_work = parse_time(sorted_slots[0]["fromTime"])
-        end_work = parse_time(sorted_slots[-1]["toTime"])
-
-        # 4️⃣ Kiểm tra slot phù hợp
-        chosen_slot = None
-        full_slot = None
-
-        for s in sorted_slots:
-            f_slot = parse_time(s["fromTime"])
-            t_slot = parse_time(s["toTime"])
-            if f_in >= f_slot and t_in <= t_slot:
-                if s.get("availableSlot", 0) > 0 and s.get("status") == "ACTIVE":
-                    chosen_slot = s
-                    break
-                else:
-                    full_slot = s
-                    break
+        f_min, t_min = floor_minutes(f_in), ceil_minutes(t_in)
+
+        # 4️⃣ Slot đầu tiên chứa trọn khoảng yêu cầu
+        slot = index.containing(f_min, t_min)
+        chosen_slot = full_slot = None
+        if slot is not None:
+            if slot.get("availableSlot", 0) > 0 and slot.get("status") == "ACTIVE":
+                chosen_slot = slot
+            else:
+                full_slot = slot
 
         # 5️⃣ Không tìm được slot trống
         if not chosen_slot:
             if full_slot:
                 msg = f"❌ Khung giờ {full_slot['fromTime']}-{full_slot['toTime']} đã hết chỗ."
-                suggested = [f"{s['fromTime']}-{s['toTime']}" for s in sorted_slots if s.get("availableSlot", 0) > 0]
-                return {"status": "FAILED", "message": msg, "suggested_slots": suggested}
-
-            if t_in <= start_work or f_in >= end_work:
+            elif t_min <= index.start_work or f_min >= index.end_work:
                 msg = "🌙 Ngoài giờ làm việc của phòng khám."
-                suggested = [f"{s['fromTime']}-{s['toTime']}" for s in sorted_slots if s["availableSlot"] > 0]
-                return {"status": "FAILED", "message": msg, "suggested_slots": suggested}
-
-            gaps = []
-            for i in range(len(sorted_slots) - 1):
-                end_prev = parse_time(sorted_slots[i]["toTime"])
-                start_next = parse_time(sorted_slots[i + 1]["fromTime"])
-                if end_prev < start_next:
-                    gaps.append((end_prev, start_next))
-
-            if any(f_in >= g[0] and t_in <= g[1] for g in gaps):
+            elif index.in_gap(f_min, t_min):
                 msg = "🕑 Đây là giờ nghỉ giữa các ca."
             else:
                 msg = "⚠️ Không có khung giờ hoạt động phù hợp cho thời gian bạn yêu cầu."
-
-            suggested = [f"{s['fromTime']}-{s['toTime']}" for s in sorted_slots if s["availableSlot"] > 0]
-            return {"status": "FAILED", "message": msg, "suggested_slots": suggested}
+            return {"status": "FAILED", "message": msg, "suggested_slots": index.suggested}
 
         # 6️⃣ Tạo booking thành công
         shift_id = chosen_slot["shiftId"]
@@ -369,9 +794,15 @@ def create_booking(phone: str, startDateExpect: str, endDateExpect: str, clinicI
         }
 
         headers = {"Content-Type": "application/json"}
-        response = requests.post(BOOKING_API, headers=headers, json=payload, timeout=10)
-        response.raise_for_status()
+        try:
+            response = await http_post(BOOKING_API, headers=headers, json=payload)
+            response.raise_for_status()
+        except Exception:
+            # không rõ booking đã ghi hay chưa → lần sau đọc lại slot thật
+            slot_cache.invalidate(clinicId, booking_date)
+            raise
         booking_data = response.json()
+        slot_cache.book(clinicId, booking_date, chosen_slot)
 
         # 🧾 Log chi tiết
         logger.info(
@@ -384,7 +815,7 @@ def create_booking(phone: str, startDateExpect: str, endDateExpect: str, clinicI
 
         return {"status": "SUCCESS", "booking": booking_data}
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.exception("❌ Lỗi kết nối API: %s", e)
         return {"status": "ERROR", "message": f"Lỗi kết nối API: {e}"}
     except Exception as e:
@@ -397,4 +828,5 @@ if __name__ == "__main__":
     # Chạy local trong ứng dụng (off)
     # Nếu muốn expose HTTP thì đổi sang transport="sse"
     #mcp.run(transport="local")
+    customer_index.warm()
     mcp.run(transport="sse", host="0.0.0.0", port=9000)
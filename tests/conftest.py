@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# module trong dispatch_server import nhau theo tên trần (chạy trực tiếp `python dispatch.py`),
+# server.py cũng vậy → thêm các thư mục đó vào sys.path giống lúc chạy thật
+ROOT = Path(__file__).resolve().parents[1]
+for path in (ROOT, ROOT / "dispatch_server", ROOT / "server"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,89 @@
+import time
+
+from livekit import api
+
+from adaptive_poll import AdaptiveInterval, RoomLanes
+
+
+def test_adaptive_interval_backs_off_and_resets():
+    interval = AdaptiveInterval(min_interval=0.5, max_interval=4.0, factor=2.0, start=1.0)
+    assert interval.next(False) == 2.0
+    assert interval.next(False) == 4.0
+    # không giãn quá max_interval
+    assert interval.next(False) == 4.0
+    assert interval.next(True) == 0.5
+    assert interval.next(False) == 1.0
+
+
+def test_adaptive_interval_clamps_start():
+    assert AdaptiveInterval(min_interval=0.5, max_interval=4.0, start=10.0).current == 4.0
+    assert AdaptiveInterval(min_interval=0.5, max_interval=4.0, start=0.1).current == 0.5
+
+
+def room(name, num, version=1, publishers=None):
+    return api.Room(sid="RM_1", name=name, num_participants=num,
+                    num_publishers=num if publishers is None else publishers,
+                    version=api.TimedVersion(unix_micro=version, ticks=0))
+
+
+def people(*identities):
+    return [api.ParticipantInfo(identity=i) for i in identities]
+
+
+def tick(lanes, info, fetched):
+    """1 tick của run_tick: reuse, nếu None thì dùng danh sách fetched, rồi observe."""
+    lanes.begin_tick()
+    cached = lanes.reuse(info)
+    participants = cached if cached is not None else fetched
+    lanes.observe(info.name, info.num_participants, participants)
+    return cached
+
+
+def test_cold_room_reuses_participants():
+    lanes = RoomLanes(cold_interval=60, hot_ticks=1)
+    assert tick(lanes, room("r1", 1), people("a")) is None
+    assert lanes.changed
+    tick(lanes, room("r1", 1), people("a"))  # còn trong hot_ticks
+    assert tick(lanes, room("r1", 1), people("a")) is not None
+    assert not lanes.changed
+    assert lanes.hot_count() == 0
+
+
+def test_leave_and_join_at_same_count_refetches():
+    lanes = RoomLanes(cold_interval=60, hot_ticks=0)
+    tick(lanes, room("r1", 1, version=1), people("a"))
+    assert tick(lanes, room("r1", 1, version=1), people("a")) is not None
+    # a rời, b vào trong cùng tick: số người không đổi nhưng version đổi → list lại ngay
+    assert tick(lanes, room("r1", 1, version=2), people("b")) is None
+    assert lanes.changed
+
+
+def test_publisher_change_refetches():
+    lanes = RoomLanes(cold_interval=60, hot_ticks=0)
+    tick(lanes, room("r1", 2, publishers=1), people("a", "b"))
+    assert tick(lanes, room("r1", 2, publishers=2), people("a", "b")) is None
+
+
+def test_is_hot_room_listed_every_tick():
+    hot = {"r1"}
+    lanes = RoomLanes(cold_interval=60, hot_ticks=0, is_hot=lambda name: name in hot)
+    tick(lanes, room("r1", 1), people("a"))
+    assert tick(lanes, room("r1", 1), people("a")) is None
+    hot.clear()
+    assert tick(lanes, room("r1", 1), people("a")) is not None
+
+
+def test_cold_interval_expiry_refetches():
+    lanes = RoomLanes(cold_interval=0.01, hot_ticks=0)
+    tick(lanes, room("r1", 1), people("a"))
+    time.sleep(0.02)
+    assert tick(lanes, room("r1", 1), people("a")) is None
+
+
+def test_retain_drops_gone_rooms():
+    lanes = RoomLanes(cold_interval=60, hot_ticks=0)
+    tick(lanes, room("r1", 1), people("a"))
+    lanes.begin_tick()
+    lanes.retain({"r2"})
+    assert lanes.changed
+    assert lanes.reuse(room("r1", 1)) is None
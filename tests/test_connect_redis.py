@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from utils_.connect_redis import RoomRegistry
+
+
+def make_registry(**kwargs):
+    registry = RoomRegistry(**kwargs)
+    calls = []
+
+    def on_latency(op, seconds):
+        calls.append(op)
+
+    registry.on_latency = on_latency
+    registry._client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    registry._client_loop = asyncio.get_running_loop()
+    return registry, calls
+
+
+def test_get_room_data_caches_hget_without_sync_loop():
+    async def run():
+        registry, calls = make_registry(cache_ttl=0.05)
+        await registry._client.hset(registry.hash_key, "r1", json.dumps({"topicId": "t1"}))
+
+        assert (await registry.get_room_data("r1"))["topicId"] == "t1"
+        assert (await registry.get_room_data("r1"))["topicId"] == "t1"
+        # agent không start vòng sync: chỉ 1 HGET, không HGETALL / HKEYS
+        assert calls == ["hget"]
+
+        # value sửa tại chỗ → thấy sau cache_ttl
+        await registry._client.hset(registry.hash_key, "r1", json.dumps({"topicId": "t1", "prescriptionId": "p1"}))
+        await asyncio.sleep(0.06)
+        assert (await registry.get_room_data("r1"))["prescriptionId"] == "p1"
+        assert calls == ["hget", "hget"]
+
+        # room bị xóa khỏi hash → không trả bản cache cũ
+        await registry._client.hdel(registry.hash_key, "r1")
+        await asyncio.sleep(0.06)
+        assert await registry.get_room_data("r1") == {}
+        assert registry.get("r1") is None
+
+    asyncio.run(run())
+
+
+def test_get_room_data_serves_synced_map():
+    async def run():
+        registry, calls = make_registry(cache_ttl=0)
+        registry._apply("r1", "r1", {"topicId": "t1"})
+        # room do vòng sync quản lý → không HGET
+        assert (await registry.get_room_data("r1"))["topicId"] == "t1"
+        assert calls == []
+        assert await registry.get_room_data("missing") == {}
+        assert calls == ["hget"]
+
+    asyncio.run(run())
@@ -0,0 +1,86 @@
+import asyncio
+
+from delay_scheduler import DelayScheduler
+
+
+def test_fires_in_deadline_order():
+    async def run():
+        scheduler = DelayScheduler()
+        fired = []
+
+        def job(name):
+            async def _fn():
+                fired.append(name)
+            return _fn
+
+        scheduler.schedule(("r1", "a", "remove"), 0.06, job("late"))
+        scheduler.schedule(("r1", "b", "remove"), 0.02, job("early"))
+        await asyncio.sleep(0.15)
+        assert fired == ["early", "late"]
+        assert scheduler.pending() == 0
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_same_key_is_deduped():
+    async def run():
+        scheduler = DelayScheduler()
+        fired = []
+
+        async def job():
+            fired.append(1)
+
+        assert scheduler.schedule(("r1", "a", "remove"), 0.02, job)
+        assert not scheduler.schedule(("r1", "a", "remove"), 0.02, job)
+        assert scheduler.pending_by_action() == {"remove": 1}
+        await asyncio.sleep(0.1)
+        assert fired == [1]
+        # đã chạy xong → schedule lại được
+        assert scheduler.schedule(("r1", "a", "remove"), 0.02, job)
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_cancel_and_cancel_room():
+    async def run():
+        scheduler = DelayScheduler()
+        fired = []
+
+        def job(name):
+            async def _fn():
+                fired.append(name)
+            return _fn
+
+        scheduler.schedule(("r1", "a", "remove"), 0.03, job("r1a"))
+        scheduler.schedule(("r1", "b", "remove"), 0.03, job("r1b"))
+        scheduler.schedule(("r2", "a", "remove"), 0.03, job("r2a"))
+        assert scheduler.cancel(("r1", "a", "remove"))
+        assert not scheduler.cancel(("r1", "a", "remove"))
+        assert scheduler.cancel_room("r1") == 1
+        await asyncio.sleep(0.1)
+        assert fired == ["r2a"]
+        await scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_failing_job_does_not_stop_runner():
+    async def run():
+        scheduler = DelayScheduler()
+        fired = []
+
+        async def boom():
+            raise RuntimeError("x")
+
+        async def ok():
+            fired.append(1)
+
+        scheduler.schedule(("r1", "a", "remove"), 0.01, boom)
+        scheduler.schedule(("r1", "b", "remove"), 0.03, ok)
+        await asyncio.sleep(0.1)
+        assert fired == [1]
+        await scheduler.stop()
+
+    asyncio.run(run())
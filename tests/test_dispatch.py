@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import dispatch
+from livekit import api
+
+
+class FakeIngress:
+    def __init__(self):
+        self.alive = set()
+
+    async def create_ingress(self, req):
+        ingress_id = f"IN_{len(self.alive) + 1}"
+        self.alive.add(ingress_id)
+        return api.IngressInfo(ingress_id=ingress_id)
+
+    async def list_ingress(self, req):
+        items = [api.IngressInfo(ingress_id=req.ingress_id,
+                                 state=api.IngressState(status=api.IngressState.ENDPOINT_PUBLISHING))]
+        return api.ListIngressResponse(items=items)
+
+    async def delete_ingress(self, req):
+        self.alive.discard(req.ingress_id)
+        return api.IngressInfo(ingress_id=req.ingress_id)
+
+
+class FakeAPI:
+    def __init__(self):
+        self.ingress = FakeIngress()
+
+
+def test_shutdown_does_not_checkpoint_live_ingress(monkeypatch):
+    async def resolve_url():
+        return "https://cdn/wait.mp4"
+
+    async def run():
+        monkeypatch.setattr(dispatch.state_store, "_client", fakeredis.aioredis.FakeRedis(decode_responses=True))
+        monkeypatch.setattr(dispatch.ingress_supervisor, "resolve_url", resolve_url)
+        room = "clinic"
+        lkapi = FakeAPI()
+
+        dispatch.dispatched_rooms.add(room)
+        dispatch.ingress_state[room] = True
+        dispatch.last_room_state[room] = {"count_all": 2, "count_egress": 1, "identities": {"u1"}, "recording": False}
+        assert dispatch.create_ingress_and_push(lkapi, room) or dispatch.ingress_supervisor.is_running(room)
+        await asyncio.sleep(0.05)
+        assert lkapi.ingress.alive
+        await dispatch.state_store.flush()
+
+        await dispatch.stop_ingress_for_shutdown()
+        await dispatch.state_store.flush()
+        assert not lkapi.ingress.alive
+
+        # restart: nạp lại checkpoint → room vẫn đã dispatch nhưng không còn cờ video chờ / last state cũ
+        dispatch.dispatcher_state.forget(room)
+        dispatch.state_store.discard([room])
+        assert await dispatch.state_store.load() == 1
+        assert room in dispatch.dispatched_rooms
+        assert not dispatch.ingress_state.get(room)
+        assert room not in dispatch.last_room_state
+
+        dispatch.dispatcher_state.forget(room)
+        dispatch.dirty_rooms.clear()
+
+    asyncio.run(run())
+
+
+def test_offline_room_uses_audio_only_profile(monkeypatch):
+    route = dispatch.route_for("Offline01")
+    assert route.egress
+    assert dispatch.egress_profile_for("Offline01").name == "audio_only"
+    # phòng có trong Redis registry vẫn phải khớp rule offline, không rơi vào rule redis
+    monkeypatch.setitem(dispatch.room_registry.rooms, "Offline01", {"roomName": "Offline01"})
+    assert dispatch.route_for("Offline01").rule == "offline"
+    assert dispatch.egress_profile_for("Offline01").name == "audio_only"
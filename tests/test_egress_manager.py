@@ -0,0 +1,140 @@
+import asyncio
+
+import aiohttp
+import pytest
+from livekit import api
+
+from egress_manager import EgressManager, is_retryable
+
+
+def twirp(code, status):
+    return api.TwirpError(code, "x", status=status)
+
+
+def connector_error():
+    return aiohttp.ClientConnectorError(None, OSError(111, "refused"))
+
+
+@pytest.mark.parametrize("error, idempotent, expected", [
+    (twirp("unavailable", 503), True, True),
+    (twirp("internal", 500), True, True),
+    (twirp("not_found", 404), True, False),
+    (twirp("invalid_argument", 400), True, False),
+    (asyncio.TimeoutError(), True, True),
+    (connector_error(), True, True),
+    # start: chỉ retry khi chắc chắn server chưa tạo egress
+    (twirp("unavailable", 503), False, True),
+    (twirp("internal", 500), False, False),
+    (twirp("deadline_exceeded", 504), False, False),
+    (asyncio.TimeoutError(), False, False),
+    (aiohttp.ServerDisconnectedError(), False, False),
+    (RuntimeError("?"), False, False),
+    (connector_error(), False, True),
+])
+def test_is_retryable(error, idempotent, expected):
+    assert is_retryable(error, idempotent) is expected
+
+
+class FakeEgress:
+    """start lần đầu: server tạo egress nhưng client timeout; list_egress thấy egress đó."""
+
+    def __init__(self, slow_first=True):
+        self.started = []
+        self.slow_first = slow_first
+
+    async def start_room_composite_egress(self, req):
+        egress_id = f"EG_{len(self.started) + 1}"
+        self.started.append(egress_id)
+        if self.slow_first and len(self.started) == 1:
+            await asyncio.sleep(1)
+        return api.EgressInfo(egress_id=egress_id, room_name=req.room_name)
+
+    async def list_egress(self, req):
+        items = [api.EgressInfo(egress_id=e, room_name=req.room_name,
+                                room_composite=api.RoomCompositeEgressRequest(
+                                    file_outputs=[api.EncodedFileOutput(filepath=f"{e}.mp4")]))
+                 for e in self.started]
+        return api.ListEgressResponse(items=items)
+
+
+class FakeAPI:
+    def __init__(self, egress):
+        self.egress = egress
+
+
+def run_start(egress):
+    egress_map, recording, filepath = {}, {}, {}
+
+    async def build(lkapi, room_name):
+        return api.RoomCompositeEgressRequest(room_name=room_name), f"{room_name}.mp4"
+
+    async def run():
+        manager = EgressManager(egress_map, recording, filepath, build, backoff=0, timeout=0.05)
+        await manager._start(FakeAPI(egress), "r1")
+
+    asyncio.run(run())
+    return egress_map, recording, filepath
+
+
+def test_start_timeout_adopts_egress_instead_of_starting_twice():
+    egress = FakeEgress()
+    egress_map, recording, filepath = run_start(egress)
+    assert egress.started == ["EG_1"]
+    assert egress_map == {"r1": "EG_1"} and recording == {"r1": True}
+    assert filepath == {"r1": "EG_1.mp4"}
+
+
+def test_start_retries_when_server_has_nothing():
+    egress = FakeEgress()
+
+    async def list_nothing(req):
+        return api.ListEgressResponse()
+
+    egress.list_egress = list_nothing
+    egress_map, _, filepath = run_start(egress)
+    assert egress.started == ["EG_1", "EG_2"]
+    assert egress_map == {"r1": "EG_2"} and filepath == {"r1": "r1.mp4"}
+
+
+def info(egress_id, room_name):
+    return api.EgressInfo(egress_id=egress_id, room_name=room_name)
+
+
+async def no_build(lkapi, room_name):
+    raise AssertionError("không được start")
+
+
+def test_reconcile_releases_ended_and_adopts_owned():
+    egress_map = {"r1": "EG_1", "r2": "EG_2"}
+    recording = {"r1": True, "r2": True}
+    filepath = {"r1": "r1.mp4", "r2": "r2.mp4"}
+    manager = EgressManager(egress_map, recording, filepath, no_build, max_concurrent=3)
+    assert manager.active_count() == 2
+
+    # EG_2 kết thúc phía server; r3 (room mình) có egress chưa biết; EG_9 của instance khác
+    active = {"EG_1": info("EG_1", "r1"), "EG_3": info("EG_3", "r3"), "EG_9": info("EG_9", "x9")}
+    released, adopted = manager.reconcile(active, dict(egress_map), adopt=lambda room: room.startswith("r"))
+    assert (released, adopted) == (1, 1)
+    assert egress_map == {"r1": "EG_1", "r3": "EG_3"}
+    assert recording == {"r1": True, "r2": False, "r3": True}
+    assert "r2" not in filepath
+    # giới hạn là toàn cục: egress của instance khác chiếm slot
+    assert manager.active_count() == 3
+    assert not manager.has_capacity()
+
+
+def test_reconcile_keeps_egress_started_after_snapshot():
+    egress_map, recording = {"r1": "EG_1"}, {"r1": True}
+    manager = EgressManager(egress_map, recording, {}, no_build)
+    # EG_1 start xong sau khi list_egress đã gửi đi → không có trong active nhưng cũng không có trong known
+    manager.reconcile({}, {}, adopt=lambda room: True)
+    assert egress_map == {"r1": "EG_1"} and recording == {"r1": True}
+
+
+def test_release_gone_dequeues_closed_rooms():
+    manager = EgressManager({}, {}, {}, no_build, max_concurrent=0)
+    manager.request_start(None, "r1")
+    manager.request_start(None, "r2")
+    assert manager.queue_depth() == 2
+    assert manager.release_gone({"r2"}) == 1
+    assert not manager.is_queued("r1") and manager.is_queued("r2")
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from fanout import fan_out
+
+
+def collect(items, fn, **kwargs):
+    async def run():
+        return [r async for r in fan_out(items, fn, **kwargs)]
+    return asyncio.run(run())
+
+
+def test_yields_in_completion_order():
+    async def fn(delay):
+        await asyncio.sleep(delay)
+        return delay * 10
+
+    assert collect([0.05, 0.0, 0.02], fn) == [(0.0, 0.0), (0.02, 0.2), (0.05, 0.5)]
+
+
+def test_respects_limit():
+    running = peak = 0
+
+    async def fn(item):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return item
+
+    results = collect(range(20), fn, limit=3)
+    assert sorted(r for _, r in results) == list(range(20))
+    assert peak == 3
+
+
+def test_errors_and_timeouts_yield_none():
+    async def fn(item):
+        if item == "boom":
+            raise RuntimeError("boom")
+        if item == "slow":
+            await asyncio.sleep(1)
+        return item
+
+    results = dict(collect(["ok", "boom", "slow"], fn, timeout=0.05))
+    assert results == {"ok": "ok", "boom": None, "slow": None}
+
+
+def test_jitter_does_not_hold_slots():
+    async def fn(item):
+        return item
+
+    started = time.monotonic()
+    results = collect(range(200), fn, limit=2, jitter=0.02)
+    assert len(results) == 200
+    # jitter ngủ ngoài semaphore: tổng thời gian ~ 1 lần jitter, không phải 200 / 2 lần
+    assert time.monotonic() - started < 0.5
+
+
+def test_early_exit_cancels_pending():
+    cancelled = []
+
+    async def fn(item):
+        try:
+            await asyncio.sleep(item)
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+        return item
+
+    async def run():
+        gen = fan_out([0.0, 1.0, 1.0], fn)
+        async for item, _ in gen:
+            break
+        await gen.aclose()
+        await asyncio.sleep(0)
+        return item
+
+    assert asyncio.run(run()) == 0.0
+    assert sorted(cancelled) == [1.0, 1.0]
@@ -0,0 +1,105 @@
+import asyncio
+
+from livekit import api
+
+from ingress_supervisor import IngressSupervisor
+
+
+class FakeBroadcaster:
+    def __init__(self):
+        self.detached = []
+
+    async def detach(self, room_name):
+        # teardown chậm: start mới cùng room chen vào giữa chừng
+        await asyncio.sleep(0.05)
+        self.detached.append(room_name)
+
+    async def stop(self):
+        pass
+
+
+class FakeIngress:
+    def __init__(self):
+        self.alive = set()
+        self.created = 0
+        self.status = api.IngressState.ENDPOINT_PUBLISHING
+
+    async def create_ingress(self, req):
+        self.created += 1
+        ingress_id = f"IN_{self.created}"
+        self.alive.add(ingress_id)
+        return api.IngressInfo(ingress_id=ingress_id, url="rtmp://x", stream_key="k")
+
+    async def list_ingress(self, req):
+        # URL_INPUT phát 1 lượt là xong
+        items = [api.IngressInfo(ingress_id=i, state=api.IngressState(status=self.status))
+                 for i in self.alive if i == req.ingress_id]
+        return api.ListIngressResponse(items=items)
+
+    async def delete_ingress(self, req):
+        self.alive.discard(req.ingress_id)
+        return api.IngressInfo(ingress_id=req.ingress_id)
+
+
+class FakeAPI:
+    def __init__(self):
+        self.ingress = FakeIngress()
+
+
+async def resolve_url():
+    return "https://cdn/wait.mp4"
+
+
+def test_fast_stop_start_keeps_new_ingress():
+    async def run():
+        lkapi = FakeAPI()
+        sup = IngressSupervisor(FakeBroadcaster(), resolve_url, max_seconds=60)
+        assert sup.start(lkapi, "r1", mode="url")
+        await asyncio.sleep(0.01)
+        assert lkapi.ingress.alive == {"IN_1"}
+
+        sup.stop("r1", "test")
+        assert sup.start(lkapi, "r1", mode="url")
+        await asyncio.sleep(0.2)
+        # teardown của task cũ chỉ xóa ingress cũ
+        assert lkapi.ingress.alive == {"IN_2"}
+        assert sup.is_running("r1")
+        await sup.stop_all()
+        assert lkapi.ingress.alive == set()
+
+    asyncio.run(run())
+
+
+def test_refused_at_max_streams():
+    async def run():
+        lkapi = FakeAPI()
+        sup = IngressSupervisor(FakeBroadcaster(), resolve_url, max_streams=1, max_seconds=60)
+        assert sup.start(lkapi, "r1", mode="url")
+        assert not sup.start(lkapi, "r2", mode="url")
+        assert not sup.is_running("r2")
+        await sup.stop_rooms(["r1"], "test")
+        assert sup.start(lkapi, "r2", mode="url")
+        await sup.stop_all()
+
+    asyncio.run(run())
+
+
+def test_url_ingress_loops_after_complete():
+    async def run():
+        lkapi = FakeAPI()
+        sup = IngressSupervisor(FakeBroadcaster(), resolve_url, max_seconds=60, url_poll_interval=0.01)
+        assert sup.start(lkapi, "r1", mode="url")
+        await asyncio.sleep(0.05)
+        assert lkapi.ingress.created == 1
+        lkapi.ingress.status = api.IngressState.ENDPOINT_COMPLETE
+        await asyncio.sleep(0.05)
+        lkapi.ingress.status = api.IngressState.ENDPOINT_PUBLISHING
+        await asyncio.sleep(0.05)
+        # phát hết → xóa ingress cũ, tạo ingress mới để lặp video
+        assert lkapi.ingress.created >= 2
+        assert len(lkapi.ingress.alive) == 1
+        assert sup.is_running("r1")
+        await sup.stop_all()
+        assert lkapi.ingress.alive == set()
+
+    asyncio.run(run())
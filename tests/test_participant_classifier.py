@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+
+from participant_classifier import ParticipantClassifier, ParticipantKind, normalize
+
+
+def participant(identity, name=""):
+    return SimpleNamespace(identity=identity, name=name)
+
+
+@pytest.mark.parametrize("identity, name, kind", [
+    ("EG_abc", "", ParticipantKind.EGRESS),
+    ("ingress_agent", "Video giới thiệu", ParticipantKind.INGRESS),
+    ("assistant_agent", "", ParticipantKind.AGENT),
+    ("", "Nguyễn Văn A", ParticipantKind.AGENT),
+    ("bs_lan", "", ParticipantKind.DOCTOR),
+    ("user_1", "Bác sĩ Lan", ParticipantKind.DOCTOR),
+    ("user_2", "BÁC-SĨ Minh", ParticipantKind.DOCTOR),
+    ("user_3", "Nguyễn Văn A", ParticipantKind.PATIENT),
+    ("  user_4  ", " ", ParticipantKind.PATIENT),
+])
+def test_classify(identity, name, kind):
+    assert ParticipantClassifier().classify(participant(identity, name)) is kind
+
+
+def test_normalize_strips_accents_and_case():
+    assert normalize("  Bác Sĩ ") == "bac si"
+    assert normalize(None) == ""
+
+
+def test_is_real():
+    classifier = ParticipantClassifier()
+    assert classifier.is_real(participant("user_1"))
+    assert classifier.is_real(participant("bs_lan"))
+    assert not classifier.is_real(participant("record_agent"))
+    assert not classifier.is_real(participant("EG_1"))
+
+
+def test_result_is_memoized_per_identity_and_name():
+    classifier = ParticipantClassifier(maxsize=16)
+    for _ in range(5):
+        classifier.classify(participant("user_1", "A"))
+    classifier.classify(participant("user_1", "Bác sĩ A"))
+    info = classifier.cache_info()
+    assert (info.misses, info.hits) == (2, 4)
@@ -0,0 +1,64 @@
+import json
+import os
+
+import pytest
+
+from routing import Router, RoutingTable
+
+
+RULES = [
+    {"name": "clinic", "match": "exact", "rooms": ["phong_kham"], "agent": "book_agent", "egress": True,
+     "ingress_mode": "url"},
+    {"name": "calls", "match": "prefix", "prefixes": ["call_", "sip_"], "agent": "call_agent"},
+    {"name": "tests", "match": "regex", "patterns": [r"test_\d+"], "monitor": True},
+    {"name": "online", "match": "redis", "agent": "redis_agent"},
+    {"name": "late_exact", "match": "exact", "rooms": ["call_vip"], "agent": "vip_agent"},
+]
+
+
+def test_resolve_by_match_kind():
+    table = RoutingTable(RULES)
+    assert table.resolve("phong_kham").agent == "book_agent"
+    assert table.resolve("sip_123").rule == "calls"
+    assert table.resolve("test_42").monitor
+    assert table.resolve("test_x") is None
+    assert table.resolve("abc") is None
+    assert table.resolve("abc", in_redis=True).agent == "redis_agent"
+    assert table.static_rooms() == {"phong_kham", "call_vip"}
+
+
+def test_first_matching_rule_wins():
+    table = RoutingTable(RULES)
+    # call_vip khớp cả prefix "call_" (rule 1) lẫn exact (rule 4) → rule xếp trước thắng
+    assert table.resolve("call_vip").rule == "calls"
+    assert table.resolve("phong_kham", in_redis=True).rule == "clinic"
+
+
+def test_unknown_keys_become_options():
+    route = RoutingTable(RULES).resolve("phong_kham")
+    assert route.options == {"ingress_mode": "url"}
+    assert route.doctor_first == "skip"
+
+
+def test_invalid_rules_rejected():
+    with pytest.raises(ValueError):
+        RoutingTable([{"match": "glob"}])
+    with pytest.raises(Exception):
+        RoutingTable([{"match": "regex", "patterns": ["("]}])
+
+
+def test_router_reload_keeps_old_table_on_bad_config(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"rules": RULES[:1]}), encoding="utf-8")
+    router = Router(str(path), check_interval=0)
+    assert router.resolve("phong_kham").agent == "book_agent"
+
+    path.write_text(json.dumps({"rules": [{**RULES[0], "agent": "new_agent"}]}), encoding="utf-8")
+    os.utime(path, (1, 1))
+    assert router.maybe_reload()
+    assert router.resolve("phong_kham").agent == "new_agent"
+
+    path.write_text("{not json", encoding="utf-8")
+    os.utime(path, (2, 2))
+    assert not router.maybe_reload()
+    assert router.resolve("phong_kham").agent == "new_agent"
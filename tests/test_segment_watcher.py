@@ -0,0 +1,37 @@
+from segment_watcher import parse_playlist
+
+
+PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:6
+#EXT-X-PROGRAM-DATE-TIME:2026-10-18T08:00:00.000Z
+#EXTINF:6.000,
+room_00000.ts
+#EXTINF:5.5,
+room_00001.ts
+
+#EXT-X-PROGRAM-DATE-TIME:2026-10-18T08:00:11.500Z
+#EXTINF:2.25,
+room_00002.ts
+"""
+
+
+def test_parse_playlist_offsets():
+    segments, ended = parse_playlist(PLAYLIST)
+    assert not ended
+    assert [s["uri"] for s in segments] == ["room_00000.ts", "room_00001.ts", "room_00002.ts"]
+    assert [s["index"] for s in segments] == [0, 1, 2]
+    assert [s["start"] for s in segments] == [0.0, 6.0, 11.5]
+    assert [s["duration"] for s in segments] == [6.0, 5.5, 2.25]
+    # PROGRAM-DATE-TIME chỉ gắn cho segment ngay sau nó
+    assert [s["wall_clock"] for s in segments] == ["2026-10-18T08:00:00.000Z", None, "2026-10-18T08:00:11.500Z"]
+
+
+def test_parse_playlist_endlist_and_bad_duration():
+    segments, ended = parse_playlist("#EXTM3U\n#EXTINF:abc,\na.ts\nb.ts\n#EXT-X-ENDLIST\n")
+    assert ended
+    assert [(s["uri"], s["start"], s["duration"]) for s in segments] == [("a.ts", 0.0, 0.0), ("b.ts", 0.0, 0.0)]
+
+
+def test_parse_playlist_empty():
+    assert parse_playlist("") == ([], False)
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastmcp")
+pytest.importorskip("langchain_google_genai")
+
+from server import CustomerIndex, SlotCache, SlotIndex
+
+
+def owner(_id, phone, name="X"):
+    return {"_id": _id, "phone": phone, "name": name}
+
+
+def test_customer_index_normalizes_phone():
+    index = CustomerIndex("http://owner")
+    index.load([owner("o1", "+84 901 234 567")])
+    assert index.get("0901234567")["_id"] == "o1"
+    assert index.get("84901234567")["_id"] == "o1"
+
+
+def test_customer_index_load_keeps_pending_upsert():
+    index = CustomerIndex("http://owner")
+    index.load([owner("o1", "0901234567")])
+    index.upsert(owner("o2", "0911000111"))
+    # bảng tải về chưa có khách mới → không được làm mất bản upsert
+    index.load([owner("o1", "0901234567")])
+    assert index.get("0911000111")["_id"] == "o2"
+    # bảng đã có dòng đó → dùng bản của bảng, bỏ pending
+    index.load([owner("o1", "0901234567"), owner("o2", "0911000111", name="Y")])
+    assert index.get("0911000111")["name"] == "Y"
+    index.load([owner("o1", "0901234567")])
+    assert index.get("0911000111") is None
+
+
+def test_customer_index_invalidate_forces_refresh_on_miss():
+    index = CustomerIndex("http://owner", refresh_interval=3600, miss_refresh_interval=3600)
+    rows = [owner("o1", "0901234567")]
+    calls = []
+
+    async def refresh():
+        calls.append(1)
+        index.load(rows)
+        return True
+
+    index.refresh = refresh
+
+    async def run():
+        assert (await index.lookup("0901234567"))["_id"] == "o1"
+        # miss trong miss_refresh_interval → không tải lại
+        assert await index.lookup("0911000111") is None
+        assert len(calls) == 1
+        # vừa tạo khách qua gateway → lookup kế tiếp tải lại ngay, lấy đúng _id của OWNER
+        index.invalidate("0911000111")
+        rows.append(owner("o2", "0911000111"))
+        assert (await index.lookup("0911000111"))["_id"] == "o2"
+        assert len(calls) == 2
+        index._loop_task.cancel()
+
+    asyncio.run(run())
+
+
+def slot(shift, f, t, available=1, status="ACTIVE"):
+    return {"shiftId": shift, "fromTime": f, "toTime": t, "availableSlot": available, "status": status}
+
+
+def test_slot_index_containing_and_gaps():
+    index = SlotIndex([slot("s2", "09:00", "10:00"), slot("s1", "08:00", "12:00"), slot("s3", "13:00", "14:00")])
+    assert [s["shiftId"] for s in index.slots] == ["s1", "s2", "s3"]
+    assert index.containing(9 * 60, 9 * 60 + 30)["shiftId"] == "s1"
+    assert index.containing(13 * 60, 13 * 60 + 30)["shiftId"] == "s3"
+    assert index.containing(11 * 60 + 30, 13 * 60) is None
+    assert index.in_gap(12 * 60 + 10, 12 * 60 + 50)
+    assert (index.start_work, index.end_work) == (8 * 60, 14 * 60)
+
+
+def test_slot_index_skips_slots_without_times():
+    index = SlotIndex([slot("s1", "08:00", "09:00"), {"shiftId": "bad", "fromTime": "10:00"},
+                       slot("s3", None, "11:00"), slot("s4", "x", "11:00")])
+    assert [s["shiftId"] for s in index.slots] == ["s1"]
+
+
+def test_slot_cache_book_matches_by_shift_and_time():
+    cache = SlotCache("http://slot", ttl=60)
+    cache._entries[("c1", "2026-10-18")] = (float("inf"), SlotIndex([slot("s1", "08:00", "09:00", 2),
+                                                                     slot("s1", "09:00", "10:00", 2)]))
+    # dict của caller là bản copy (vd. đọc từ lần get trước), không cùng object với bản trong cache
+    cache.book("c1", "2026-10-18", dict(slot("s1", "09:00", "10:00", 2)))
+    index = cache._entries[("c1", "2026-10-18")][1]
+    assert [s["availableSlot"] for s in index.slots] == [2, 1]
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from sharding import RELEASE_SCRIPT, RENEW_SCRIPT, ShardManager, shard_of
+
+
+class LeaseRedis(fakeredis.aioredis.FakeRedis):
+    """fakeredis không kèm Lua (lupa): chạy 2 script lease bằng Python, cùng ngữ nghĩa compare-and-set."""
+
+    async def eval(self, script, numkeys, key, owner, *args):
+        if await self.get(key) != owner:
+            return 0
+        if script == RENEW_SCRIPT:
+            return int(await self.pexpire(key, int(args[0])))
+        assert script == RELEASE_SCRIPT
+        return await self.delete(key)
+
+
+def test_shard_of_is_stable_and_in_range():
+    rooms = [f"room_{i}" for i in range(2000)]
+    shards = [shard_of(r, 8) for r in rooms]
+    assert all(0 <= s < 8 for s in shards)
+    assert set(shards) == set(range(8))
+    assert shard_of("call_abc", 8) == shard_of("call_abc", 8)
+    assert all(shard_of(r, 1) == 0 for r in rooms[:50])
+
+
+def make_manager(server, instance_id, events, shard_count=4):
+    async def on_acquire(shards):
+        events.append(("acquire", instance_id, sorted(shards)))
+
+    async def on_release(shards):
+        events.append(("release", instance_id, sorted(shards)))
+
+    async def on_lost(shards):
+        events.append(("lost", instance_id, sorted(shards)))
+
+    manager = ShardManager("h", 0, shard_count=shard_count, lease_ttl=5, instance_id=instance_id,
+                           on_acquire=on_acquire, on_release=on_release, on_lost=on_lost)
+    manager._client = LeaseRedis(server=server, decode_responses=True)
+    return manager
+
+
+def test_acquire_applies_only_in_main_loop():
+    async def run():
+        server, events = fakeredis.FakeServer(), []
+        a = make_manager(server, "a", events)
+        await a.rebalance()
+        # lease đã có nhưng state chưa nạp → chưa xử lý room của shard đó
+        assert a.leased_shards() == [0, 1, 2, 3]
+        assert a.owned_shards() == [] and events == []
+        assert a.has_transitions()
+        await a.apply_transitions()
+        assert events == [("acquire", "a", [0, 1, 2, 3])]
+        assert a.owned_shards() == [0, 1, 2, 3]
+        # renew giữ lease, không sinh chuyển giao mới
+        await a.rebalance()
+        assert not a.has_transitions()
+
+    asyncio.run(run())
+
+
+def test_rebalance_releases_after_checkpoint():
+    async def run():
+        server, events = fakeredis.FakeServer(), []
+        a = make_manager(server, "a", events)
+        await a.rebalance()
+        await a.apply_transitions()
+
+        b = make_manager(server, "b", events)
+        await b.rebalance()  # b vào: chưa có shard trống
+        assert b.leased_shards() == []
+        await a.rebalance()  # a thấy 2 instance → nhả bớt, nhưng chỉ xếp hàng
+        assert len(a.leased_shards()) == 4
+        await a.apply_transitions()
+        released = events[-1]
+        assert released[:2] == ("release", "a") and len(released[2]) == 2
+        assert len(a.leased_shards()) == 2
+
+        await b.rebalance()
+        await b.apply_transitions()
+        assert events[-1] == ("acquire", "b", released[2])
+        assert sorted(a.owned_shards() + b.owned_shards()) == [0, 1, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_lost_lease_discards_without_release():
+    async def run():
+        server, events = fakeredis.FakeServer(), []
+        a = make_manager(server, "a", events, shard_count=2)
+        await a.rebalance()
+        await a.apply_transitions()
+
+        # lease shard 1 hết hạn và bị instance khác lấy
+        redis = LeaseRedis(server=server, decode_responses=True)
+        await redis.set(a._lease_key(1), "other")
+        await a.rebalance()
+        assert not a.owns_shard(1)
+        assert a.owned_shards() == [0]
+        await a.apply_transitions()
+        # không checkpoint shard đã mất (không gọi on_release), chỉ bỏ state local
+        assert events[-1] == ("lost", "a", [1])
+        assert not any(e[0] == "release" for e in events)
+        assert await redis.get(a._lease_key(1)) == "other"
+
+    asyncio.run(run())
+
+
+def test_stop_releases_all_leases():
+    async def run():
+        server, events = fakeredis.FakeServer(), []
+        a = make_manager(server, "a", events, shard_count=2)
+        await a.rebalance()
+        await a.stop()
+        # chuyển giao đang chờ được áp trước, rồi checkpoint + nhả lease
+        assert events == [("acquire", "a", [0, 1]), ("release", "a", [0, 1])]
+        redis = LeaseRedis(server=server, decode_responses=True)
+        assert await redis.get(a._lease_key(0)) is None
+
+    asyncio.run(run())
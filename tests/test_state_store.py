@@ -0,0 +1,126 @@
+import asyncio
+import json
+
+from state_store import DispatcherState, StateStore, TrackedDict, TrackedSet
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def hset(self, key, mapping):
+        self.ops.append(("hset", dict(mapping)))
+
+    def hdel(self, key, *fields):
+        self.ops.append(("hdel", sorted(fields)))
+
+    async def execute(self):
+        self.client.ops.extend(self.ops)
+        for op, arg in self.ops:
+            if op == "hset":
+                self.client.hash.update(arg)
+            else:
+                for field in arg:
+                    self.client.hash.pop(field, None)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hash = {}
+        self.ops = []
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+    async def hgetall(self, key):
+        return dict(self.hash)
+
+
+def make_state():
+    dirty = set()
+    state = DispatcherState(
+        TrackedSet(dirty), TrackedSet(dirty), TrackedDict(dirty), TrackedDict(dirty),
+        TrackedDict(dirty), TrackedDict(dirty), TrackedDict(dirty), dirty=dirty,
+    )
+    store = StateStore(state, "localhost", 6379)
+    store._client = FakeRedis()
+    return state, store
+
+
+def test_tracked_containers_mark_only_real_changes():
+    dirty = set()
+    d = TrackedDict(dirty)
+    d["a"] = 1
+    assert dirty == {"a"}
+    dirty.clear()
+    d["a"] = 1
+    d.pop("missing", None)
+    assert dirty == set()
+    d.pop("a")
+    assert dirty == {"a"}
+
+    dirty.clear()
+    s = TrackedSet(dirty)
+    s.add("r")
+    s.add("r")
+    s.discard("other")
+    assert dirty == {"r"}
+
+
+def test_flush_writes_only_dirty_rooms():
+    state, store = make_state()
+    redis = store._client
+
+    state.dispatched_rooms.add("r1")
+    state.egress_map["r2"] = "EG_1"
+    asyncio.run(store.flush())
+    assert redis.ops == [("hset", {"r1": '{"d":1}', "r2": '{"e":"EG_1"}'})]
+
+    # không đổi gì → không serialize, không ghi
+    redis.ops.clear()
+    asyncio.run(store.flush())
+    assert redis.ops == []
+
+    state.room_recording["r2"] = True
+    asyncio.run(store.flush())
+    assert redis.ops == [("hset", {"r2": '{"e":"EG_1","r":1}'})]
+
+    # room hết state → HDEL field
+    redis.ops.clear()
+    state.forget("r1")
+    asyncio.run(store.flush())
+    assert redis.ops == [("hdel", ["r1"])]
+    assert set(redis.hash) == {"r2"}
+
+
+def test_failed_flush_is_retried():
+    state, store = make_state()
+
+    class Broken(FakePipeline):
+        async def execute(self):
+            raise ConnectionError("down")
+
+    good = store._client
+    store._client.pipeline = lambda transaction=False: Broken(good)
+    state.dispatched_rooms.add("r1")
+    asyncio.run(store.flush())
+    assert good.hash == {}
+
+    del store._client.pipeline
+    asyncio.run(store.flush())
+    assert good.hash == {"r1": '{"d":1}'}
+
+
+def test_load_and_discard_keep_released_rooms_in_redis():
+    state, store = make_state()
+    store._client.hash = {"r1": json.dumps({"d": 1}), "r2": json.dumps({"e": "EG_2", "r": 1})}
+    assert asyncio.run(store.load(include=lambda r: r == "r1")) == 1
+    assert set(state.dispatched_rooms) == {"r1"} and not state.egress_map
+
+    # shard chuyển đi: bỏ state local, checkpoint trong Redis giữ nguyên cho instance mới
+    state.forget("r1")
+    store.discard(["r1"])
+    store._client.ops.clear()
+    asyncio.run(store.flush())
+    assert store._client.ops == [] and "r1" in store._client.hash
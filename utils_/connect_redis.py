@@ -1,34 +1,309 @@
-import redis, json
+import os
+import json
+import asyncio
+import time
 
-r = redis.Redis(
-    host='redis-connect.dev.longvan.vn',
-    port=32276,
-    password='111111aA',
-    decode_responses=True
-)
+# optional redis (async client, redis-py >= 4.2). Thiếu module thì registry luôn rỗng.
+try:
+    import redis.asyncio as aioredis
+except Exception:
+    aioredis = None
 
-hash_key = "room:online"
-all_fields = r.hgetall(hash_key)
+REDIS_HOST = os.getenv("REDIS_HOST", "redis-connect.dev.longvan.vn")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "32276"))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", "111111aA")
+REDIS_HASH_KEY = os.getenv("REDIS_HASH_KEY", "room:online")
 
-room_to_topic = {}  # dict để lưu mapping room -> topic
 
-if not all_fields:
-    print("❌ Không có room nào trong cache (room:online trống)")
-else:
-    print(f"✅ Có {len(all_fields)} room trong cache\n")
-    for field, value_json in all_fields.items():
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+def parse_room_value(field: str, value_json: str):
+    """Decode 1 value của hash room:online → (room_name, data) hoặc None nếu JSON lỗi."""
+    try:
+        data = json.loads(value_json)
+    except (TypeError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data.get("roomName") or field, data
+
+
+class RoomRegistry:
+    """
+    Bản sao in-memory của hash room:online: roomName -> {topicId, prescriptionId, ...}.
+      - 1 connection pool dùng lâu dài (không mở connection mới mỗi lần đọc)
+      - load toàn bộ hash 1 lần khi start
+      - sau đó cập nhật incremental: keyspace notification (nếu server bật) hoặc poll HKEYS,
+        chỉ HMGET các field mới, bỏ các field đã bị xóa
+      - full resync định kỳ (resync_interval) để bắt các value bị sửa tại chỗ
+    Đọc (room_names / get) là thao tác trên dict, không gọi Redis.
+    get_room_data(room): đọc từ map, miss thì HGET đúng room đó rồi cache lại. Process chỉ cần vài room (agent)
+    không start vòng sync: room đọc bằng HGET chỉ được dùng lại trong cache_ttl giây (value sửa tại chỗ như
+    prescriptionId vẫn thấy sau tối đa cache_ttl), không HGETALL / poll HKEYS.
+    """
+
+    def __init__(self, host: str = REDIS_HOST, port: int = REDIS_PORT, password: str = REDIS_PASSWORD,
+                 hash_key: str = REDIS_HASH_KEY, db: int = 0, max_connections: int = 10,
+                 poll_interval: float = 1.0, resync_interval: float = 60.0,
+                 enable_notifications: bool = False, on_latency=None, cache_ttl: float = 2.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.hash_key = hash_key
+        self.db = db
+        self.max_connections = max_connections
+        self.poll_interval = poll_interval
+        self.resync_interval = resync_interval
+        self.enable_notifications = enable_notifications
+        self.on_latency = on_latency  # callback(op, seconds) sau mỗi lệnh đọc Redis (metrics)
+        self.cache_ttl = cache_ttl
+
+
+        self.rooms = {}       # room_name -> data
+        self._fields = {}     # field -> room_name
+        self._fetched = {}    # room_name -> monotonic lúc HGET (room đọc lẻ khi chưa start vòng sync)
+        self.version = 0      # tăng mỗi khi map thay đổi
+        self._client = None
+        self._client_loop = None
+        self._task = None
+        self._loop = None
+
+    # ---------- đọc (không IO) ----------
+    def room_names(self):
+        return set(self.rooms.keys())
+
+    def get(self, room_name: str):
+        return self.rooms.get(room_name)
+
+    async def get_room_data(self, room_name: str) -> dict:
+        """Đọc từ map; miss (room vừa được tạo) hoặc bản HGET đã quá cache_ttl thì HGET 1 lần và cache lại."""
+        if not room_name:
+            return {}
+        data = self.rooms.get(room_name)
+        if data is not None:
+            fetched_at = self._fetched.get(room_name)
+            if fetched_at is None or time.monotonic() - fetched_at < self.cache_ttl:
+                return data
+        parsed = await self._hget(room_name)
+        if parsed is None:
+            if room_name in self._fetched:
+                # room đã bị xóa khỏi hash (hoặc đọc lỗi) → không dùng bản cache cũ
+                self._fetched.pop(room_name, None)
+                self._drop(room_name)
+            return {}
+        self._apply(room_name, *parsed)
+        if self._task is None:
+            # vòng sync không chạy → bản này không được cập nhật, chỉ dùng trong cache_ttl
+            self._fetched[room_name] = time.monotonic()
+        return parsed[1]
+
+    async def _hget(self, room_name: str):
+        if not self._connect():
+            return None
+        try:
+            value_json = await self._timed("hget", self._client.hget(self.hash_key, room_name))
+        except Exception as e:
+            print(f"{now()} ⚠️ Redis hget failed for room={room_name}: {repr(e)}", flush=True)
+            return None
+        if not value_json:
+            return None
+        return parse_room_value(room_name, value_json)
+
+    # ---------- vòng đời ----------
+    async def start(self):
+        """Idempotent: gọi nhiều lần chỉ khởi tạo 1 lần trên mỗi event loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop or not self._connect():
+            return
+        self._loop = loop
+        self._fetched.clear()  # từ giờ map do vòng sync cập nhật
+        await self._full_sync()
+        self._task = asyncio.create_task(self._run())
+
+    def _connect(self) -> bool:
+        """Tạo connection pool cho event loop hiện tại (1 lần / loop); False nếu thiếu redis."""
+        if aioredis is None:
+            return False
+        loop = asyncio.get_running_loop()
+        if self._client is not None and self._client_loop is loop:
+            return True
+        self._client_loop = loop
+        pool = aioredis.ConnectionPool(
+            host=self.host,
+            port=self.port,
+            password=self.password or None,
+            db=self.db,
+            max_connections=self.max_connections,
+            decode_responses=True,
+            socket_connect_timeout=3,
+            socket_timeout=3,
+        )
+        self._client = aioredis.Redis(connection_pool=pool)
+        return True
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self._client_loop = None
+        self._loop = None
+
+    async def _timed(self, op: str, coro):
+        started = time.monotonic()
         try:
-            data = json.loads(value_json)
-            room_name = data.get("roomName")
-            topic_id = data.get("topicId")
-            prescriptionId = data.get("prescriptionId")
-            if room_name and topic_id:
-                room_to_topic[room_name] = topic_id
-            print(f"room={room_name}, topic={topic_id}, prescriptionId={prescriptionId}")
+            return await coro
+        finally:
+            if self.on_latency is not None:
+                self.on_latency(op, time.monotonic() - started)
+
+    # ---------- sync ----------
+    def _apply(self, field: str, room_name: str, data: dict):
+        if self.rooms.get(room_name) != data or self._fields.get(field) != room_name:
+            self._fields[field] = room_name
+            self.rooms[room_name] = data
+            self.version += 1
+
+    def _drop(self, field: str):
+        room_name = self._fields.pop(field, None)
+        if room_name is not None:
+            self.rooms.pop(room_name, None)
+            self.version += 1
+
+    async def _full_sync(self):
+        try:
+            all_fields = await self._timed("hgetall", self._client.hgetall(self.hash_key))
         except Exception as e:
-            print(f"Lỗi decode JSON field={field}: {e}")
+            print(f"{now()} ⚠️ Redis hgetall {self.hash_key} failed: {repr(e)}", flush=True)
+            return False
+        rooms, fields = {}, {}
+        for field, value_json in all_fields.items():
+            parsed = parse_room_value(field, value_json)
+            if parsed is None:
+                fields[field] = None  # JSON lỗi: nhớ field để incremental sync không đọc lại mãi
+                continue
+            fields[field] = parsed[0]
+            rooms[parsed[0]] = parsed[1]
+        if rooms != self.rooms:
+            self.version += 1
+        self.rooms, self._fields = rooms, fields
+        return True
+
+    async def _incremental_sync(self):
+        """
+        HKEYS (chỉ tên field) → diff với map hiện tại; HMGET field mới, bỏ field đã xóa.
+        Trả về False nếu không thấy thay đổi membership (có thể là value bị sửa tại chỗ).
+        """
+        try:
+            keys = set(await self._timed("hkeys", self._client.hkeys(self.hash_key)))
+        except Exception as e:
+            print(f"{now()} ⚠️ Redis hkeys {self.hash_key} failed: {repr(e)}", flush=True)
+            return True
+        known = set(self._fields.keys())
+        added = keys - known
+        removed = known - keys
+        for field in removed:
+            self._drop(field)
+        if added:
+            added = list(added)
+            try:
+                values = await self._timed("hmget", self._client.hmget(self.hash_key, added))
+            except Exception as e:
+                print(f"{now()} ⚠️ Redis hmget {self.hash_key} failed: {repr(e)}", flush=True)
+                return True
+            for field, value_json in zip(added, values):
+                parsed = parse_room_value(field, value_json)
+                if parsed is None:
+                    self._fields[field] = None
+                else:
+                    self._apply(field, *parsed)
+        return bool(added or removed)
+
+    async def _notifications_enabled(self) -> bool:
+        try:
+            cfg = (await self._client.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+            if "K" in cfg and ("h" in cfg or "A" in cfg):
+                return True
+            if self.enable_notifications:
+                await self._client.config_set("notify-keyspace-events", cfg + "Kh")
+                return True
+        except Exception:
+            # managed redis thường chặn CONFIG → dùng poll
+            pass
+        return False
+
+    async def _run(self):
+        use_notifications = await self._notifications_enabled()
+        last_full = time.monotonic()
+        while True:
+            try:
+                if use_notifications:
+                    await self._listen()
+                else:
+                    await asyncio.sleep(self.poll_interval)
+                    await self._incremental_sync()
+                if time.monotonic() - last_full >= self.resync_interval:
+                    await self._full_sync()
+                    last_full = time.monotonic()
+                    use_notifications = await self._notifications_enabled()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{now()} ⚠️ Room registry sync error: {repr(e)}", flush=True)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _listen(self):
+        """Nghe keyspace event của hash tới khi đến hạn full resync."""
+        channel = f"__keyspace@{self.db}__:{self.hash_key}"
+        pubsub = self._client.pubsub()
+        await pubsub.subscribe(channel)
+        deadline = time.monotonic() + self.resync_interval
+        try:
+            # subscribe xong mới diff 1 lần để không lỡ thay đổi xảy ra trong lúc chưa nghe
+            await self._incremental_sync()
+            while time.monotonic() < deadline:
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if not msg:
+                    continue
+                op = msg.get("data")
+                if op == "del":
+                    if self.rooms:
+                        self.rooms, self._fields = {}, {}
+                        self.version += 1
+                elif op == "hset":
+                    # hset field có sẵn (sửa value) không đổi membership → đọc lại toàn bộ
+                    if not await self._incremental_sync():
+                        await self._full_sync()
+                else:
+                    await self._incremental_sync()
+        finally:
+            await pubsub.aclose()
+
+
+# registry dùng chung trong 1 process (dispatcher: start() + map in-memory; agent: get_room_data không start)
+room_registry = RoomRegistry()
+
+
+if __name__ == "__main__":
+    async def _main():
+        await room_registry.start()
+        rooms = room_registry.rooms
+        if not rooms:
+            print(f"❌ Không có room nào trong cache ({REDIS_HASH_KEY} trống)")
+        else:
+            print(f"✅ Có {len(rooms)} room trong cache\n")
+            for room_name, data in rooms.items():
+                print(f"room={room_name}, topic={data.get('topicId')}, prescriptionId={data.get('prescriptionId')}")
+
+        # Ví dụ: tra cứu topicId từ roomName
+        room_query = "call_20.178926.8835_20.177629.3219_1762307502536"
+        data = await room_registry.get_room_data(room_query)
+        print(f"\nTopicId của room '{room_query}' là: {data.get('topicId')}")
+        await room_registry.stop()
 
-# Ví dụ: tra cứu topicId từ roomName
-room_query = "call_20.178926.8835_20.177629.3219_1762307502536"
-topic_id = room_to_topic.get(room_query)
-print(f"\nTopicId của room '{room_query}' là: {topic_id}")
+    asyncio.run(_main())
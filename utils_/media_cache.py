@@ -0,0 +1,272 @@
+import os
+import json
+import asyncio
+import hashlib
+import tempfile
+import time
+
+import aiohttp
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ingress_media_cache"))
+MEDIA_REVALIDATE_INTERVAL = float(os.getenv("MEDIA_REVALIDATE_INTERVAL", "300"))
+
+# Encode 1 lần, sẵn sàng cho RTMP ingress: H.264 main + AAC, GOP cố định 2s để ingress nhận keyframe đều
+INGRESS_ENCODE_ARGS = [
+    "-vf", "scale=1280:720",
+    "-c:v", "libx264",
+    "-preset", "medium",
+    "-profile:v", "main",
+    "-pix_fmt", "yuv420p",
+    "-b:v", "1300k",
+    "-maxrate", "1500k",
+    "-bufsize", "2200k",
+    "-r", "30",
+    "-g", "60",
+    "-keyint_min", "60",
+    "-sc_threshold", "0",
+    "-c:a", "aac",
+    "-b:a", "96k",
+    "-ac", "2",
+    "-ar", "22050",
+]
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+def stream_copy_cmd(media_path: str, rtmp_url: str):
+    """Lệnh ffmpeg đẩy file đã encode sẵn lên RTMP, không encode lại (-c copy)."""
+    return [
+        "ffmpeg", "-re",
+        "-stream_loop", "-1",
+        "-i", media_path,
+        "-c", "copy",
+        "-f", "flv", rtmp_url,
+    ]
+
+
+class MediaCache:
+    """
+    Cache video chờ trên đĩa: tải 1 lần (theo URL + ETag/Last-Modified), encode 1 lần ra FLV H.264/AAC,
+    các room sau chỉ stream bằng -c copy.
+      - index.json: url -> {etag, last_modified, file, checked}
+      - revalidate bằng conditional GET (If-None-Match / If-Modified-Since) tối đa 1 lần / revalidate_interval
+      - nhiều room cùng xin 1 URL cùng lúc chỉ tải + encode 1 lần
+      - file local (không phải http) thì key theo path + mtime + size
+      - đã có bản encode thì get() trả ngay, kể cả khi đến hạn revalidate: tải + encode lại chạy nền,
+        xong mới đổi sang bản mới (stale-while-revalidate) → không nằm trên đường start ingress
+      - start(resolve_source): encode sẵn lúc dispatcher khởi động và refresh nền mỗi revalidate_interval
+    get() trả None nếu tải/encode lỗi → caller tự fallback về encode trực tiếp.
+    """
+
+    def __init__(self, cache_dir: str = MEDIA_CACHE_DIR, revalidate_interval: float = MEDIA_REVALIDATE_INTERVAL,
+                 encode_args=None, ffmpeg: str = "ffmpeg"):
+        self.cache_dir = cache_dir
+        self.revalidate_interval = revalidate_interval
+        self.encode_args = list(encode_args or INGRESS_ENCODE_ARGS)
+        self.ffmpeg = ffmpeg
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._index = None
+        self._locks = {}
+        self._refreshing = {}  # source -> task revalidate nền
+        self._loop_task = None
+
+    # ---------- index ----------
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        tmp = self._index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(tmp, self._index_path)
+
+    def _entry_ready(self, entry) -> bool:
+        return bool(entry) and os.path.exists(os.path.join(self.cache_dir, entry["file"]))
+
+    def _cached(self, source: str):
+        """(đường dẫn bản encode đang có hoặc None, có cần revalidate không)."""
+        entry = self._load_index().get(source)
+        if not self._entry_ready(entry):
+            return None, True
+        path = os.path.join(self.cache_dir, entry["file"])
+        if source.startswith(("http://", "https://")):
+            return path, time.time() - entry.get("checked", 0) >= self.revalidate_interval
+        try:
+            return path, self._local_name(source) != entry["file"]
+        except OSError:
+            return path, False
+
+    # ---------- API ----------
+    async def get(self, source: str):
+        """Đường dẫn FLV đã encode sẵn của source (URL hoặc file local), hoặc None nếu lỗi."""
+        if not source:
+            return None
+        path, stale = self._cached(source)
+        if path is not None:
+            if stale:
+                self._refresh_in_background(source)
+            return path
+        # cache lạnh (chưa pre-warm kịp): đành đợi tải + encode
+        return await self.refresh(source)
+
+    def _refresh_in_background(self, source: str):
+        task = self._refreshing.get(source)
+        if task is None or task.done():
+            task = asyncio.create_task(self.refresh(source))
+            self._refreshing[source] = task
+
+            def _done(t):
+                if self._refreshing.get(source) is t:
+                    self._refreshing.pop(source, None)
+
+            task.add_done_callback(_done)
+        return task
+
+    async def refresh(self, source: str):
+        """Revalidate / tải + encode source ngay (giữ lock theo source); trả về đường dẫn hoặc None nếu lỗi."""
+        if not source:
+            return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        lock = self._locks.setdefault(source, asyncio.Lock())
+        async with lock:
+            try:
+                if source.startswith(("http://", "https://")):
+                    return await self._get_remote(source)
+                return await self._get_local(source)
+            except Exception as e:
+                print(f"{now()} ⚠️ Media cache lỗi cho {source}: {repr(e)}")
+                return None
+
+    async def _get_remote(self, url: str):
+        index = self._load_index()
+        entry = index.get(url)
+        ready = self._entry_ready(entry)
+        if ready and time.time() - entry.get("checked", 0) < self.revalidate_interval:
+            return os.path.join(self.cache_dir, entry["file"])
+
+        headers = {}
+        if ready and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if ready and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        fd, src_tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".src")
+        os.close(fd)
+        try:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=300)) as resp:
+                        if resp.status == 304 and ready:
+                            entry["checked"] = time.time()
+                            self._save_index()
+                            return os.path.join(self.cache_dir, entry["file"])
+                        if resp.status != 200:
+                            raise RuntimeError(f"HTTP {resp.status}")
+                        etag = resp.headers.get("ETag")
+                        last_modified = resp.headers.get("Last-Modified")
+                        digest = hashlib.sha1(url.encode("utf-8"))
+                        with open(src_tmp, "wb") as f:
+                            async for chunk in resp.content.iter_chunked(1 << 16):
+                                f.write(chunk)
+                                if not etag:
+                                    digest.update(chunk)
+            except Exception as e:
+                if ready:
+                    # CMS/CDN lỗi → dùng bản đã encode trước đó
+                    print(f"{now()} ⚠️ Revalidate {url} lỗi, dùng bản cache cũ: {repr(e)}")
+                    return os.path.join(self.cache_dir, entry["file"])
+                raise
+
+            if etag:
+                digest.update(etag.encode("utf-8"))
+            name = digest.hexdigest()[:20] + ".flv"
+            if not (entry and entry.get("file") == name and ready):
+                await self._encode(src_tmp, os.path.join(self.cache_dir, name))
+            self._replace_entry(url, {
+                "etag": etag, "last_modified": last_modified, "file": name, "checked": time.time(),
+            })
+            return os.path.join(self.cache_dir, name)
+        finally:
+            if os.path.exists(src_tmp):
+                os.remove(src_tmp)
+
+    @staticmethod
+    def _local_name(path: str) -> str:
+        st = os.stat(path)
+        key = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:20] + ".flv"
+
+    async def _get_local(self, path: str):
+        name = self._local_name(path)
+        index = self._load_index()
+        entry = index.get(path)
+        if not (entry and entry.get("file") == name and self._entry_ready(entry)):
+            await self._encode(path, os.path.join(self.cache_dir, name))
+            self._replace_entry(path, {"file": name, "checked": time.time()})
+        return os.path.join(self.cache_dir, name)
+
+    def _replace_entry(self, source: str, entry: dict):
+        old = self._index.get(source)
+        self._index[source] = entry
+        self._save_index()
+        # bản encode cũ của cùng source không còn ai trỏ tới → xóa
+        if old and old.get("file") != entry["file"]:
+            if not any(e.get("file") == old["file"] for e in self._index.values()):
+                try:
+                    os.remove(os.path.join(self.cache_dir, old["file"]))
+                except OSError:
+                    pass
+
+    # ---------- pre-warm ----------
+    async def _run(self, resolve_source):
+        while True:
+            try:
+                source = await resolve_source()
+                if source:
+                    await self.refresh(source)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{now()} ⚠️ Pre-warm media cache lỗi: {repr(e)}")
+            await asyncio.sleep(self.revalidate_interval)
+
+    def start(self, resolve_source):
+        """Encode sẵn video chờ hiện tại (resolve_source: coroutine trả về URL / path) và refresh nền định kỳ."""
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run(resolve_source))
+
+    async def stop(self):
+        tasks = [t for t in (self._loop_task, *self._refreshing.values()) if t is not None and not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop_task = None
+        self._refreshing.clear()
+
+    async def _encode(self, src: str, dst: str):
+        tmp = dst + ".part"
+        cmd = [self.ffmpeg, "-y", "-v", "error", "-i", src, *self.encode_args, "-f", "flv", tmp]
+        print(f"{now()} 🎞️ Encode video chờ 1 lần → {dst}")
+        started = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise RuntimeError(f"ffmpeg exit {proc.returncode}: {stderr.decode(errors='replace')[-500:]}")
+        os.replace(tmp, dst)
+        print(f"{now()} ✅ Encode xong sau {time.monotonic() - started:.1f}s")
+
+
+# cache dùng chung trong 1 process
+media_cache = MediaCache()
@@ -0,0 +1,143 @@
+import os
+import asyncio
+import time
+
+import aiohttp
+
+WAITING_VIDEO_API_URL = os.getenv(
+    "WAITING_VIDEO_API_URL",
+    "https://content-core-dev.longvan.vn/api/layouts?filters[sites][name][$eq]=TRUEDOC&filters[name][$eq]=WAITINGROOM&populate[banners]=true",
+)
+WAITING_VIDEO_TTL = float(os.getenv("WAITING_VIDEO_TTL", "60"))
+WAITING_VIDEO_STALE_TTL = float(os.getenv("WAITING_VIDEO_STALE_TTL", "86400"))
+
+
+def now():
+    return time.strftime("[%H:%M:%S]")
+
+
+def parse_latest_video_url(data):
+    """Lấy URL video mới nhất trong banner đầu tiên của layout WAITINGROOM; None nếu không có."""
+    banners = (
+        data.get("data", [{}])[0]
+        .get("attributes", {})
+        .get("banners", {})
+        .get("data", [])
+    )
+    if not banners:
+        print(f"{now()} ⚠️ Không có banner nào trong dữ liệu API.")
+        return None
+
+    media_items = banners[0]["attributes"].get("media", [])
+    videos = [m for m in media_items if m.get("type") == "VIDEO" and m.get("url")]
+    if not videos:
+        print(f"{now()} ⚠️ Không tìm thấy media VIDEO nào.")
+        return None
+    return videos[-1]["url"]
+
+
+class WaitingVideoSource:
+    """
+    Cache URL video chờ lấy từ CMS layout API:
+      - còn trong ttl → trả ngay, không gọi CMS
+      - quá ttl nhưng chưa quá stale_ttl → trả giá trị cũ ngay, refresh chạy nền (stale-while-revalidate)
+      - chưa có giá trị / quá stale_ttl → đợi 1 lần refresh (nhiều caller dùng chung 1 request)
+      - refresh dùng If-None-Match / If-Modified-Since; 304 chỉ gia hạn
+      - CMS lỗi → giữ URL tốt gần nhất (last known-good)
+    start() chạy refresher nền (mỗi ttl giây) để get() gần như không bao giờ phải đợi CMS.
+    """
+
+    def __init__(self, api_url: str = WAITING_VIDEO_API_URL, ttl: float = WAITING_VIDEO_TTL,
+                 stale_ttl: float = WAITING_VIDEO_STALE_TTL, timeout: float = 10):
+        self.api_url = api_url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.url = None
+        self._fetched_at = 0.0
+        self._etag = None
+        self._last_modified = None
+        self._session = None
+        self._refresh_task = None
+        self._loop_task = None
+
+    def _age(self) -> float:
+        return time.monotonic() - self._fetched_at
+
+    async def get(self):
+        if self.url is not None:
+            if self._age() < self.ttl:
+                return self.url
+            if self._age() < self.stale_ttl:
+                self._ensure_refresh()
+                return self.url
+        await asyncio.shield(self._ensure_refresh())
+        return self.url
+
+    def _ensure_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+        return self._refresh_task
+
+    async def refresh(self) -> bool:
+        """Gọi CMS 1 lần; True nếu có URL hợp lệ (mới hoặc 304)."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        headers = {}
+        if self.url is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        try:
+            async with self._session.get(self.api_url, headers=headers) as resp:
+                if resp.status == 304 and self.url is not None:
+                    self._fetched_at = time.monotonic()
+                    return True
+                if resp.status != 200:
+                    print(f"{now()} ❌ API lỗi: {resp.status}")
+                    return False
+                data = await resp.json()
+                etag = resp.headers.get("ETag")
+                last_modified = resp.headers.get("Last-Modified")
+            url = parse_latest_video_url(data)
+        except Exception as e:
+            print(f"{now()} ❌ Lỗi khi fetch video URL: {e}")
+            return False
+        if not url:
+            return False
+        if url != self.url:
+            print(f"{now()} 🎬 Video mới nhất: {url}")
+        self.url = url
+        self._etag = etag
+        self._last_modified = last_modified
+        self._fetched_at = time.monotonic()
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"{now()} ⚠️ Refresh video chờ lỗi: {repr(e)}")
+            await asyncio.sleep(self.ttl)
+
+    def start(self):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._loop_task, self._refresh_task):
+            if task is not None and not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._loop_task = self._refresh_task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+# resolver dùng chung trong 1 process
+waiting_video = WaitingVideoSource()
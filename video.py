@@ -3,6 +3,7 @@ import asyncio
 import subprocess
 from dotenv import load_dotenv
 from livekit import api
+from utils_.media_cache import media_cache, stream_copy_cmd
 
 """
 Chiếu video local lên phòng LiveKit bằng RTMP Ingress.
@@ -25,6 +26,9 @@ async def create_ingress_and_push(video_path: str, room_name: str):
         print(f"❌ Không tìm thấy file: {video_path}")
         return
 
+    # Encode sẵn 1 lần (cache theo path + mtime), các lần chạy sau chỉ stream copy
+    cached_path = await media_cache.get(video_path)
+
     print("🔗 Kết nối LiveKit API...")
     lkapi = api.LiveKitAPI(
         url=os.getenv("LIVEKIT_URL"),
@@ -48,7 +52,7 @@ async def create_ingress_and_push(video_path: str, room_name: str):
     print(f"🎥 RTMP endpoint: {full_rtmp}")
 
     # Lệnh ffmpeg push video local lên ingress
-    cmd = [
+    cmd = stream_copy_cmd(cached_path, full_rtmp) if cached_path else [
         "ffmpeg", "-re", "-stream_loop", "-1",
         "-i", video_path,
         "-c:v", "libx264", "-preset", "veryfast",